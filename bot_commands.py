@@ -1,34 +1,557 @@
 import logging
-import re
+import array
 import asyncio
+import contextlib
+import heapq
+import html
 import time
+import warnings
 from asyncio import Task
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import IntEnum
 from typing import Dict, Optional, Tuple, List, Set
-from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatMemberUpdated
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatMemberUpdated, MessageEntity
+from telegram.error import RetryAfter
+from telegram.warnings import PTBUserWarning
 from telegram.ext import (ContextTypes, ConversationHandler, CommandHandler, 
                          MessageHandler, filters, CallbackQueryHandler)
-from db_manager import (save_user, save_group, add_user_to_group, get_group_rules, 
-                       set_group_rules, get_user, get_pending_transactions, get_group_members,
+from db_manager import (save_user, save_users, save_group, add_user_to_group, save_group_members,
+                       get_group_rules, 
+                       set_group_rules, get_user, get_users, get_pending_transactions, get_group_members,
+                       get_group_member_by_username,
                        reset_group_data, get_expense_with_debts, update_expense_amount, 
-                       delete_expense, get_group_transactions, delete_transaction, get_group_expenses)
+                       delete_expense, get_group_transactions, delete_transaction, get_group_expenses,
+                       MEMBER_FIELDS)
 from expense_handler import (handle_new_expense, format_debt_message, 
                            handle_money_transfer, confirm_transaction, reject_transaction)
 from report_generator import generate_excel_report, generate_pdf_report
-from utils import is_admin, extract_username_and_amount
+from utils import is_admin, extract_username_and_amount, TTLCache, batched, AsyncRateLimiter
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-# Словарь для хранения таймеров удаления сообщений
-message_deletion_tasks: Dict[Tuple[int, int], Task] = {}  # (chat_id, message_id) -> Task
-# Словарь для хранения цепочек сообщений (родитель -> дети)
-message_chains: Dict[Tuple[int, int], List[Tuple[int, int]]] = {}  # (chat_id, parent_msg_id) -> [(chat_id, child_msg_id), ...]
-# Словарь для хранения незавершенных цепочек операций пользователей
-user_pending_operations: Dict[int, Dict[str, any]] = {}  # user_id -> {operation_data}
 # Время в секундах до удаления сообщения
 MESSAGE_DELETE_AFTER = 300  # 5 минут
 MESSAGE_REMINDER_AFTER = 240  # 4 минуты (напоминание за минуту до удаления)
+# Повтор той же операции быстрее этого интервала считается двойным нажатием
+DUPLICATE_OPERATION_WINDOW = 2.0
+# Ограничения для глобальных хранилищ, чтобы память не росла без предела
+STATE_CACHE_MAXSIZE = 10_000
+STATE_CACHE_TTL = MESSAGE_DELETE_AFTER + 60
+# Очистка чата при сбросе: сколько последних сообщений удалять и размер пакета
+# deleteMessages (не больше 100 по ограничению Bot API)
+RESET_DELETE_DEPTH = 1000
+DELETE_MESSAGES_BATCH = 100
+# Сколько последних расходов/транзакций показывать в меню администратора
+ADMIN_LIST_LIMIT = 10
+# Фильтр текстовых ответов в диалогах: один объект на все MessageHandler
+TEXT_NOT_COMMAND = filters.TEXT & ~filters.COMMAND
+# Типы чатов, в которых работает бот
+_GROUP_TYPES = frozenset(('group', 'supergroup'))
+# Статические клавиатуры: InlineKeyboardMarkup неизменяем, поэтому создаем их один раз
+_PHOTO_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Да", callback_data="expense_photo_yes"),
+        InlineKeyboardButton("Нет", callback_data="expense_photo_no"),
+    ]
+])
+_SEND_CONFIRM_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Подтвердить", callback_data="send_confirm"),
+        InlineKeyboardButton("Отменить", callback_data="send_cancel"),
+    ]
+])
+# Кнопки быстрого доступа под закрепленными правилами группы
+_RULES_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("➕ Добавить расход", callback_data="help_addexpense"),
+        InlineKeyboardButton("💰 Мой долг", callback_data="help_mydebt")
+    ],
+    [
+        InlineKeyboardButton("📊 Отчет", callback_data="help_report"),
+        InlineKeyboardButton("💸 Отправить деньги", callback_data="help_send")
+    ]
+])
+_RESET_CONFIRM_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Да, подтверждаю", callback_data="reset_confirm"),
+        InlineKeyboardButton("Отмена", callback_data="reset_cancel")
+    ]
+])
+_SETUP_RULES_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Да", callback_data="setup_rules_yes"),
+        InlineKeyboardButton("Нет", callback_data="setup_rules_no")
+    ]
+])
+# Меню администратора (Markdown)
+_ADMIN_MENU_TEXT = (
+    "*Меню администратора*\n\n"
+    "Выберите действие из списка ниже:"
+)
+_ADMIN_MENU_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📝 Редактировать расходы", callback_data="admin_edit_expenses"),
+        InlineKeyboardButton("🗑️ Удалить расходы", callback_data="admin_delete_expenses")
+    ],
+    [
+        InlineKeyboardButton("🧹 Удалить транзакции", callback_data="admin_delete_transactions"),
+        InlineKeyboardButton("⚙️ Настроить правила", callback_data="help_rules")
+    ],
+    [
+        InlineKeyboardButton("♻️ Сбросить данные группы", callback_data="admin_reset"),
+        InlineKeyboardButton("⬅️ Назад", callback_data="admin_back")
+    ]
+])
+_ABOUT_TEXT = (
+    "*О боте для учета расходов*\n\n"
+    "Этот бот помогает группам друзей или коллег вести учет совместных расходов и разделять их между участниками.\n\n"
+    "*Основные возможности:*\n"
+    "• Добавление расходов с выбором участников\n"
+    "• Автоматический расчет долга для каждого участника\n"
+    "• Загрузка фото чеков для подтверждения расходов\n"
+    "• Перевод денег между участниками\n"
+    "• Генерация отчетов для контроля финансов\n\n"
+    "Создан с использованием Python и библиотеки python-telegram-bot."
+)
+# Меню помощи: обычный вариант и вариант с кнопкой администрирования
+_HELP_ROWS = (
+    (
+        InlineKeyboardButton("➕ Добавить расход", callback_data="help_addexpense"),
+        InlineKeyboardButton("💰 Мой долг", callback_data="help_mydebt")
+    ),
+    (
+        InlineKeyboardButton("📊 Отчет", callback_data="help_report"),
+        InlineKeyboardButton("💸 Отправить деньги", callback_data="help_send")
+    ),
+    (
+        InlineKeyboardButton("⚙️ Правила группы", callback_data="help_rules"),
+        InlineKeyboardButton("ℹ️ О боте", callback_data="help_about")
+    ),
+)
+_HELP_MARKUP_USER = InlineKeyboardMarkup(_HELP_ROWS)
+_HELP_MARKUP_ADMIN = InlineKeyboardMarkup(
+    _HELP_ROWS + ((InlineKeyboardButton("🔧 Администрирование", callback_data="help_admin"),),)
+)
+# Текст закрепляемых правил группы (HTML): описание, срок погашения (часы), время уведомлений
+_PINNED_RULES_TEMPLATE = (
+    "<b>ПРАВИЛА ГРУППЫ:</b>\n\n"
+    "• <b>Описание:</b> %s\n"
+    "• <b>Срок погашения:</b> %s часов\n"
+    "• <b>Время уведомлений:</b> %s\n\n"
+    "Используйте кнопки ниже для быстрого доступа к основным функциям:"
+)
+
+def _pinned_rules_text(description, deadline_hours, notifications_time) -> str:
+    """Подставляет правила в шаблон, экранируя пользовательский текст для HTML."""
+    return _PINNED_RULES_TEMPLATE % tuple(
+        html.escape(str(value)) for value in (description, deadline_hours, notifications_time)
+    )
+
+def _bold_entities(text: str, *phrases: str) -> List[MessageEntity]:
+    """Строит жирные MessageEntity для фраз текста (смещения в UTF-16, как требует Telegram)."""
+    def utf16_len(part: str) -> int:
+        return len(part.encode('utf-16-le')) // 2
+    entities = []
+    for phrase in phrases:
+        start = text.index(phrase)
+        entities.append(MessageEntity(MessageEntity.BOLD, utf16_len(text[:start]), utf16_len(phrase)))
+    return entities
+
+# Текст меню помощи; разметка передается готовыми entities, без разбора Markdown
+_HELP_TEXT = (
+    "Команды бота:\n\n"
+    "Нажмите на кнопку ниже для выполнения соответствующей команды.\n\n"
+    "Как использовать:\n"
+    "1. Добавляйте расходы\n"
+    "2. Проверяйте свой долг\n"
+    "3. Отправляйте деньги участникам\n"
+    "4. Получайте отчеты\n"
+    "5. Администраторы имеют дополнительные функции"
+)
+_HELP_ENTITIES = _bold_entities(_HELP_TEXT, "Команды бота:", "Как использовать:")
+
+# Готовые аргументы меню помощи (ключ - является ли пользователь администратором);
+# вызывающий код распаковывает их через **, поэтому общие словари не изменяются
+_HELP_PAYLOADS = {
+    is_user_admin: {
+        'text': _HELP_TEXT,
+        'entities': _HELP_ENTITIES,
+        'reply_markup': _HELP_MARKUP_ADMIN if is_user_admin else _HELP_MARKUP_USER,
+    }
+    for is_user_admin in (False, True)
+}
+
+def _help_payload(is_user_admin: bool) -> Dict:
+    """Аргументы отправки/редактирования меню помощи для обычного пользователя или администратора."""
+    return _HELP_PAYLOADS[bool(is_user_admin)]
+# Строка "Назад" для возврата в меню администратора (кортеж, чтобы её нельзя было изменить)
+_BACK_ROW = (InlineKeyboardButton("⬅️ Назад", callback_data="help_admin"),)
+# Строка управления под списком участников расхода
+_PARTICIPANTS_CONTROL_ROW = (
+    InlineKeyboardButton("Выбрать всех", callback_data="participants_all"),
+    InlineKeyboardButton("Готово", callback_data="participants_done"),
+)
+# Кнопка отмены в подтверждениях удаления из меню администратора
+_ADMIN_CANCEL_BUTTON = InlineKeyboardButton("Отмена", callback_data="admin_back")
+# Строка отмены под списком получателей перевода
+_SEND_CANCEL_ROW = (InlineKeyboardButton("Отмена", callback_data="send_cancel"),)
+_EXPENSE_TYPE_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("На всех участников группы", callback_data="expense_all_members"),
+        InlineKeyboardButton("Выборочно", callback_data="expense_selective")
+    ]
+])
+
+def _valid_hhmm(text: str) -> bool:
+    """Проверяет время уведомлений в формате Ч:ММ или ЧЧ:ММ без регулярного выражения."""
+    hours, sep, minutes = text.partition(':')
+    if not sep or len(minutes) != 2 or not 1 <= len(hours) <= 2:
+        return False
+    if not (hours.isascii() and hours.isdigit() and minutes.isascii() and minutes.isdigit()):
+        return False
+    return int(hours) < 24 and int(minutes) < 60
+
+def _unsigned_part(text: str) -> str:
+    return text[1:] if text[:1] in ('+', '-') else text
+
+def _parse_amount(text: str) -> Optional[float]:
+    """Преобразует введенную сумму (допускается запятая) в число или возвращает None.
+    
+    Проверка идет по символам, без исключений: на мусорном вводе это заметно дешевле.
+    """
+    text = text.strip().replace(',', '.')
+    digits = _unsigned_part(text).replace('.', '', 1)
+    if not (digits.isascii() and digits.isdigit()):
+        return None
+    return float(text)
+
+def _parse_int(text: str) -> Optional[int]:
+    """Преобразует введенное целое число или возвращает None."""
+    text = text.strip()
+    digits = _unsigned_part(text)
+    if not (digits.isascii() and digits.isdigit()):
+        return None
+    return int(text)
+
+@dataclass(slots=True)
+class PendingOp:
+    """Незавершенная операция пользователя."""
+    type: str
+    chat_id: int
+    message_id: int
+    start_time: float
+    completed: bool = False
+    data: Dict = field(default_factory=dict)
+    done_event: asyncio.Event = field(default_factory=asyncio.Event)
+
+def _cancel_evicted_task(message_key: Tuple[int, int], task: Task) -> None:
+    """Отменяет задачу удаления, вытесненную из кеша."""
+    if not task.done():
+        task.cancel()
+
+def _log_expired_operation(user_id: int, operation: 'PendingOp') -> None:
+    """Логирует и отбрасывает устаревшую незавершенную операцию."""
+    logger.info("Операция %s пользователя %s устарела и удалена", operation.type, user_id)
+
+# Словарь для хранения таймеров удаления сообщений
+message_deletion_tasks: TTLCache = TTLCache(
+    STATE_CACHE_MAXSIZE, STATE_CACHE_TTL, on_evict=_cancel_evicted_task
+)  # (chat_id, message_id) -> Task
+# Словарь для хранения цепочек сообщений (родитель -> дети)
+message_chains: TTLCache = TTLCache(
+    STATE_CACHE_MAXSIZE, STATE_CACHE_TTL, default_factory=list
+)  # (chat_id, parent_msg_id) -> [(chat_id, child_msg_id), ...]
+# Словарь для хранения незавершенных цепочек операций пользователей
+user_pending_operations: TTLCache = TTLCache(
+    STATE_CACHE_MAXSIZE, STATE_CACHE_TTL, on_evict=_log_expired_operation
+)  # user_id -> PendingOp
+# ID бота, кешируется один раз при запуске приложения (см. cache_bot_id)
+BOT_ID: Optional[int] = None
+
+async def cache_bot_id(application) -> None:
+    """post_init-хук приложения: запоминает ID бота после инициализации."""
+    global BOT_ID
+    BOT_ID = application.bot.id
+
+# Статус бота в чатах: запрашивается при сбросе и настройке правил, а свежие
+# значения приходят в обновлениях my_chat_member
+BOT_MEMBER_CACHE_TTL = 60
+_bot_members = TTLCache(maxsize=STATE_CACHE_MAXSIZE, ttl=BOT_MEMBER_CACHE_TTL)
+
+async def get_bot_member(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    """Возвращает статус бота в чате (ChatMember) с кэшированием на BOT_MEMBER_CACHE_TTL секунд."""
+    bot_member = _bot_members.get(chat_id)
+    if bot_member is None:
+        bot_member = await context.bot.get_chat_member(chat_id, get_bot_id(context))
+        _bot_members[chat_id] = bot_member
+    return bot_member
+
+def get_bot_id(context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Возвращает закешированный ID бота."""
+    return BOT_ID if BOT_ID is not None else context.bot.id
+
+# Последние сохраненные в БД данные пользователей: user_id -> (username, first_name, last_name)
+_saved_users: TTLCache = TTLCache(maxsize=8192, ttl=600)
+# Последние сохраненные названия групп: group_id -> title
+_saved_groups: TTLCache = TTLCache(maxsize=STATE_CACHE_MAXSIZE, ttl=600)
+# Отложенные обновления уже сохраненных пользователей; пишутся в БД пачкой
+USER_SAVE_FLUSH_INTERVAL = 0.1
+_pending_user_saves: Dict[int, Tuple] = {}
+_user_flush_task: Optional[Task] = None
+
+def _save_user_cached(user) -> None:
+    """Сохраняет пользователя Telegram в БД, только если его данные изменились.
+    
+    Нового пользователя записываем сразу, чтобы последующие запросы его видели;
+    изменения уже известных пользователей копятся и сбрасываются одной пачкой.
+    """
+    global _user_flush_task
+    fields = (user.username, user.first_name, user.last_name)
+    known = _saved_users.get(user.id)
+    if known == fields:
+        return
+    if known is None:
+        if save_user(user.id, *fields):
+            _saved_users[user.id] = fields
+        return
+    _saved_users[user.id] = fields
+    _pending_user_saves[user.id] = fields
+    if _user_flush_task is None:
+        _user_flush_task = _spawn(_flush_user_saves(USER_SAVE_FLUSH_INTERVAL))
+
+def _save_group_cached(chat) -> bool:
+    """Сохраняет группу в БД, только если ее название изменилось."""
+    if _saved_groups.get(chat.id) == chat.title:
+        return True
+    saved = save_group(chat.id, chat.title)
+    if saved:
+        _saved_groups[chat.id] = chat.title
+    return saved
+
+async def _flush_user_saves(delay: float = 0) -> None:
+    """Записывает накопленные обновления пользователей одним запросом."""
+    global _user_flush_task
+    try:
+        await asyncio.sleep(delay)
+    finally:
+        _user_flush_task = None
+        batch = list(_pending_user_saves.items())
+        _pending_user_saves.clear()
+        if batch and not save_users([(user_id, *fields) for user_id, fields in batch]):
+            # Не удалось записать - забываем кэш, чтобы следующий вызов повторил запись
+            for user_id, _ in batch:
+                _saved_users.pop(user_id, None)
+
+# Чаты, администраторы которых недавно сохранены в БД, и уже добавленные в группу
+# бота пары (chat_id, user_id): повторные /send обходятся без getChatAdministrators и записей
+CHAT_ADMINS_REGISTER_TTL = 300
+_registered_chat_admins = TTLCache(maxsize=STATE_CACHE_MAXSIZE, ttl=CHAT_ADMINS_REGISTER_TTL)
+_registered_group_members = TTLCache(maxsize=STATE_CACHE_MAXSIZE, ttl=CHAT_ADMINS_REGISTER_TTL)
+
+async def _register_chat_admins(context: ContextTypes.DEFAULT_TYPE, chat, user_id: int) -> None:
+    """Сохраняет администраторов чата и добавляет их вместе с пользователем в группу бота.
+    
+    Изменившиеся данные пользователей и членство в группе пишутся одной транзакцией.
+    Администраторы чата перечитываются не чаще раза в CHAT_ADMINS_REGISTER_TTL секунд.
+    """
+    if chat.id in _registered_chat_admins:
+        if ((chat.id, user_id) not in _registered_group_members
+                and await asyncio.to_thread(add_user_to_group, chat.id, user_id)):
+            _registered_group_members[(chat.id, user_id)] = True
+        return
+    
+    chat_admins = await context.bot.get_chat_administrators(chat.id)
+    logger.info("Found %d admins in chat %s", len(chat_admins), chat.id)
+    
+    changed = []
+    for admin in chat_admins:
+        admin_user = admin.user
+        fields = (admin_user.username, admin_user.first_name, admin_user.last_name)
+        if _saved_users.get(admin_user.id) != fields:
+            changed.append((admin_user.id, fields))
+    member_ids = [member_id for member_id in dict.fromkeys((user_id, *(admin.user.id for admin in chat_admins)))
+                  if (chat.id, member_id) not in _registered_group_members]
+    # Запись выполняется одним переходом в поток, не блокируя цикл событий
+    if (changed or member_ids) and not await asyncio.to_thread(
+            save_group_members, chat.id, [(admin_id, *fields) for admin_id, fields in changed], member_ids):
+        return
+    
+    for admin_id, fields in changed:
+        _saved_users[admin_id] = fields
+        # Отложенная запись с устаревшими данными больше не нужна
+        _pending_user_saves.pop(admin_id, None)
+    for member_id in member_ids:
+        _registered_group_members[(chat.id, member_id)] = True
+    _registered_chat_admins[chat.id] = True
+
+async def flush_pending_user_saves(application) -> None:
+    """post_shutdown-хук приложения: дописывает отложенные обновления пользователей."""
+    await _flush_user_saves()
+
+# Сильные ссылки на фоновые задачи: цикл событий хранит только слабые
+_background_tasks: Set[Task] = set()
+
+def _log_task_exception(task: Task) -> None:
+    """Логирует исключение фоновой задачи, которое иначе никто не увидит."""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Ошибка в фоновой задаче %s: %s", task.get_name(), task.exception())
+
+def _spawn(coro) -> Task:
+    """Запускает фоновую задачу и удерживает ссылку на неё до завершения."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(_log_task_exception)
+    return task
+
+async def _delete_user_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int) -> None:
+    """Удаляет сообщение пользователя; ошибка (нет прав, уже удалено) только логируется."""
+    try:
+        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+    except Exception as e:
+        logger.info("Не удалось удалить сообщение %s в чате %s: %s", message_id, chat_id, e)
+
+def _schedule_deletion_soon(*args, **kwargs) -> Task:
+    """Планирует удаление сообщения в фоне, не задерживая ответ обработчика."""
+    return _spawn(schedule_message_deletion(*args, **kwargs))
+
+# Общий лимит исходящих запросов (Telegram допускает ~30 сообщений в секунду на бота)
+_SEND_LIMITER = AsyncRateLimiter(29, 1)
+_MAX_RETRY_AFTER_ATTEMPTS = 3
+
+# Лимит новых сообщений в одном групповом чате (Telegram допускает ~20 сообщений в минуту).
+# TTLCache считает срок от последней записи, поэтому _chat_send_limiter перезаписывает
+# лимитер при каждом использовании: запись удаляется только после минуты простоя,
+# когда корзина все равно полна, а чат под нагрузкой не получает новую полную корзину
+CHAT_SEND_LIMIT_PERIOD = 60
+_CHAT_SEND_LIMITERS = TTLCache(maxsize=STATE_CACHE_MAXSIZE, ttl=CHAT_SEND_LIMIT_PERIOD,
+                               default_factory=lambda: AsyncRateLimiter(20, CHAT_SEND_LIMIT_PERIOD))
+
+async def _chat_send_limiter(chat_id: int) -> None:
+    """Ждет разрешения лимита чата, продлевая жизнь его лимитера в кэше."""
+    limiter = _CHAT_SEND_LIMITERS[chat_id]
+    _CHAT_SEND_LIMITERS[chat_id] = limiter
+    await limiter.acquire()
+    # Ожидание в очереди могло занять больше периода: продлеваем еще раз
+    _CHAT_SEND_LIMITERS[chat_id] = limiter
+
+async def _tg_call(chat_id: Optional[int], method, *args, **kwargs):
+    """Вызывает метод Bot API с учетом лимитов и повтором после RetryAfter.
+    
+    chat_id задает лимит новых сообщений чата; для правок передается None,
+    тогда действует только общий лимит бота.
+    """
+    for attempt in range(_MAX_RETRY_AFTER_ATTEMPTS):
+        if chat_id is not None:
+            await _chat_send_limiter(chat_id)
+        async with _SEND_LIMITER:
+            try:
+                return await method(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == _MAX_RETRY_AFTER_ATTEMPTS - 1:
+                    raise
+                retry_after = e.retry_after
+        # Ждем вне лимитера, чтобы не занимать его на время паузы
+        await asyncio.sleep(getattr(retry_after, 'total_seconds', lambda: retry_after)())
+
+async def _safe_edit(query, *args, **kwargs):
+    """Редактирует сообщение callback-запроса с учетом лимита и повтором после RetryAfter."""
+    return await _tg_call(None, query.edit_message_text, *args, **kwargs)
+
+async def _delete_messages_batch(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_ids) -> int:
+    """Удаляет пакет сообщений одним запросом; возвращает размер пакета или 0 при ошибке."""
+    async with _SEND_LIMITER:
+        try:
+            await context.bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+            return len(message_ids)
+        except Exception as e:
+            # Ошибка одного пакета не должна прерывать очистку
+            logger.info("Не удалось удалить пакет сообщений в чате %s: %s", chat_id, e)
+            return 0
+
+async def _edit_and_schedule_deletion(query, context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
+    """Заменяет текст сообщения с кнопками и планирует удаление этого сообщения.
+    
+    Планирование не зависит от результата правки, поэтому оба действия идут параллельно.
+    """
+    await asyncio.gather(
+        _safe_edit(query, text),
+        schedule_message_deletion(
+            context=context,
+            chat_id=query.message.chat_id,
+            message_id=query.message.message_id
+        )
+    )
+
+# Без JobQueue (python-telegram-bot без extra job-queue) удаления ждут в общей куче
+# (срок, chat_id, message_id), которую разбирает одна фоновая задача. Актуальный срок
+# сообщения хранится в _deletion_deadlines: записи кучи с другим сроком устарели.
+_deletion_heap: List[Tuple[float, int, int]] = []
+_deletion_deadlines: Dict[Tuple[int, int], float] = {}
+_deletion_wakeup = asyncio.Event()
+_deletion_worker: Optional[Task] = None
+# Контекст последнего планирования: обработчику кучи из него нужен только bot
+_deletion_context: Optional[ContextTypes.DEFAULT_TYPE] = None
+
+def _push_deletions(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_ids, delay: float) -> None:
+    """Добавляет сообщения чата в кучу удаления с общим сроком и при необходимости будит её обработчик."""
+    global _deletion_worker, _deletion_context
+    deadline = time.monotonic() + delay
+    for message_id in message_ids:
+        _deletion_deadlines[(chat_id, message_id)] = deadline
+        heapq.heappush(_deletion_heap, (deadline, chat_id, message_id))
+    _deletion_context = context
+    if _deletion_worker is None:
+        _deletion_worker = _spawn(_run_deletion_heap())
+    elif _deletion_heap[0][0] == deadline:
+        # Новый ближайший срок - обработчик должен пересчитать ожидание
+        _deletion_wakeup.set()
+
+async def _run_deletion_heap() -> None:
+    """Удаляет сообщения из кучи по наступлении сроков; завершается, когда куча пуста."""
+    global _deletion_worker
+    try:
+        while _deletion_heap:
+            delay = _deletion_heap[0][0] - time.monotonic()
+            if delay > 0:
+                _deletion_wakeup.clear()
+                await _wait_event(_deletion_wakeup, delay)
+                continue
+            
+            now = time.monotonic()
+            due = []
+            while _deletion_heap and _deletion_heap[0][0] <= now:
+                deadline, chat_id, message_id = heapq.heappop(_deletion_heap)
+                message_key = (chat_id, message_id)
+                if _deletion_deadlines.get(message_key) == deadline:
+                    del _deletion_deadlines[message_key]
+                    due.append(message_key)
+            if due:
+                try:
+                    await _delete_messages_with_chains(_deletion_context, due)
+                except Exception as e:
+                    logger.error("Ошибка при удалении %d сообщений по расписанию: %s", len(due), e)
+    finally:
+        _deletion_worker = None
+
+def _schedule_deletion_at(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, delay: float) -> None:
+    """Планирует удаление сообщения через delay секунд в JobQueue или, без неё, в куче."""
+    job_queue = context.job_queue
+    if job_queue is None:
+        _push_deletions(context, chat_id, (message_id,), delay)
+        return
+    job_queue.run_once(
+        _delete_message_job,
+        delay,
+        data={"chat_id": chat_id, "message_id": message_id},
+        name=_deletion_job_name(chat_id, message_id)
+    )
+
+def _deletion_job_name(chat_id: int, message_id: int) -> str:
+    """Имя задачи JobQueue, удаляющей сообщение."""
+    return f"del:{chat_id}:{message_id}"
 
 async def schedule_message_deletion(
     context: ContextTypes.DEFAULT_TYPE,
@@ -50,21 +573,76 @@ async def schedule_message_deletion(
         extend_if_pending: Продлить таймер, если операция не завершена
     """
     message_key = (chat_id, message_id)
+    job_name = _deletion_job_name(chat_id, message_id)
+    # JobQueue доступна только при установке python-telegram-bot[job-queue]
+    job_queue = context.job_queue
     
     # Если для этого сообщения уже запланировано удаление, отменяем старую задачу
-    if message_key in message_deletion_tasks and not message_deletion_tasks[message_key].done():
-        message_deletion_tasks[message_key].cancel()
-    
-    # Создаем и запускаем новую задачу для удаления сообщения
-    task = asyncio.create_task(
-        delayed_message_deletion(
-            context, chat_id, message_id, user_id, operation_type, extend_if_pending
+    # и дожидаемся её завершения, чтобы она не удерживала контекст в памяти
+    old_task = message_deletion_tasks.pop(message_key, None)
+    if old_task and not old_task.done() and old_task is not asyncio.current_task():
+        old_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await old_task
+    if job_queue is not None:
+        for job in job_queue.get_jobs_by_name(job_name):
+            job.schedule_removal()
+    _deletion_deadlines.pop(message_key, None)
+    
+    if not (user_id and operation_type and extend_if_pending):
+        # Простое удаление без напоминаний - достаточно одной записи в планировщике
+        _schedule_deletion_at(context, chat_id, message_id, MESSAGE_DELETE_AFTER)
+    else:
+        # Удаление с отслеживанием операции выполняет отдельная задача
+        task = _spawn(
+            delayed_message_deletion(
+                context, chat_id, message_id, user_id, operation_type, extend_if_pending
+            )
         )
-    )
-    message_deletion_tasks[message_key] = task
+        message_deletion_tasks[message_key] = task
     
     # Записываем информацию о задаче
-    logger.info(f"Запланировано удаление сообщения {message_id} в чате {chat_id} через {MESSAGE_DELETE_AFTER} секунд")
+    logger.info("Запланировано удаление сообщения %s в чате %s через %s секунд", message_id, chat_id, MESSAGE_DELETE_AFTER)
+
+async def schedule_messages_deletion(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_ids: List[int]) -> None:
+    """Планирует удаление нескольких сообщений одного чата одной задачей JobQueue."""
+    job_queue = context.job_queue
+    if job_queue is None:
+        _push_deletions(context, chat_id, message_ids, MESSAGE_DELETE_AFTER)
+    else:
+        job_queue.run_once(
+            _delete_messages_job,
+            MESSAGE_DELETE_AFTER,
+            data={"chat_id": chat_id, "message_ids": list(message_ids)}
+        )
+    logger.info("Запланировано удаление %d сообщений в чате %s через %s секунд",
+                len(message_ids), chat_id, MESSAGE_DELETE_AFTER)
+
+async def _delete_messages_with_chains(context: ContextTypes.DEFAULT_TYPE,
+                                       message_keys: List[Tuple[int, int]]) -> None:
+    """Удаляет сообщения вместе с их цепочками пакетами deleteMessages по чатам."""
+    targets: Dict[int, List[int]] = {}
+    for message_key in message_keys:
+        for target_chat_id, target_message_id in message_chains.pop(message_key, None) or ():
+            targets.setdefault(target_chat_id, []).append(target_message_id)
+        targets.setdefault(message_key[0], []).append(message_key[1])
+    
+    await asyncio.gather(*(
+        _delete_messages_batch(context, target_chat_id, chunk)
+        for target_chat_id, message_ids in targets.items()
+        for chunk in batched(message_ids, DELETE_MESSAGES_BATCH)
+    ))
+
+async def _delete_messages_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Задача JobQueue: удаляет сообщения schedule_messages_deletion вместе с их цепочками."""
+    data = context.job.data
+    chat_id = data["chat_id"]
+    await _delete_messages_with_chains(context, [(chat_id, message_id) for message_id in data["message_ids"]])
+
+async def _delete_message_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Задача JobQueue: удаляет сообщение, запланированное schedule_message_deletion."""
+    data = context.job.data
+    await _delete_messages_with_chains(context, [(data["chat_id"], data["message_id"])])
 
 async def delayed_message_deletion(
     context: ContextTypes.DEFAULT_TYPE,
@@ -88,49 +666,41 @@ async def delayed_message_deletion(
     message_key = (chat_id, message_id)
     
     try:
-        # Отправляем напоминание, если операция не завершена
+        # Снимок состояния операции берем один раз: дальше ориентируемся только
+        # на её событие завершения
+        done_event = None
         if user_id and operation_type and extend_if_pending:
-            # Сначала ждем время до напоминания
-            await asyncio.sleep(MESSAGE_REMINDER_AFTER)
+            op = user_pending_operations.get(user_id)
+            if op is not None and op.type == operation_type and not op.completed:
+                done_event = op.done_event
+        
+        if done_event is not None:
+            deadline = time.monotonic() + MESSAGE_DELETE_AFTER
             
-            # Проверяем, не завершена ли операция
-            operation_pending = False
-            if user_id in user_pending_operations:
-                user_ops = user_pending_operations[user_id]
-                if user_ops.get("type") == operation_type and not user_ops.get("completed", False):
-                    operation_pending = True
+            # Ждем либо завершения операции, либо времени напоминания
+            if not await _wait_event(done_event, MESSAGE_REMINDER_AFTER):
+                # Операция не завершена - отправляем напоминание
+                try:
+                    reminder_text = f"⚠️ Напоминание: у вас есть незавершенная операция. Сообщение будет удалено через 1 минуту, если вы не завершите её."
+                    reminder_message = await context.bot.send_message(
+                        chat_id=chat_id,
+                        text=reminder_text,
+                        reply_to_message_id=message_id
+                    )
                     
-                    # Отправляем напоминание
-                    try:
-                        reminder_text = f"⚠️ Напоминание: у вас есть незавершенная операция. Сообщение будет удалено через 1 минуту, если вы не завершите её."
-                        reminder_message = await context.bot.send_message(
-                            chat_id=chat_id,
-                            text=reminder_text,
-                            reply_to_message_id=message_id
-                        )
-                        
-                        # Планируем удаление напоминания
-                        reminder_key = (chat_id, reminder_message.message_id)
-                        reminder_task = asyncio.create_task(
-                            delayed_message_deletion(context, chat_id, reminder_message.message_id)
-                        )
-                        message_deletion_tasks[reminder_key] = reminder_task
-                        
-                        # Добавляем напоминание в цепочку сообщений
-                        if message_key in message_chains:
-                            message_chains[message_key].append((chat_id, reminder_message.message_id))
-                        else:
-                            message_chains[message_key] = [(chat_id, reminder_message.message_id)]
-                    except Exception as e:
-                        logger.error(f"Ошибка при отправке напоминания: {e}")
-            
-            # Ждем оставшееся время
-            await asyncio.sleep(MESSAGE_DELETE_AFTER - MESSAGE_REMINDER_AFTER)
-            
-            # Проверяем еще раз, не завершена ли операция
-            if operation_pending and user_id in user_pending_operations:
-                user_ops = user_pending_operations[user_id]
-                if user_ops.get("type") == operation_type and not user_ops.get("completed", False):
+                    # Планируем удаление напоминания
+                    await schedule_message_deletion(context, chat_id, reminder_message.message_id)
+                    
+                    # Добавляем напоминание в цепочку сообщений
+                    message_chains[message_key].append((chat_id, reminder_message.message_id))
+                except Exception as e:
+                    logger.error("Ошибка при отправке напоминания: %s", e)
+                
+                # Ждем оставшееся время или завершения операции; прерываем операцию,
+                # только если её еще не прервала другая задача той же цепочки
+                completed = await _wait_event(done_event, MESSAGE_DELETE_AFTER - MESSAGE_REMINDER_AFTER)
+                current_op = user_pending_operations.get(user_id)
+                if not completed and current_op is not None and current_op.done_event is done_event:
                     # Операция всё еще не завершена - прерываем её и удаляем сообщения
                     try:
                         # Отправляем сообщение о прерывании операции
@@ -141,52 +711,40 @@ async def delayed_message_deletion(
                         )
                         
                         # Планируем удаление этого сообщения
-                        abort_key = (chat_id, abort_message.message_id)
-                        abort_task = asyncio.create_task(
-                            delayed_message_deletion(context, chat_id, abort_message.message_id)
-                        )
-                        message_deletion_tasks[abort_key] = abort_task
+                        await schedule_message_deletion(context, chat_id, abort_message.message_id)
                         
                         # Очищаем данные незавершенной операции
                         user_pending_operations.pop(user_id, None)
                     except Exception as e:
-                        logger.error(f"Ошибка при отправке сообщения о прерывании операции: {e}")
-        else:
-            # Просто ждем стандартное время до удаления
-            await asyncio.sleep(MESSAGE_DELETE_AFTER)
-        
-        # Удаляем все сообщения в цепочке
-        if message_key in message_chains:
-            for child_chat_id, child_message_id in message_chains[message_key]:
-                try:
-                    await context.bot.delete_message(
-                        chat_id=child_chat_id,
-                        message_id=child_message_id
-                    )
-                    logger.info(f"Удалено дочернее сообщение {child_message_id} в чате {child_chat_id}")
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении дочернего сообщения {child_message_id} в чате {child_chat_id}: {e}")
+                        logger.error("Ошибка при отправке сообщения о прерывании операции: %s", e)
             
-            # Удаляем запись о цепочке
-            message_chains.pop(message_key, None)
+            # Операция могла завершиться досрочно. Оставшееся ожидание передаем
+            # планировщику, чтобы задача не висела до момента удаления
+            remaining = max(0.0, deadline - time.monotonic())
+        else:
+            remaining = MESSAGE_DELETE_AFTER
         
-        # Удаляем само сообщение
-        await context.bot.delete_message(
-            chat_id=chat_id,
-            message_id=message_id
-        )
-        logger.info(f"Удалено сообщение {message_id} в чате {chat_id}")
+        _schedule_deletion_at(context, chat_id, message_id, remaining)
         
     except asyncio.CancelledError:
         # Задача была отменена, ничего не делаем
-        logger.info(f"Удаление сообщения {message_id} в чате {chat_id} отменено")
+        logger.info("Удаление сообщения %s в чате %s отменено", message_id, chat_id)
         
     except Exception as e:
-        logger.error(f"Ошибка при удалении сообщения {message_id} в чате {chat_id}: {e}")
+        logger.error("Ошибка при удалении сообщения %s в чате %s: %s", message_id, chat_id, e)
     
     finally:
-        # Удаляем задачу из словаря
-        message_deletion_tasks.pop(message_key, None)
+        # Удаляем задачу из словаря, если её еще не заменила новая
+        if message_deletion_tasks.get(message_key) is asyncio.current_task():
+            message_deletion_tasks.pop(message_key, None)
+
+async def _wait_event(event: asyncio.Event, timeout: float) -> bool:
+    """Ждет событие не дольше timeout секунд. Возвращает True, если событие наступило."""
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
 
 async def add_message_to_chain(parent_key: Tuple[int, int], child_key: Tuple[int, int]) -> None:
     """
@@ -196,20 +754,18 @@ async def add_message_to_chain(parent_key: Tuple[int, int], child_key: Tuple[int
         parent_key: Кортеж (chat_id, parent_message_id)
         child_key: Кортеж (chat_id, child_message_id)
     """
-    if parent_key in message_chains:
-        message_chains[parent_key].append(child_key)
-    else:
-        message_chains[parent_key] = [child_key]
+    message_chains[parent_key].append(child_key)
     
-    logger.debug(f"Добавлено сообщение {child_key[1]} в цепочку к сообщению {parent_key[1]}")
+    logger.debug("Добавлено сообщение %s в цепочку к сообщению %s", child_key[1], parent_key[1])
 
 async def register_pending_operation(
     user_id: int,
     operation_type: str,
     chat_id: int,
     message_id: int,
-    data: Dict = None
-) -> None:
+    data: Dict = None,
+    reject_duplicate: bool = False
+) -> bool:
     """
     Регистрирует незавершенную операцию пользователя.
     
@@ -219,17 +775,47 @@ async def register_pending_operation(
         chat_id: ID чата
         message_id: ID сообщения
         data: Дополнительные данные операции
+        reject_duplicate: Не регистрировать операцию, если такая же начата
+            менее DUPLICATE_OPERATION_WINDOW секунд назад (повторное нажатие)
+    
+    Returns:
+        False, если операция отклонена как повторная, иначе True
     """
-    user_pending_operations[user_id] = {
-        "type": operation_type,
-        "chat_id": chat_id,
-        "message_id": message_id,
-        "start_time": datetime.now(),
-        "completed": False,
-        "data": data or {}
-    }
+    # Продолжение операции того же типа сохраняет её событие завершения,
+    # а операция другого типа считается завершенной и будит ожидающие задачи
+    previous = user_pending_operations.get(user_id)
+    done_event = None
+    if previous and not previous.completed:
+        if previous.type == operation_type:
+            if reject_duplicate and time.monotonic() - previous.start_time < DUPLICATE_OPERATION_WINDOW:
+                logger.info("Повторная операция %s пользователя %s отклонена", operation_type, user_id)
+                return False
+            done_event = previous.done_event
+        else:
+            previous.done_event.set()
+    
+    user_pending_operations[user_id] = PendingOp(
+        type=operation_type,
+        chat_id=chat_id,
+        message_id=message_id,
+        start_time=time.monotonic(),
+        done_event=done_event or asyncio.Event(),
+        data=data or {}
+    )
+    
+    logger.info("Зарегистрирована операция %s для пользователя %s", operation_type, user_id)
+    return True
+
+def _expense_operation_active(update: Update) -> bool:
+    """Проверяет, что добавление расхода пользователем в этом чате не завершено и не прервано.
     
-    logger.info(f"Зарегистрирована операция {operation_type} для пользователя {user_id}")
+    Операцию прерывает schedule_message_deletion после MESSAGE_DELETE_AFTER секунд
+    без ответа (или ее вытесняет другая операция пользователя); после этого текст
+    пользователя больше не считается ответом диалогу расхода.
+    """
+    op = user_pending_operations.get(update.effective_user.id)
+    return (op is not None and op.type == "expense_add" and not op.completed
+            and op.chat_id == update.effective_chat.id)
 
 async def complete_pending_operation(user_id: int) -> None:
     """
@@ -238,298 +824,314 @@ async def complete_pending_operation(user_id: int) -> None:
     Args:
         user_id: ID пользователя
     """
-    if user_id in user_pending_operations:
-        user_pending_operations[user_id]["completed"] = True
-        logger.info(f"Операция для пользователя {user_id} отмечена как завершенная")
+    op = user_pending_operations.get(user_id)
+    if op is not None:
+        op.completed = True
+        op.done_event.set()
+        logger.info("Операция для пользователя %s отмечена как завершенная", user_id)
 
 # Conversation states
+class ConvState(IntEnum):
+    RULES_DESCRIPTION = 0
+    RULES_DEADLINE = 1
+    RULES_NOTIFICATIONS = 2
+    EXPENSE_AMOUNT = 3
+    EXPENSE_DESCRIPTION = 4
+    EXPENSE_PARTICIPANTS = 5
+    EXPENSE_PHOTO = 6
+    SEND_AMOUNT = 7
+    SEND_CONFIRM = 8
+    USER_INTRO_NAME = 9
+    USER_INTRO_LASTNAME = 10
+    EDIT_EXPENSE_AMOUNT = 11
+    EDIT_EXPENSE_CONFIRM = 12
+
+# Имена состояний на уровне модуля для существующих обработчиков
 (RULES_DESCRIPTION, RULES_DEADLINE, RULES_NOTIFICATIONS,
  EXPENSE_AMOUNT, EXPENSE_DESCRIPTION, EXPENSE_PARTICIPANTS, EXPENSE_PHOTO,
  SEND_AMOUNT, SEND_CONFIRM, USER_INTRO_NAME, USER_INTRO_LASTNAME,
- EDIT_EXPENSE_AMOUNT, EDIT_EXPENSE_CONFIRM) = range(13)
+ EDIT_EXPENSE_AMOUNT, EDIT_EXPENSE_CONFIRM) = ConvState
 
-# Обработчик для обработки ожидающих состояний после нажатия инлайн кнопок
-async def handle_pending_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработка текстовых сообщений в контексте ожидающих состояний."""
-    user = update.effective_user
-    chat = update.effective_chat
-    message_text = update.message.text
+# Биты ожидающих текстового ввода состояний в context.user_data['pending_state_mask']
+# (ввод расхода из меню помощи идет через состояния expense_conversation_handler)
+PS_SEND_USERNAME = 1 << 0
+PS_SEND_AMOUNT = 1 << 1
+PS_RULES_DESCRIPTION = 1 << 2
+PS_RULES_DEADLINE = 1 << 3
+PS_RULES_NOTIFICATIONS = 1 << 4
+PS_EDIT_EXPENSE_AMOUNT = 1 << 5
+
+# Ключи user_data с черновиками расхода и перевода, очищаемые по завершении операции
+_EXPENSE_DRAFT_KEYS = ('expense_amount', 'expense_description', 'expense_file_id',
+                       'all_participants', 'selected_mask', 'participant_users')
+_SEND_DRAFT_KEYS = ('send_username', 'send_amount', 'send_receiver_id', 'send_receiver_name')
+_EDIT_EXPENSE_KEYS = ('edit_expense_id', 'edit_expense_old_amount', 'edit_expense_description')
+# Отметка "представление не ожидается" для _pending_intros (None там - ожидание имени)
+_NO_INTRO = object()
+
+def _clear_user_data(user_data: Dict, keys) -> None:
+    """Удаляет из user_data перечисленные ключи (отсутствующие пропускаются)."""
+    for key in keys:
+        user_data.pop(key, None)
+
+def _set_waiting(user_data: Dict, state_bit: int, waiting: bool) -> None:
+    """Устанавливает или сбрасывает бит ожидающего состояния пользователя."""
+    mask = user_data.get('pending_state_mask', 0)
+    user_data['pending_state_mask'] = (mask | state_bit) if waiting else (mask & ~state_bit)
+
+def _display_name(first_name: Optional[str], last_name: Optional[str], username: Optional[str]) -> str:
+    """Имя участника расхода: имя и фамилия, если их нет - никнейм."""
+    return f"{first_name or ''} {last_name or ''}".strip() or username or 'Без имени'
+
+def _recipient_label(user_id: int, first_name: Optional[str], last_name: Optional[str],
+                     username: Optional[str]) -> str:
+    """Имя получателя перевода: имя и фамилия, иначе @юзернейм, иначе ID."""
+    if first_name and last_name:
+        return f"{first_name} {last_name}"
+    if username:
+        return f"@{username}"
+    return f"ID: {user_id}"
+
+def _recipient_name(member: Dict) -> str:
+    """Имя получателя перевода по пользователю из БД."""
+    return _recipient_label(member['user_id'], member['first_name'], member['last_name'], member['username'])
+
+def _recipient_button(member) -> InlineKeyboardButton:
+    """Создает кнопку выбора получателя перевода (member - запись с полями MEMBER_FIELDS)."""
+    user_id, first_name, last_name, username = member
+    return InlineKeyboardButton(_recipient_label(user_id, first_name, last_name, username),
+                                callback_data=f"send_to_{user_id}")
+
+def _recipient_keyboard(recipients) -> InlineKeyboardMarkup:
+    """Клавиатура выбора получателя перевода: кнопка на каждого получателя и кнопка отмены."""
+    return InlineKeyboardMarkup([*([_recipient_button(member)] for member in recipients), _SEND_CANCEL_ROW])
+
+def _participant_button(member) -> InlineKeyboardButton:
+    """Создает кнопку выбора участника расхода (member - запись с полями MEMBER_FIELDS)."""
+    user_id, first_name, last_name, username = member
+    return InlineKeyboardButton(_display_name(first_name, last_name, username),
+                                callback_data=f"participant_{user_id}")
+
+# Выбор участников расхода хранится компактно: ID в array('q') и битовая маска выбранных
+def _init_participant_selection(user_data: Dict, member_ids, select_all: bool) -> None:
+    """Сохраняет список участников и сбрасывает (или заполняет) маску выбора."""
+    ids = array.array('q', member_ids)
+    user_data['all_participants'] = ids
+    mask = bytearray(b'\xff' if select_all else b'\x00') * ((len(ids) + 7) // 8)
+    user_data['selected_mask'] = mask
+
+def _is_participant_selected(mask: bytearray, index: int) -> bool:
+    return bool(mask[index >> 3] & (1 << (index & 7)))
+
+def _toggle_participant(user_data: Dict, user_id: int) -> None:
+    """Переключает выбор участника по его ID."""
+    ids = user_data.get('all_participants')
+    if ids is None or user_id not in ids:
+        return
+    index = ids.index(user_id)
+    user_data['selected_mask'][index >> 3] ^= 1 << (index & 7)
+
+def _participant_users(user_data: Dict) -> Dict[int, Dict]:
+    """Возвращает данные участников расхода, загружая их из БД одним запросом на весь выбор."""
+    users = user_data.get('participant_users')
+    if users is None:
+        users = user_data['participant_users'] = get_users(user_data.get('all_participants', ()))
+    return users
+
+def _selected_participants(user_data: Dict) -> Optional[List[int]]:
+    """Возвращает ID выбранных участников или None, если выбор не производился."""
+    mask = user_data.get('selected_mask')
+    if mask is None:
+        return None
+    return [user_id for i, user_id in enumerate(user_data['all_participants'])
+            if _is_participant_selected(mask, i)]
+
+# Обработчики ожидающих состояний после нажатия инлайн кнопок
+async def _pending_send_username(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработка ожидания имени пользователя для отправки денег."""
+    # Извлекаем имя пользователя без @
+    username = update.message.text.strip().removeprefix('@')
     
-    # Сохраняем информацию о пользователе
-    save_user(user.id, user.username, user.first_name, user.last_name)
+    context.user_data['send_username'] = username
+    _set_waiting(context.user_data, PS_SEND_USERNAME, False)
+    _set_waiting(context.user_data, PS_SEND_AMOUNT, True)
     
-    # Обработка ожидания суммы расхода (после нажатия на кнопку "Добавить расход")
-    if context.user_data.get('waiting_for_expense_amount'):
-        try:
-            amount = float(message_text.replace(',', '.'))
-            if amount <= 0:
-                await update.message.reply_text(
-                    "Сумма должна быть положительным числом. Попробуйте снова:"
-                )
-                return
-            
-            # Сохраняем сумму и спрашиваем описание
-            context.user_data['expense_amount'] = amount
-            context.user_data['waiting_for_expense_amount'] = False
-            context.user_data['waiting_for_expense_description'] = True
-            
-            await update.message.reply_text(
-                "Теперь введите описание расхода:"
-            )
-        except ValueError:
-            await update.message.reply_text(
-                "Неверный формат суммы. Введите число:"
-            )
+    await update.message.reply_text(
+        f"Сколько вы хотите отправить пользователю @{username}? Введите сумму:"
+    )
+
+async def _pending_send_amount(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработка ожидания суммы для отправки денег."""
+    amount = _parse_amount(update.message.text)
+    if amount is None:
+        await update.message.reply_text(
+            "Неверный формат суммы. Введите число:"
+        )
         return
-    
-    # Обработка ожидания описания расхода
-    elif context.user_data.get('waiting_for_expense_description'):
-        # Сохраняем описание
-        context.user_data['expense_description'] = message_text
-        context.user_data['waiting_for_expense_description'] = False
-        
-        # Получаем информацию о группе и её участниках
-        if chat.type in ['group', 'supergroup']:
-            # Получаем всех участников группы кроме ботов
-            members = get_group_members(chat.id, exclude_bots=True)
-            
-            # Если есть участники, предлагаем выбрать среди них
-            if members and len(members) > 0:
-                # Создаем кнопки для каждого участника
-                keyboard = []
-                row = []
-                
-                # Фильтруем, исключая ID бота
-                bot_user_id = context.bot.id
-                filtered_members = [m for m in members if m['user_id'] != bot_user_id]
-                
-                for i, member in enumerate(filtered_members):
-                    # Используем имя и фамилию для отображения
-                    first_name = member.get('first_name', '')
-                    last_name = member.get('last_name', '')
-                    full_name = f"{first_name} {last_name}".strip()
-                    
-                    # Если нет имени, используем никнейм
-                    display_name = full_name if full_name else member.get('username', 'Без имени')
-                    
-                    # Создаем кнопку для участника
-                    user_id = member['user_id']
-                    callback_data = f"participant_{user_id}"
-                    button = InlineKeyboardButton(display_name, callback_data=callback_data)
-                    
-                    # Добавляем максимум 2 кнопки в строку
-                    row.append(button)
-                    if len(row) == 2 or i == len(filtered_members) - 1:
-                        keyboard.append(row)
-                        row = []
-                
-                # Добавляем кнопки "Выбрать всех" и "Готово"
-                keyboard.append([
-                    InlineKeyboardButton("Выбрать всех", callback_data="participants_all"),
-                    InlineKeyboardButton("Готово", callback_data="participants_done")
-                ])
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                # Сохраняем список участников и инициализируем выбранных (без бота)
-                context.user_data['all_participants'] = [m['user_id'] for m in filtered_members]
-                context.user_data['selected_participants'] = []
-                
-                await update.message.reply_text(
-                    "Выберите участников для разделения расхода:",
-                    reply_markup=reply_markup
-                )
-                return
-        
-        # Если не группа или нет участников, спрашиваем о фото
-        keyboard = [
-            [
-                InlineKeyboardButton("Да", callback_data="expense_photo_yes"),
-                InlineKeyboardButton("Нет", callback_data="expense_photo_no"),
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
+    if amount <= 0:
         await update.message.reply_text(
-            "Хотите прикрепить фото чека?",
-            reply_markup=reply_markup
+            "Сумма должна быть положительным числом. Попробуйте снова:"
         )
         return
     
-    # Обработка ожидания имени пользователя для отправки денег
-    elif context.user_data.get('waiting_for_send_username'):
-        username = message_text.strip()
-        
-        # Извлекаем имя пользователя без @
-        if username.startswith('@'):
-            username = username[1:]
-        
-        context.user_data['send_username'] = username
-        context.user_data['waiting_for_send_username'] = False
-        context.user_data['waiting_for_send_amount'] = True
-        
+    context.user_data['send_amount'] = amount
+    _set_waiting(context.user_data, PS_SEND_AMOUNT, False)
+    
+    # Запрашиваем подтверждение
+    reply_markup = _SEND_CONFIRM_KB
+    
+    # Проверяем, откуда пришел выбор пользователя - из меню или ручного ввода
+    if context.user_data.get('send_receiver_id') and context.user_data.get('send_receiver_name'):
+        # Если выбран из меню, используем ID и имя получателя
+        receiver_id = context.user_data['send_receiver_id']
+        receiver_name = context.user_data['send_receiver_name']
         await update.message.reply_text(
-            f"Сколько вы хотите отправить пользователю @{username}? Введите сумму:"
+            f"Вы собираетесь отправить {amount} руб. пользователю {receiver_name}. "
+            f"Подтвердите операцию:",
+            reply_markup=reply_markup
         )
-        return
+    elif context.user_data.get('send_username'):
+        # Если был введен username
+        username = context.user_data['send_username']
+        await update.message.reply_text(
+            f"Вы собираетесь отправить {amount} руб. пользователю @{username}. "
+            f"Подтвердите операцию:",
+            reply_markup=reply_markup
+        )
+    else:
+        # Если каким-то образом нет данных о получателе
+        await update.message.reply_text(
+            "Ошибка: не указан получатель платежа. Повторите операцию с помощью команды /send."
+        )
+
+async def _pending_rules_description(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработка ожидания описания правил."""
+    context.user_data['rules_description'] = update.message.text
+    _set_waiting(context.user_data, PS_RULES_DESCRIPTION, False)
+    _set_waiting(context.user_data, PS_RULES_DEADLINE, True)
     
-    # Обработка ожидания суммы для отправки денег
-    elif context.user_data.get('waiting_for_send_amount'):
-        try:
-            amount = float(message_text.replace(',', '.'))
-            if amount <= 0:
-                await update.message.reply_text(
-                    "Сумма должна быть положительным числом. Попробуйте снова:"
-                )
-                return
-            
-            context.user_data['send_amount'] = amount
-            context.user_data['waiting_for_send_amount'] = False
-            
-            # Запрашиваем подтверждение
-            keyboard = [
-                [
-                    InlineKeyboardButton("Подтвердить", callback_data="send_confirm"),
-                    InlineKeyboardButton("Отменить", callback_data="send_cancel"),
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            # Проверяем, откуда пришел выбор пользователя - из меню или ручного ввода
-            if context.user_data.get('send_receiver_id') and context.user_data.get('send_receiver_name'):
-                # Если выбран из меню, используем ID и имя получателя
-                receiver_id = context.user_data['send_receiver_id']
-                receiver_name = context.user_data['send_receiver_name']
-                await update.message.reply_text(
-                    f"Вы собираетесь отправить {amount} руб. пользователю {receiver_name}. "
-                    f"Подтвердите операцию:",
-                    reply_markup=reply_markup
-                )
-            elif context.user_data.get('send_username'):
-                # Если был введен username
-                username = context.user_data['send_username']
-                await update.message.reply_text(
-                    f"Вы собираетесь отправить {amount} руб. пользователю @{username}. "
-                    f"Подтвердите операцию:",
-                    reply_markup=reply_markup
-                )
-            else:
-                # Если каким-то образом нет данных о получателе
-                await update.message.reply_text(
-                    "Ошибка: не указан получатель платежа. Повторите операцию с помощью команды /send."
-                )
-        except ValueError:
-            await update.message.reply_text(
-                "Неверный формат суммы. Введите число:"
-            )
+    await update.message.reply_text(
+        "Теперь укажите срок погашения долгов в часах (например, 24):"
+    )
+
+async def _pending_rules_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработка ожидания срока погашения долгов."""
+    deadline = _parse_int(update.message.text)
+    if deadline is None:
+        await update.message.reply_text(
+            "Неверный формат. Введите число часов:"
+        )
         return
-    
-    # Обработка ожидания описания правил
-    elif context.user_data.get('waiting_for_rules_description'):
-        context.user_data['rules_description'] = message_text
-        context.user_data['waiting_for_rules_description'] = False
-        context.user_data['waiting_for_rules_deadline'] = True
-        
+    if deadline <= 0:
         await update.message.reply_text(
-            "Теперь укажите срок погашения долгов в часах (например, 24):"
+            "Срок должен быть положительным числом. Попробуйте снова:"
         )
         return
     
-    # Обработка ожидания срока погашения долгов
-    elif context.user_data.get('waiting_for_rules_deadline'):
-        try:
-            deadline = int(message_text)
-            if deadline <= 0:
-                await update.message.reply_text(
-                    "Срок должен быть положительным числом. Попробуйте снова:"
-                )
-                return
-            
-            context.user_data['rules_deadline'] = deadline
-            context.user_data['waiting_for_rules_deadline'] = False
-            context.user_data['waiting_for_rules_notifications'] = True
-            
-            await update.message.reply_text(
-                "Укажите время для ежедневных уведомлений о долгах в формате ЧЧ:ММ (например, 20:00):"
-            )
-        except ValueError:
-            await update.message.reply_text(
-                "Неверный формат. Введите число часов:"
-            )
+    context.user_data['rules_deadline'] = deadline
+    _set_waiting(context.user_data, PS_RULES_DEADLINE, False)
+    _set_waiting(context.user_data, PS_RULES_NOTIFICATIONS, True)
+    
+    await update.message.reply_text(
+        "Укажите время для ежедневных уведомлений о долгах в формате ЧЧ:ММ (например, 20:00):"
+    )
+
+async def _pending_rules_notifications(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработка ожидания времени уведомлений."""
+    message_text = update.message.text
+    
+    if not _valid_hhmm(message_text):
+        await update.message.reply_text(
+            "Неверный формат времени. Введите время в формате ЧЧ:ММ (например, 20:00):"
+        )
         return
     
-    # Обработка ожидания времени уведомлений
-    elif context.user_data.get('waiting_for_rules_notifications'):
-        time_pattern = re.compile(r'^([01]?[0-9]|2[0-3]):([0-5][0-9])$')
-        
-        if not time_pattern.match(message_text):
-            await update.message.reply_text(
-                "Неверный формат времени. Введите время в формате ЧЧ:ММ (например, 20:00):"
-            )
-            return
-        
-        # Сохраняем время уведомлений и настраиваем правила
-        context.user_data['rules_notifications'] = message_text
-        context.user_data['waiting_for_rules_notifications'] = False
-        
-        # Сохраняем правила в базе данных
-        set_group_rules(
-            chat.id,
-            context.user_data['rules_description'],
-            context.user_data['rules_deadline'],
-            context.user_data['rules_notifications']
+    # Сохраняем время уведомлений и настраиваем правила
+    context.user_data['rules_notifications'] = message_text
+    _set_waiting(context.user_data, PS_RULES_NOTIFICATIONS, False)
+    
+    # Сохраняем правила в базе данных
+    set_group_rules(
+        update.effective_chat.id,
+        context.user_data['rules_description'],
+        context.user_data['rules_deadline'],
+        context.user_data['rules_notifications']
+    )
+    
+    await update.message.reply_text(
+        "Правила группы успешно настроены! 👍"
+    )
+
+async def _pending_edit_expense_amount(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработка ожидания новой суммы расхода для редактирования."""
+    new_amount = _parse_amount(update.message.text)
+    if new_amount is None:
+        await update.message.reply_text(
+            "Неверный формат суммы. Введите число:"
         )
-        
+        return
+    if new_amount <= 0:
         await update.message.reply_text(
-            "Правила группы успешно настроены! 👍"
+            "Сумма должна быть положительным числом. Попробуйте снова:"
         )
+        return
     
-    # Обработка ожидания новой суммы расхода для редактирования
-    elif context.user_data.get('waiting_for_edit_expense_amount'):
-        try:
-            new_amount = float(message_text.replace(',', '.'))
-            if new_amount <= 0:
-                await update.message.reply_text(
-                    "Сумма должна быть положительным числом. Попробуйте снова:"
-                )
-                return
-            
-            # Получаем ID расхода и старую сумму из контекста
-            expense_id = context.user_data.get('edit_expense_id')
-            old_amount = context.user_data.get('edit_expense_old_amount')
-            description = context.user_data.get('edit_expense_description')
-            
-            if not expense_id:
-                await update.message.reply_text(
-                    "Ошибка: не удалось найти ID расхода. Пожалуйста, начните редактирование заново."
-                )
-                return
-            
-            # Обновляем сумму расхода
-            success, message = update_expense_amount(expense_id, new_amount)
-            
-            # Очищаем данные редактирования
-            context.user_data.pop('waiting_for_edit_expense_amount', None)
-            context.user_data.pop('edit_expense_id', None)
-            context.user_data.pop('edit_expense_old_amount', None)
-            context.user_data.pop('edit_expense_description', None)
-            
-            if success:
-                # Формируем сообщение об успешном обновлении
-                update_message = (
-                    f"✅ Сумма расхода успешно обновлена:\n\n"
-                    f"Расход: {description}\n"
-                    f"Старая сумма: {old_amount} руб.\n"
-                    f"Новая сумма: {new_amount} руб."
-                )
-                await update.message.reply_text(update_message)
-            else:
-                await update.message.reply_text(f"❌ Ошибка: {message}")
-            
-        except ValueError:
-            await update.message.reply_text(
-                "Неверный формат суммы. Введите число:"
-            )
+    # Получаем ID расхода и старую сумму из контекста
+    expense_id = context.user_data.get('edit_expense_id')
+    old_amount = context.user_data.get('edit_expense_old_amount')
+    description = context.user_data.get('edit_expense_description')
+    
+    if not expense_id:
+        await update.message.reply_text(
+            "Ошибка: не удалось найти ID расхода. Пожалуйста, начните редактирование заново."
+        )
+        return
+    
+    # Обновляем сумму расхода
+    success, message = update_expense_amount(expense_id, new_amount)
+    
+    # Очищаем данные редактирования
+    _set_waiting(context.user_data, PS_EDIT_EXPENSE_AMOUNT, False)
+    _clear_user_data(context.user_data, _EDIT_EXPENSE_KEYS)
+    
+    if success:
+        # Формируем сообщение об успешном обновлении
+        update_message = (
+            f"✅ Сумма расхода успешно обновлена:\n\n"
+            f"Расход: {description}\n"
+            f"Старая сумма: {old_amount} руб.\n"
+            f"Новая сумма: {new_amount} руб."
+        )
+        await update.message.reply_text(update_message)
+    else:
+        await update.message.reply_text(f"❌ Ошибка: {message}")
+
+# Бит ожидающего состояния -> обработчик; порядок определяет приоритет
+_PENDING_STATE_HANDLERS = (
+    (PS_SEND_USERNAME, _pending_send_username),
+    (PS_SEND_AMOUNT, _pending_send_amount),
+    (PS_RULES_DESCRIPTION, _pending_rules_description),
+    (PS_RULES_DEADLINE, _pending_rules_deadline),
+    (PS_RULES_NOTIFICATIONS, _pending_rules_notifications),
+    (PS_EDIT_EXPENSE_AMOUNT, _pending_edit_expense_amount),
+)
+
+async def handle_pending_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработка текстовых сообщений в контексте ожидающих состояний."""
+    # Большинство сообщений в группе не относятся ни к одной операции. Представление
+    # нового участника имеет наименьший приоритет: ожидающие состояния и диалоги важнее
+    mask = context.user_data.get('pending_state_mask', 0)
+    if not mask:
+        await user_intro_step(update, context)
+        return
+    
+    # Сохраняем информацию о пользователе
+    user = update.effective_user
+    _save_user_cached(user)
+    
+    for state_bit, handler in _PENDING_STATE_HANDLERS:
+        if mask & state_bit:
+            await handler(update, context)
             return
 
 async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -538,21 +1140,31 @@ async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TY
     chat = chat_member_updated.chat
     
     # Проверяем, что это групповой чат
-    if chat.type not in ['group', 'supergroup']:
+    if chat.type not in _GROUP_TYPES:
         return
     
     # Получаем предыдущий и новый статус бота
-    old_status = chat_member_updated.old_chat_member.status
-    new_status = chat_member_updated.new_chat_member.status
+    old_member = chat_member_updated.old_chat_member
+    new_member = chat_member_updated.new_chat_member
+    # Обновление содержит актуальные права бота - сразу заменяем ими кэш
+    _bot_members[chat.id] = new_member
+    # Состав администраторов мог измениться вместе со статусом бота
+    _registered_chat_admins.pop(chat.id, None)
+    old_status = old_member.status
+    new_status = new_member.status
+    
+    # Статус и право закрепления не изменились - обновление нас не касается
+    if (old_status == new_status and
+            getattr(old_member, 'can_pin_messages', None) == getattr(new_member, 'can_pin_messages', None)):
+        return
     
     # Логируем изменение статуса
     logger.info(f"Статус бота в группе {chat.id} ({chat.title}) изменен с {old_status} на {new_status}")
     
     # Проверяем, получил ли бот права администратора
-    bot_member = chat_member_updated.new_chat_member
     if (new_status in ['administrator'] and 
-        (old_status != 'administrator' or not getattr(chat_member_updated.old_chat_member, 'can_pin_messages', False)) and 
-        bot_member.can_pin_messages):
+        (old_status != 'administrator' or not getattr(old_member, 'can_pin_messages', False)) and 
+        new_member.can_pin_messages):
         
         # Бот получил права администратора с возможностью закрепления сообщений
         # Проверяем, есть ли правила группы и закрепляем их
@@ -569,31 +1181,17 @@ async def pin_group_rules_if_exist(context: ContextTypes.DEFAULT_TYPE, chat_id:
     
     try:
         # Формируем сообщение с правилами для закрепления
-        rules_message = (
-            "*ПРАВИЛА ГРУППЫ:*\n\n"
-            f"• *Описание:* {rules.get('description', 'Не указано')}\n"
-            f"• *Срок погашения:* {rules.get('deadline_hours', 'Не указано')} часов\n"
-            f"• *Время уведомлений:* {rules.get('notifications_time', 'Не указано')}\n\n"
-            "Используйте кнопки ниже для быстрого доступа к основным функциям:"
-        )
-        
-        # Создаем инлайн кнопки для быстрого доступа
-        keyboard = [
-            [
-                InlineKeyboardButton("➕ Добавить расход", callback_data="help_addexpense"),
-                InlineKeyboardButton("💰 Мой долг", callback_data="help_mydebt")
-            ],
-            [
-                InlineKeyboardButton("📊 Отчет", callback_data="help_report"),
-                InlineKeyboardButton("💸 Отправить деньги", callback_data="help_send")
-            ]
-        ]
+        rules_message = _pinned_rules_text(
+            rules.get('description', 'Не указано'),
+            rules.get('deadline_hours', 'Не указано'),
+            rules.get('notifications_time', 'Не указано')
+        )
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _RULES_KB
         
         # Проверяем, есть ли уже закрепленное сообщение от бота
         chat = await context.bot.get_chat(chat_id)
-        if chat.pinned_message and chat.pinned_message.from_user.id == context.bot.id:
+        if chat.pinned_message and chat.pinned_message.from_user.id == get_bot_id(context):
             # Если есть закрепленное сообщение от бота, открепляем его
             await context.bot.unpin_chat_message(
                 chat_id=chat_id,
@@ -606,7 +1204,7 @@ async def pin_group_rules_if_exist(context: ContextTypes.DEFAULT_TYPE, chat_id:
             chat_id=chat_id,
             text=rules_message,
             reply_markup=reply_markup,
-            parse_mode='Markdown'
+            parse_mode='HTML'
         )
         
         # Закрепляем сообщение
@@ -628,15 +1226,15 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat = update.effective_chat
     
     # Save user info
-    save_user(user.id, user.username, user.first_name, user.last_name)
+    _save_user_cached(user)
     
     # Handle group chats
-    if chat.type in ['group', 'supergroup']:
+    if chat.type in _GROUP_TYPES:
         # Логируем информацию о пользователе и группе
         logger.info(f"Start command from user {user.id} (@{user.username}, {user.first_name} {user.last_name}) in group {chat.id} ({chat.title})")
         
         # Save group info
-        saved_group = save_group(chat.id, chat.title)
+        saved_group = _save_group_cached(chat)
         # Add user to group
         added_to_group = add_user_to_group(chat.id, user.id)
         
@@ -663,10 +1261,10 @@ async def reset_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     chat = update.effective_chat
     
     # Сохраняем информацию о пользователе
-    save_user(user.id, user.username, user.first_name, user.last_name)
+    _save_user_cached(user)
     
     # Проверяем, что команда вызвана в групповом чате
-    if chat.type not in ['group', 'supergroup']:
+    if chat.type not in _GROUP_TYPES:
         await update.message.reply_text(
             "Эта команда работает только в группах."
         )
@@ -680,13 +1278,7 @@ async def reset_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
     
     # Создаем кнопки для подтверждения/отмены сброса
-    keyboard = [
-        [
-            InlineKeyboardButton("Да, подтверждаю", callback_data="reset_confirm"),
-            InlineKeyboardButton("Отмена", callback_data="reset_cancel")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _RESET_CONFIRM_KB
     
     await update.message.reply_text(
         "⚠️ *ВНИМАНИЕ!* ⚠️\n\n"
@@ -713,47 +1305,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         message_id=message.message_id
     )
     
-    help_text = (
-        "*Команды бота:*\n\n"
-        "Нажмите на кнопку ниже для выполнения соответствующей команды.\n\n"
-        "*Как использовать:*\n"
-        "1. Добавляйте расходы\n"
-        "2. Проверяйте свой долг\n"
-        "3. Отправляйте деньги участникам\n"
-        "4. Получайте отчеты\n"
-        "5. Администраторы имеют дополнительные функции"
-    )
-    
-    # Создаем инлайн кнопки для всех команд
-    keyboard = [
-        [
-            InlineKeyboardButton("➕ Добавить расход", callback_data="help_addexpense"),
-            InlineKeyboardButton("💰 Мой долг", callback_data="help_mydebt")
-        ],
-        [
-            InlineKeyboardButton("📊 Отчет", callback_data="help_report"),
-            InlineKeyboardButton("💸 Отправить деньги", callback_data="help_send")
-        ],
-        [
-            InlineKeyboardButton("⚙️ Правила группы", callback_data="help_rules"),
-            InlineKeyboardButton("ℹ️ О боте", callback_data="help_about")
-        ]
-    ]
-    
-    # Проверяем, является ли пользователь администратором, и если да, добавляем кнопку админа
+    # Администраторам показываем меню с кнопкой администрирования
     is_user_admin = await is_admin(update, context)
-    if is_user_admin:
-        keyboard.append([
-            InlineKeyboardButton("🔧 Администрирование", callback_data="help_admin")
-        ])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
     
     # Отправляем сообщение с помощью
-    help_message = await message.reply_markdown(help_text, reply_markup=reply_markup)
+    help_message = await message.reply_text(**_help_payload(is_user_admin))
     
     # Планируем удаление исходной команды
-    await schedule_message_deletion(
+    _schedule_deletion_soon(
         context=context,
         chat_id=chat_id,
         message_id=message.message_id
@@ -761,7 +1320,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     
     # Планируем удаление сообщения с помощью, но с более длительным таймером,
     # так как это интерактивное меню
-    await schedule_message_deletion(
+    _schedule_deletion_soon(
         context=context,
         chat_id=chat_id,
         message_id=help_message.message_id,
@@ -782,10 +1341,10 @@ async def rules(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     chat = update.effective_chat
     
     # Save user info
-    save_user(user.id, user.username, user.first_name, user.last_name)
+    _save_user_cached(user)
     
     # Check if in group chat
-    if chat.type not in ['group', 'supergroup']:
+    if chat.type not in _GROUP_TYPES:
         await update.message.reply_text(
             "Эта команда работает только в группах."
         )
@@ -830,34 +1389,35 @@ async def rules_description(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def rules_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle the rules deadline input."""
-    try:
-        deadline = int(update.message.text)
-        if deadline <= 0:
-            await update.message.reply_text(
-                "Срок должен быть положительным числом. Попробуйте снова:"
-            )
-            return RULES_DEADLINE
-        
-        context.user_data['rules_deadline'] = deadline
-        
+    deadline = _parse_int(update.message.text)
+    if deadline is None:
         await update.message.reply_text(
-            "Укажите время для ежедневных уведомлений о долгах в формате ЧЧ:ММ (например, 20:00):"
+            "Неверный формат. Введите число часов:",
+            disable_notification=True
         )
-        
-        return RULES_NOTIFICATIONS
-    except ValueError:
+        return RULES_DEADLINE
+    if deadline <= 0:
         await update.message.reply_text(
-            "Неверный формат. Введите число часов:"
+            "Срок должен быть положительным числом. Попробуйте снова:",
+            disable_notification=True
         )
         return RULES_DEADLINE
+    
+    context.user_data['rules_deadline'] = deadline
+    
+    await update.message.reply_text(
+        "Укажите время для ежедневных уведомлений о долгах в формате ЧЧ:ММ (например, 20:00):",
+        disable_notification=True
+    )
+    
+    return RULES_NOTIFICATIONS
 
 async def rules_notifications(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle the rules notifications time input."""
-    time_pattern = re.compile(r'^([01]?[0-9]|2[0-3]):([0-5][0-9])$')
-    
-    if not time_pattern.match(update.message.text):
+    if not _valid_hhmm(update.message.text):
         await update.message.reply_text(
-            "Неверный формат времени. Введите время в формате ЧЧ:ММ (например, 20:00):"
+            "Неверный формат времени. Введите время в формате ЧЧ:ММ (например, 20:00):",
+            disable_notification=True
         )
         return RULES_NOTIFICATIONS
     
@@ -871,52 +1431,42 @@ async def rules_notifications(update: Update, context: ContextTypes.DEFAULT_TYPE
         context.user_data['rules_notifications']
     )
     
+    # Запрашиваем информацию о боте в чате параллельно с ответом об успехе
+    member_request = asyncio.ensure_future(get_bot_member(context, update.effective_chat.id))
+    
     # Создаем сообщение об успешной настройке правил
-    await update.message.reply_text(
-        "Правила группы успешно настроены! 👍"
-    )
+    try:
+        await update.message.reply_text(
+            "Правила группы успешно настроены! 👍",
+            disable_notification=True
+        )
+    except Exception:
+        member_request.cancel()
+        raise
     
     # Проверяем, есть ли у бота права на закрепление сообщений
     try:
-        # Получаем информацию о боте в чате
-        bot_member = await context.bot.get_chat_member(
-            update.effective_chat.id, 
-            context.bot.id
-        )
+        bot_member = await member_request
         
         # Проверяем права бота на закрепление сообщений
         can_pin = bot_member.can_pin_messages
         
         if can_pin:
             # Формируем сообщение с правилами для закрепления
-            rules_message = (
-                "*ПРАВИЛА ГРУППЫ:*\n\n"
-                f"• *Описание:* {context.user_data['rules_description']}\n"
-                f"• *Срок погашения:* {context.user_data['rules_deadline']} часов\n"
-                f"• *Время уведомлений:* {context.user_data['rules_notifications']}\n\n"
-                "Используйте кнопки ниже для быстрого доступа к основным функциям:"
+            rules_message = _pinned_rules_text(
+                context.user_data['rules_description'],
+                context.user_data['rules_deadline'],
+                context.user_data['rules_notifications']
             )
             
-            # Создаем инлайн кнопки для быстрого доступа
-            keyboard = [
-                [
-                    InlineKeyboardButton("➕ Добавить расход", callback_data="help_addexpense"),
-                    InlineKeyboardButton("💰 Мой долг", callback_data="help_mydebt")
-                ],
-                [
-                    InlineKeyboardButton("📊 Отчет", callback_data="help_report"),
-                    InlineKeyboardButton("💸 Отправить деньги", callback_data="help_send")
-                ]
-            ]
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = _RULES_KB
             
             # Отправляем сообщение с правилами и кнопками
             pinned_message = await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text=rules_message,
                 reply_markup=reply_markup,
-                parse_mode='Markdown'
+                parse_mode='HTML'
             )
             
             # Закрепляем сообщение
@@ -933,13 +1483,15 @@ async def rules_notifications(update: Update, context: ContextTypes.DEFAULT_TYPE
             await update.message.reply_text(
                 "Я не могу закрепить правила, так как у меня нет прав администратора "
                 "с возможностью закрепления сообщений. Чтобы я мог закреплять правила, "
-                "пожалуйста, назначьте меня администратором и предоставьте права на закрепление сообщений."
+                "пожалуйста, назначьте меня администратором и предоставьте права на закрепление сообщений.",
+                disable_notification=True
             )
     except Exception as e:
         logger.error(f"Ошибка при закреплении правил: {e}")
         await update.message.reply_text(
             "Не удалось закрепить правила группы. Пожалуйста, убедитесь, что бот имеет "
-            "необходимые права администратора."
+            "необходимые права администратора.",
+            disable_notification=True
         )
     
     return ConversationHandler.END
@@ -950,24 +1502,18 @@ async def add_expense(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     chat = update.effective_chat
     
     # Save user info
-    save_user(user.id, user.username, user.first_name, user.last_name)
+    _save_user_cached(user)
     
-    # Планируем удаление исходной команды пользователя
-    try:
-        await context.bot.delete_message(
-            chat_id=chat.id,
-            message_id=update.message.message_id
-        )
-    except Exception as e:
-        logger.info(f"Не удалось удалить команду: {e}")
+    # Удаляем исходную команду пользователя в фоне, не задерживая ответ
+    _spawn(_delete_user_message(context, chat.id, update.message.message_id))
     
     # Check if in group chat
-    if chat.type not in ['group', 'supergroup']:
+    if chat.type not in _GROUP_TYPES:
         message = await update.message.reply_text(
             "Эта команда работает только в группах."
         )
         # Планируем удаление сообщения
-        await schedule_message_deletion(context, chat.id, message.message_id)
+        _schedule_deletion_soon(context, chat.id, message.message_id)
         return ConversationHandler.END
     
     # Parse command arguments if provided
@@ -985,13 +1531,13 @@ async def add_expense(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
                     f"✅ Расход успешно добавлен: {amount} руб. за {description}"
                 )
                 # Планируем удаление сообщения
-                await schedule_message_deletion(context, chat.id, message.message_id)
+                _schedule_deletion_soon(context, chat.id, message.message_id)
             else:
                 message = await update.message.reply_text(
                     f"❌ Ошибка: {result}"
                 )
                 # Планируем удаление сообщения об ошибке
-                await schedule_message_deletion(context, chat.id, message.message_id)
+                _schedule_deletion_soon(context, chat.id, message.message_id)
             
             return ConversationHandler.END
         except ValueError:
@@ -999,13 +1545,7 @@ async def add_expense(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
             pass
     
     # Создаем подменю для выбора типа добавления расхода
-    keyboard = [
-        [
-            InlineKeyboardButton("На всех участников группы", callback_data="expense_all_members"),
-            InlineKeyboardButton("Выборочно", callback_data="expense_selective")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _EXPENSE_TYPE_MARKUP
     
     message = await update.message.reply_text(
         "Как вы хотите добавить расход?",
@@ -1021,7 +1561,7 @@ async def add_expense(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     )
     
     # Планируем удаление сообщения с проверкой незавершенной операции
-    await schedule_message_deletion(
+    _schedule_deletion_soon(
         context=context,
         chat_id=chat.id,
         message_id=message.message_id,
@@ -1036,59 +1576,26 @@ async def add_expense(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 
 async def expense_amount(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle the expense amount input."""
+    # Операция прервана по неактивности: сообщение - обычный текст в чате, а не сумма
+    if not _expense_operation_active(update):
+        return ConversationHandler.END
+    
     user = update.effective_user
     chat = update.effective_chat
     
-    # Планируем удаление сообщения пользователя
-    try:
-        await context.bot.delete_message(
-            chat_id=chat.id,
-            message_id=update.message.message_id
-        )
-    except Exception as e:
-        logger.info(f"Не удалось удалить сообщение пользователя: {e}")
+    # Удаляем сообщение пользователя в фоне, не задерживая ответ
+    _spawn(_delete_user_message(context, chat.id, update.message.message_id))
     
-    try:
-        amount = float(update.message.text.replace(',', '.'))
-        if amount <= 0:
-            message = await update.message.reply_text(
-                "Сумма должна быть положительным числом. Попробуйте снова:"
-            )
-            
-            # Планируем удаление сообщения с проверкой незавершенной операции
-            await schedule_message_deletion(
-                context=context,
-                chat_id=chat.id,
-                message_id=message.message_id,
-                user_id=user.id,
-                operation_type="expense_add"
-            )
-            
-            return EXPENSE_AMOUNT
-        
-        context.user_data['expense_amount'] = amount
-        
-        message = await update.message.reply_text(
-            "Теперь введите описание расхода:"
-        )
-        
-        # Планируем удаление сообщения с проверкой незавершенной операции
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat.id,
-            message_id=message.message_id,
-            user_id=user.id,
-            operation_type="expense_add"
-        )
-        
-        return EXPENSE_DESCRIPTION
-    except ValueError:
+    amount = _parse_amount(update.message.text)
+    if amount is None or amount <= 0:
         message = await update.message.reply_text(
-            "Неверный формат суммы. Введите число:"
+            "Неверный формат суммы. Введите число:" if amount is None else
+            "Сумма должна быть положительным числом. Попробуйте снова:",
+            disable_notification=True
         )
         
         # Планируем удаление сообщения с проверкой незавершенной операции
-        await schedule_message_deletion(
+        _schedule_deletion_soon(
             context=context,
             chat_id=chat.id,
             message_id=message.message_id,
@@ -1097,21 +1604,37 @@ async def expense_amount(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         
         return EXPENSE_AMOUNT
+    
+    context.user_data['expense_amount'] = amount
+    
+    message = await update.message.reply_text(
+        "Теперь введите описание расхода:",
+        disable_notification=True
+    )
+    
+    # Планируем удаление сообщения с проверкой незавершенной операции
+    _schedule_deletion_soon(
+        context=context,
+        chat_id=chat.id,
+        message_id=message.message_id,
+        user_id=user.id,
+        operation_type="expense_add"
+    )
+    
+    return EXPENSE_DESCRIPTION
 
 async def expense_description(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработка ввода описания расхода."""
+    # Операция прервана по неактивности: сообщение - обычный текст в чате, а не описание
+    if not _expense_operation_active(update):
+        return ConversationHandler.END
+    
     user = update.effective_user
     chat = update.effective_chat
     chat_id = chat.id
     
-    # Планируем удаление сообщения пользователя
-    try:
-        await context.bot.delete_message(
-            chat_id=chat_id,
-            message_id=update.message.message_id
-        )
-    except Exception as e:
-        logger.info(f"Не удалось удалить сообщение пользователя: {e}")
+    # Удаляем сообщение пользователя в фоне, не задерживая ответ
+    _spawn(_delete_user_message(context, chat_id, update.message.message_id))
     
     context.user_data['expense_description'] = update.message.text
     
@@ -1119,33 +1642,27 @@ async def expense_description(update: Update, context: ContextTypes.DEFAULT_TYPE
     expense_all_members = context.user_data.get('expense_all_members', False)
     
     # Получаем информацию о группе и её участниках
-    if chat_id < 0:  # Это групповой чат
+    if chat.type in _GROUP_TYPES:  # Это групповой чат
         # Если выбран режим "на всех участников", сразу переходим к запросу о фото
         if expense_all_members:
             # Получаем всех участников группы (кроме ботов)
-            members = get_group_members(chat_id, exclude_bots=True)
+            members = get_group_members(chat_id, exclude_bots=True, fields=('user_id',))
             
             # Сохраняем список всех участников в контексте
-            context.user_data['all_participants'] = [m['user_id'] for m in members]
             # Автоматически выбираем всех участников
-            context.user_data['selected_participants'] = [m['user_id'] for m in members]
+            _init_participant_selection(context.user_data, (m.user_id for m in members), select_all=True)
             
             # Переходим к запросу фото чека
-            keyboard = [
-                [
-                    InlineKeyboardButton("Да", callback_data="expense_photo_yes"),
-                    InlineKeyboardButton("Нет", callback_data="expense_photo_no"),
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = _PHOTO_KB
             
             message = await update.message.reply_text(
                 "Хотите прикрепить фото чека?",
-                reply_markup=reply_markup
+                reply_markup=reply_markup,
+                disable_notification=True
             )
             
             # Планируем удаление сообщения с проверкой незавершенной операции
-            await schedule_message_deletion(
+            _schedule_deletion_soon(
                 context=context,
                 chat_id=chat_id,
                 message_id=message.message_id,
@@ -1158,48 +1675,29 @@ async def expense_description(update: Update, context: ContextTypes.DEFAULT_TYPE
         # Для режима "выборочно" показываем список участников для выбора
         else:
             # Получаем список участников группы
-            members = get_group_members(chat_id, exclude_bots=True)
+            members = get_group_members(chat_id, exclude_bots=True, fields=MEMBER_FIELDS)
             
             # Если есть участники, предлагаем выбрать среди них
             if members and len(members) > 1:
-                # Создаем кнопки для каждого участника
-                keyboard = []
-                row = []
-                for i, member in enumerate(members):
-                    full_name = f"{member.get('first_name', '')} {member.get('last_name', '')}".strip()
-                    username = member.get('username', '')
-                    display_name = full_name if full_name else username
-                    
-                    # Создаем кнопку для участника
-                    user_id = member['user_id']
-                    callback_data = f"participant_{user_id}"
-                    button = InlineKeyboardButton(display_name, callback_data=callback_data)
-                    
-                    # Добавляем максимум 2 кнопки в строку
-                    row.append(button)
-                    if len(row) == 2 or i == len(members) - 1:
-                        keyboard.append(row)
-                        row = []
+                # Создаем кнопки для каждого участника, по 2 в строку
+                keyboard = [list(pair) for pair in batched(map(_participant_button, members), 2)]
                 
                 # Добавляем кнопки "Выбрать всех" и "Готово"
-                keyboard.append([
-                    InlineKeyboardButton("Выбрать всех", callback_data="participants_all"),
-                    InlineKeyboardButton("Готово", callback_data="participants_done")
-                ])
+                keyboard.append(_PARTICIPANTS_CONTROL_ROW)
                 
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 
                 # Сохраняем список участников и инициализируем выбранных
-                context.user_data['all_participants'] = [m['user_id'] for m in members]
-                context.user_data['selected_participants'] = []
+                _init_participant_selection(context.user_data, (m.user_id for m in members), select_all=False)
                 
                 message = await update.message.reply_text(
                     "Выберите участников для разделения расхода:",
-                    reply_markup=reply_markup
+                    reply_markup=reply_markup,
+                    disable_notification=True
                 )
                 
                 # Планируем удаление сообщения с проверкой незавершенной операции
-                await schedule_message_deletion(
+                _schedule_deletion_soon(
                     context=context,
                     chat_id=chat_id,
                     message_id=message.message_id,
@@ -1210,21 +1708,16 @@ async def expense_description(update: Update, context: ContextTypes.DEFAULT_TYPE
                 return EXPENSE_PARTICIPANTS
     
     # Если не группа или нет участников, просто спрашиваем о фото
-    keyboard = [
-        [
-            InlineKeyboardButton("Да", callback_data="expense_photo_yes"),
-            InlineKeyboardButton("Нет", callback_data="expense_photo_no"),
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _PHOTO_KB
     
     message = await update.message.reply_text(
         "Хотите прикрепить фото чека?",
-        reply_markup=reply_markup
+        reply_markup=reply_markup,
+        disable_notification=True
     )
     
     # Планируем удаление сообщения с проверкой незавершенной операции
-    await schedule_message_deletion(
+    _schedule_deletion_soon(
         context=context,
         chat_id=chat_id,
         message_id=message.message_id,
@@ -1234,1347 +1727,968 @@ async def expense_description(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     return EXPENSE_PHOTO
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обработка нажатий на кнопки."""
+async def _start_expense_amount(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                all_members: bool, title: str) -> int:
+    """Запрашивает сумму расхода после выбора типа добавления."""
+    query = update.callback_query
+    await query.answer()
+    
+    await _safe_edit(query,
+        f"{title}\n\n"
+        "Введите сумму расхода (только число):"
+    )
+    
+    # Сохраняем информацию о выбранном типе расхода
+    context.user_data['expense_all_members'] = all_members
+    context.user_data['expense_add_state'] = 'waiting_for_amount'
+    
+    # Регистрируем незавершенную операцию
+    await register_pending_operation(
+        user_id=update.effective_user.id,
+        operation_type="expense_add",
+        chat_id=update.effective_chat.id,
+        message_id=query.message.message_id
+    )
+    
+    return EXPENSE_AMOUNT
+
+async def expense_all_members_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Добавление расхода на всех участников группы."""
+    return await _start_expense_amount(update, context, True, "Добавление расхода на всех участников группы.")
+
+async def expense_selective_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Добавление расхода на выбранных участников."""
+    return await _start_expense_amount(update, context, False, "Добавление расхода на выбранных участников.")
+
+async def help_add_expense_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Кнопка "Добавить расход" в меню помощи: вход в диалог добавления расхода."""
+    # Завершаем операцию help_command, из меню которой нажата кнопка
+    await complete_pending_operation(update.effective_user.id)
+    return await _start_expense_amount(update, context, False, "Добавление нового расхода.")
+
+# Отдельный пул для построения отчетов: медленные отчеты не занимают общий пул
+# asyncio.to_thread, через который идут запросы к базе из обработчиков
+REPORT_WORKERS = 2
+_report_executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="report")
+
+async def _build_reports(group_id: int) -> List:
+    """Строит Excel и PDF отчеты параллельно в пуле потоков, не блокируя цикл событий.
+
+    Возвращает [excel, pdf]; отчет, при построении которого возникла ошибка, равен None.
+    """
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(
+        loop.run_in_executor(_report_executor, generate_excel_report, group_id),
+        loop.run_in_executor(_report_executor, generate_pdf_report, group_id),
+        return_exceptions=True
+    )
+    reports = []
+    for name, result in zip(("Excel", "PDF"), results):
+        if isinstance(result, Exception):
+            logger.error("Ошибка при создании %s отчета для группы %s: %s", name, group_id, result)
+            result = None
+        reports.append(result)
+    return reports
+
+async def help_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Обработка кнопок меню помощи (help_*)."""
     query = update.callback_query
     await query.answer()
     
-    # Отмечаем операцию как завершенную, если она была связана с кнопкой
     user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
     user = update.effective_user
     chat = update.effective_chat
+    command = query.data.partition("_")[2]
     
-    # Обработка кнопок выбора типа добавления расхода
-    if query.data == "expense_all_members":
-        # Добавление расхода на всех участников группы
-        await query.edit_message_text(
-            "Добавление расхода на всех участников группы.\n\n"
-            "Введите сумму расхода (только число):"
-        )
-        
-        # Сохраняем информацию о выбранном типе расхода
-        context.user_data['expense_all_members'] = True
-        context.user_data['expense_add_state'] = 'waiting_for_amount'
-        
-        # Регистрируем незавершенную операцию
-        await register_pending_operation(
-            user_id=user_id,
-            operation_type="expense_add",
-            chat_id=chat_id,
-            message_id=query.message.message_id
-        )
+    # Отмечаем завершение операции help_command
+    await complete_pending_operation(user_id)
+    
+    # Обработка кнопки администрирования
+    if command == "admin":
+        # Проверяем, является ли пользователь администратором
+        is_user_admin = await is_admin(update, context)
         
-        return EXPENSE_AMOUNT
+        if not is_user_admin:
+            await _safe_edit(query,
+                "Только администраторы группы имеют доступ к этому меню."
+            )
+            return ConversationHandler.END
         
-    elif query.data == "expense_selective":
-        # Добавление расхода выборочно
-        await query.edit_message_text(
-            "Добавление расхода на выбранных участников.\n\n"
-            "Введите сумму расхода (только число):"
+        await _safe_edit(query,
+            text=_ADMIN_MENU_TEXT,
+            reply_markup=_ADMIN_MENU_KB,
+            parse_mode='Markdown'
         )
+        return ConversationHandler.END
+    
+    # Кнопку "Добавить расход" (help_addexpense) обрабатывает expense_conversation_handler
+    if command == "mydebt":
+        # Получаем информацию о долге пользователя напрямую
+        debt_message = format_debt_message(user.id, chat.id)
         
-        # Сохраняем информацию о выбранном типе расхода
-        context.user_data['expense_all_members'] = False
-        context.user_data['expense_add_state'] = 'waiting_for_amount'
+        # Проверяем наличие ожидающих подтверждения переводов
+        pending_transactions = get_pending_transactions(user.id, as_receiver=True)
         
-        # Регистрируем незавершенную операцию
-        await register_pending_operation(
-            user_id=user_id,
-            operation_type="expense_add",
-            chat_id=chat_id,
-            message_id=query.message.message_id
+        # Отображаем информацию о долге
+        await _safe_edit(query,
+            text=debt_message,
+            parse_mode='Markdown'
         )
         
-        return EXPENSE_AMOUNT
-    
-    # Обработка кнопок из меню помощи или админских кнопок
-    if query.data.startswith("help_") or query.data.startswith("admin_"):
-        if query.data.startswith("help_"):
-            command_type = "help"
-            command = query.data.split("_")[1]
-        else:  # admin_
-            command_type = "admin"
-            command = query.data.split("_")[1]
-            
-            # Особая обработка админских команд из help-меню
-            if command in ["edit_expenses", "delete_expenses", "delete_transactions", "reset", "back"]:
-                # Проверяем права администратора
-                is_user_admin = await is_admin(update, context)
+        # Если есть ожидающие подтверждения переводы, отображаем их отдельными сообщениями
+        if pending_transactions:
+            for transaction in pending_transactions:
+                # Имя отправителя уже получено запросом (JOIN с users)
+                sender_name = transaction['sender_username'] or transaction['sender_first_name'] or 'Unknown'
                 
-                if not is_user_admin:
-                    await query.edit_message_text(
-                        "❌ Только администраторы группы могут выполнять эти действия."
-                    )
-                    return ConversationHandler.END
+                keyboard = [
+                    [
+                        InlineKeyboardButton("Подтвердить получение", 
+                                            callback_data=f"confirm_transaction_{transaction['id']}"),
+                        InlineKeyboardButton("Отклонить", 
+                                            callback_data=f"reject_transaction_{transaction['id']}"),
+                    ]
+                ]
+                reply_markup = InlineKeyboardMarkup(keyboard)
                 
-                # Обрабатываем каждую админскую кнопку
-                if command == "edit_expenses":
-                    # Получаем список всех расходов группы
-                    expenses = get_group_expenses(chat.id)
-                    
-                    if not expenses:
-                        await query.edit_message_text(
-                            "В этой группе еще нет расходов."
-                        )
-                        return ConversationHandler.END
-                        
-                    # Создаем кнопки для каждого расхода
-                    keyboard = []
-                    for expense in expenses[:10]:  # Ограничиваем до 10 последних расходов
-                        description = expense['description']
-                        amount = expense['amount']
-                        exp_id = expense['id']
-                        
-                        # Формируем текст кнопки
-                        button_text = f"{description} ({amount} руб.)"
-                        
-                        # Добавляем кнопку
-                        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"edit_expense_{exp_id}")])
-                    
-                    # Добавляем кнопку назад
-                    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="help_admin")])
-                    
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    await query.edit_message_text(
-                        "Выберите расход для редактирования:",
-                        reply_markup=reply_markup
-                    )
-                    return ConversationHandler.END
-                
-                elif command == "delete_expenses":
-                    # Получаем список всех расходов группы
-                    expenses = get_group_expenses(chat.id)
-                    
-                    if not expenses:
-                        await query.edit_message_text(
-                            "В этой группе еще нет расходов."
-                        )
-                        return ConversationHandler.END
-                        
-                    # Создаем кнопки для каждого расхода
-                    keyboard = []
-                    for expense in expenses[:10]:  # Ограничиваем до 10 последних расходов
-                        description = expense['description']
-                        amount = expense['amount']
-                        exp_id = expense['id']
-                        
-                        # Формируем текст кнопки
-                        button_text = f"{description} ({amount} руб.)"
-                        
-                        # Добавляем кнопку
-                        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"delete_expense_{exp_id}")])
-                    
-                    # Добавляем кнопку назад
-                    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="help_admin")])
-                    
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    await query.edit_message_text(
-                        "Выберите расход для удаления:",
-                        reply_markup=reply_markup
-                    )
-                    return ConversationHandler.END
-                
-                elif command == "delete_transactions":
-                    # Получаем список всех транзакций группы
-                    transactions = get_group_transactions(chat.id)
-                    
-                    if not transactions:
-                        await query.edit_message_text(
-                            "В этой группе еще нет транзакций."
-                        )
-                        return ConversationHandler.END
-                        
-                    # Создаем кнопки для каждой транзакции
-                    keyboard = []
-                    for tx in transactions[:10]:  # Ограничиваем до 10 последних транзакций
-                        sender_name = tx.get('sender_username', tx.get('sender_first_name', 'Неизвестно'))
-                        receiver_name = tx.get('receiver_username', tx.get('receiver_first_name', 'Неизвестно'))
-                        amount = tx['amount']
-                        tx_id = tx['id']
-                        
-                        # Формируем текст кнопки
-                        button_text = f"{sender_name} → {receiver_name} ({amount} руб.)"
-                        
-                        # Добавляем кнопку
-                        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"delete_transaction_{tx_id}")])
-                    
-                    # Добавляем кнопку назад
-                    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="help_admin")])
-                    
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    await query.edit_message_text(
-                        "Выберите транзакцию для удаления:",
-                        reply_markup=reply_markup
-                    )
-                    return ConversationHandler.END
-                    
-                elif command == "back":
-                    # Возвращаемся к основному меню помощи
-                    help_text = (
-                        "*Команды бота:*\n\n"
-                        "Нажмите на кнопку ниже для выполнения соответствующей команды.\n\n"
-                        "*Как использовать:*\n"
-                        "1. Добавляйте расходы\n"
-                        "2. Проверяйте свой долг\n"
-                        "3. Отправляйте деньги участникам\n"
-                        "4. Получайте отчеты\n"
-                        "5. Администраторы имеют дополнительные функции"
-                    )
-                    
-                    # Создаем инлайн кнопки для всех команд
-                    keyboard = [
-                        [
-                            InlineKeyboardButton("➕ Добавить расход", callback_data="help_addexpense"),
-                            InlineKeyboardButton("💰 Мой долг", callback_data="help_mydebt")
-                        ],
-                        [
-                            InlineKeyboardButton("📊 Отчет", callback_data="help_report"),
-                            InlineKeyboardButton("💸 Отправить деньги", callback_data="help_send")
-                        ],
-                        [
-                            InlineKeyboardButton("⚙️ Правила группы", callback_data="help_rules"),
-                            InlineKeyboardButton("ℹ️ О боте", callback_data="help_about")
-                        ],
-                        [
-                            InlineKeyboardButton("🔧 Администрирование", callback_data="help_admin")
-                        ]
-                    ]
-                    
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    await query.edit_message_text(
-                        text=help_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                    return ConversationHandler.END
+                await context.bot.send_message(
+                    chat_id=chat.id,
+                    text=f"Перевод от @{sender_name} на сумму {transaction['amount']:.2f} руб.",
+                    reply_markup=reply_markup
+                )
         
-        user = update.effective_user
-        chat = update.effective_chat
+        return ConversationHandler.END
+    
+    elif command == "report":
+        # Проверяем, является ли пользователь администратором
+        is_user_admin = await is_admin(update, context)
         
-        # Отмечаем завершение операции help_command
-        await complete_pending_operation(user_id)
+        if not is_user_admin:
+            await _safe_edit(query,
+                "Только администраторы могут генерировать отчеты."
+            )
+            return ConversationHandler.END
         
-        # Обработка кнопки администрирования
-        if command == "admin":
-            # Проверяем, является ли пользователь администратором
-            is_user_admin = await is_admin(update, context)
-            
-            if not is_user_admin:
-                await query.edit_message_text(
-                    "Только администраторы группы имеют доступ к этому меню."
-                )
-                return ConversationHandler.END
-            
-            # Создаем админ-меню
-            admin_text = (
-                "*Меню администратора*\n\n"
-                "Выберите действие из списка ниже:"
+        # Генерируем отчеты параллельно, вне цикла событий, пока показываем сообщение о процессе
+        _, (excel_report, pdf_report) = await asyncio.gather(
+            _safe_edit(query, "Генерирую отчеты, пожалуйста подождите..."),
+            _build_reports(chat.id)
+        )
+        
+        # Отправляем отчеты отдельными сообщениями
+        if excel_report:
+            excel_send = context.bot.send_document(
+                chat_id=chat.id,
+                document=excel_report,
+                filename=f"expenses_report_{chat.id}.xlsx",
+                caption="Отчет о расходах (Excel)"
             )
-            
-            keyboard = [
-                [
-                    InlineKeyboardButton("📝 Редактировать расходы", callback_data="admin_edit_expenses"),
-                    InlineKeyboardButton("🗑️ Удалить расходы", callback_data="admin_delete_expenses")
-                ],
-                [
-                    InlineKeyboardButton("🧹 Удалить транзакции", callback_data="admin_delete_transactions"),
-                    InlineKeyboardButton("⚙️ Настроить правила", callback_data="help_rules")
-                ],
-                [
-                    InlineKeyboardButton("♻️ Сбросить данные группы", callback_data="admin_reset"),
-                    InlineKeyboardButton("⬅️ Назад", callback_data="admin_back")
-                ]
-            ]
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                text=admin_text,
-                reply_markup=reply_markup,
-                parse_mode='Markdown'
+        else:
+            excel_send = context.bot.send_message(
+                chat_id=chat.id,
+                text="Не удалось создать Excel отчет."
             )
-            return ConversationHandler.END
         
-        if command == "addexpense":
-            # Отправляем новое сообщение вместо запуска команды напрямую
-            await query.edit_message_text(
-                "Добавление нового расхода.\n\n"
-                "Введите сумму расхода (только число):"
+        if pdf_report:
+            pdf_send = context.bot.send_document(
+                chat_id=chat.id,
+                document=pdf_report,
+                filename=f"expenses_report_{chat.id}.pdf",
+                caption="Отчет о расходах (PDF)"
+            )
+        else:
+            pdf_send = context.bot.send_message(
+                chat_id=chat.id,
+                text="Не удалось создать PDF отчет."
             )
-            # Сохраняем состояние в user_data чтобы продолжить диалог позже
-            context.user_data['waiting_for_expense_amount'] = True
-            return ConversationHandler.END
         
-        elif command == "mydebt":
-            # Получаем информацию о долге пользователя напрямую
-            debt_message = format_debt_message(user.id, chat.id)
-            
-            # Проверяем наличие ожидающих подтверждения переводов
-            pending_transactions = get_pending_transactions(user.id, as_receiver=True)
-            
-            # Отображаем информацию о долге
-            await query.edit_message_text(
-                text=debt_message,
-                parse_mode='Markdown'
+        await asyncio.gather(excel_send, pdf_send)
+        
+        return ConversationHandler.END
+    
+    elif command == "send":
+        # Сохраняем группу и добавляем текущего пользователя
+        logger.info("Saving group %s (%s) and adding user %s", chat.id, chat.title, user.id)
+        _save_group_cached(chat)
+        
+        # Добавляем пользователя и администраторов чата в группу бота
+        await _register_chat_admins(context, chat, user.id)
+            
+        # Получаем список участников группы для выбора
+        logger.info("Get group members for help/send. Chat ID: %s", chat.id)
+        recipients = await asyncio.to_thread(
+            get_group_members, chat.id, exclude_user_ids=(user.id,), fields=MEMBER_FIELDS)
+        logger.info("Found %d recipients for chat %s", len(recipients), chat.id)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Recipients in chat %s: %s", chat.id, recipients)
+        
+        if recipients:
+            # Кнопки для каждого участника, кроме текущего пользователя (его исключает
+            # запрос), и кнопка отмены
+            reply_markup = _recipient_keyboard(recipients)
+            
+            await _safe_edit(query,
+                "Выберите пользователя, которому хотите отправить деньги:",
+                reply_markup=reply_markup
             )
             
-            # Если есть ожидающие подтверждения переводы, отображаем их отдельными сообщениями
-            if pending_transactions:
-                for transaction in pending_transactions:
-                    sender = get_user(transaction['sender_id'])
-                    sender_name = sender.get('username', sender.get('first_name', 'Unknown'))
-                    
-                    keyboard = [
-                        [
-                            InlineKeyboardButton("Подтвердить получение", 
-                                                callback_data=f"confirm_transaction_{transaction['id']}"),
-                            InlineKeyboardButton("Отклонить", 
-                                                callback_data=f"reject_transaction_{transaction['id']}"),
-                        ]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    await context.bot.send_message(
-                        chat_id=chat.id,
-                        text=f"Перевод от @{sender_name} на сумму {transaction['amount']:.2f} руб.",
-                        reply_markup=reply_markup
-                    )
+            return SEND_AMOUNT
+        else:
+            # Если участников мало или их нет, используем стандартный ввод
+            await _safe_edit(query,
+                "Кому вы хотите отправить деньги? Введите @username:"
+            )
+            # Сохраняем флаг для обработки следующего сообщения
+            _set_waiting(context.user_data, PS_SEND_USERNAME, True)
             
             return ConversationHandler.END
+    
+    elif command == "rules":
+        # Проверяем правила группы
+        rules_data = get_group_rules(chat.id)
         
-        elif command == "report":
-            # Проверяем, является ли пользователь администратором
+        if rules_data:
+            # Если правила существуют, показываем их
+            await _safe_edit(query,
+                f"*Правила группы:*\n\n"
+                f"• *Описание:* {rules_data['description']}\n"
+                f"• *Срок погашения:* {rules_data['deadline_hours']} часов\n"
+                f"• *Время уведомлений:* {rules_data['notifications_time']}",
+                parse_mode='Markdown'
+            )
+        else:
+            # Если правил нет и пользователь - админ, предлагаем настроить
             is_user_admin = await is_admin(update, context)
             
-            if not is_user_admin:
-                await query.edit_message_text(
-                    "Только администраторы могут генерировать отчеты."
-                )
-                return ConversationHandler.END
-            
-            # Начинаем генерацию отчета
-            await query.edit_message_text("Генерирую отчеты, пожалуйста подождите...")
-            
-            # Генерируем отчеты
-            excel_report = generate_excel_report(chat.id)
-            pdf_report = generate_pdf_report(chat.id)
-            
-            # Отправляем отчеты отдельными сообщениями
-            if excel_report:
-                await context.bot.send_document(
-                    chat_id=chat.id,
-                    document=excel_report,
-                    filename=f"expenses_report_{chat.id}.xlsx",
-                    caption="Отчет о расходах (Excel)"
+            if is_user_admin:
+                await _safe_edit(query,
+                    "В этой группе ещё не настроены правила.\n"
+                    "Хотите настроить их сейчас?",
+                    reply_markup=_SETUP_RULES_KB
                 )
             else:
-                await context.bot.send_message(
-                    chat_id=chat.id,
-                    text="Не удалось создать Excel отчет."
+                await _safe_edit(query,
+                    "В этой группе ещё не настроены правила. "
+                    "Администратор может настроить их с помощью команды /rules."
                 )
-            
-            if pdf_report:
-                await context.bot.send_document(
-                    chat_id=chat.id,
-                    document=pdf_report,
-                    filename=f"expenses_report_{chat.id}.pdf",
-                    caption="Отчет о расходах (PDF)"
-                )
-            else:
-                await context.bot.send_message(
-                    chat_id=chat.id,
-                    text="Не удалось создать PDF отчет."
-                )
-            
-            return ConversationHandler.END
         
-        elif command == "send":
-            # Сохраняем группу и добавляем текущего пользователя
-            logger.info(f"Saving group {chat.id} ({chat.title}) and adding user {user.id}")
-            save_group(chat.id, chat.title)
-            add_user_to_group(chat.id, user.id)
-            
-            # Добавляем администраторов чата в группу бота
-            chat_members = await context.bot.get_chat_administrators(chat.id)
-            logger.info(f"Found {len(chat_members)} admins in chat {chat.id}")
-            
-            for member in chat_members:
-                member_user = member.user
-                logger.info(f"Adding admin {member_user.id} (@{member_user.username}) to group {chat.id}")
-                save_user(member_user.id, member_user.username, member_user.first_name, member_user.last_name)
-                add_user_to_group(chat.id, member_user.id)
-                
-            # Получаем список участников группы для выбора
-            logger.info(f"Get group members for help/send. Chat ID: {chat.id}")
-            members = get_group_members(chat.id)
-            logger.info(f"Found {len(members) if members else 0} members for chat {chat.id}: {members}")
-            
-            if members and len(members) > 1:
-                # Создаем кнопки для каждого участника
-                keyboard = []
-                for member in members:
-                    # Пропускаем текущего пользователя
-                    if member['user_id'] == user.id:
-                        continue
-                        
-                    # Формируем отображаемое имя
-                    first_name = member.get('first_name', '')
-                    last_name = member.get('last_name', '')
-                    username = member.get('username', '')
-                    user_id = member['user_id']
-                    
-                    # Создаем текст кнопки (имя/юзернейм)
-                    if first_name and last_name:
-                        display_name = f"{first_name} {last_name}"
-                    elif username:
-                        display_name = f"@{username}"
-                    else:
-                        display_name = f"ID: {user_id}"
-                        
-                    # Добавляем кнопку
-                    keyboard.append([InlineKeyboardButton(
-                        display_name, 
-                        callback_data=f"send_to_{user_id}"
-                    )])
-                
-                # Добавляем кнопку отмены
-                keyboard.append([InlineKeyboardButton("Отмена", callback_data="send_cancel")])
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    "Выберите пользователя, которому хотите отправить деньги:",
-                    reply_markup=reply_markup
-                )
-                
-                return SEND_AMOUNT
-            else:
-                # Если участников мало или их нет, используем стандартный ввод
-                await query.edit_message_text(
-                    "Кому вы хотите отправить деньги? Введите @username:"
-                )
-                # Сохраняем флаг для обработки следующего сообщения
-                context.user_data['waiting_for_send_username'] = True
-                
-                return ConversationHandler.END
-        
-        elif command == "rules":
-            # Проверяем правила группы
-            rules_data = get_group_rules(chat.id)
-            
-            if rules_data:
-                # Если правила существуют, показываем их
-                await query.edit_message_text(
-                    f"*Правила группы:*\n\n"
-                    f"• *Описание:* {rules_data['description']}\n"
-                    f"• *Срок погашения:* {rules_data['deadline_hours']} часов\n"
-                    f"• *Время уведомлений:* {rules_data['notifications_time']}",
-                    parse_mode='Markdown'
-                )
-            else:
-                # Если правил нет и пользователь - админ, предлагаем настроить
-                is_user_admin = await is_admin(update, context)
-                
-                if is_user_admin:
-                    await query.edit_message_text(
-                        "В этой группе ещё не настроены правила.\n"
-                        "Хотите настроить их сейчас?",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("Да", callback_data="setup_rules_yes"),
-                            InlineKeyboardButton("Нет", callback_data="setup_rules_no")]
-                        ])
-                    )
-                else:
-                    await query.edit_message_text(
-                        "В этой группе ещё не настроены правила. "
-                        "Администратор может настроить их с помощью команды /rules."
-                    )
-            
-            return ConversationHandler.END
-        
-        elif command == "about":
-            # Показываем информацию о боте
-            about_text = (
-                "*О боте для учета расходов*\n\n"
-                "Этот бот помогает группам друзей или коллег вести учет совместных расходов и разделять их между участниками.\n\n"
-                "*Основные возможности:*\n"
-                "• Добавление расходов с выбором участников\n"
-                "• Автоматический расчет долга для каждого участника\n"
-                "• Загрузка фото чеков для подтверждения расходов\n"
-                "• Перевод денег между участниками\n"
-                "• Генерация отчетов для контроля финансов\n\n"
-                "Создан с использованием Python и библиотеки python-telegram-bot."
-            )
-            
-            await query.edit_message_text(
-                text=about_text,
-                parse_mode='Markdown'
-            )
-            return ConversationHandler.END
+        return ConversationHandler.END
     
-    # Обработка выбора участников для расхода
-    elif query.data.startswith("participant_"):
-        user_id = int(query.data.split("_")[1])
-        
-        # Если пользователь уже выбран, удаляем его из списка, иначе добавляем
-        if user_id in context.user_data.get('selected_participants', []):
-            context.user_data['selected_participants'].remove(user_id)
-        else:
-            if 'selected_participants' not in context.user_data:
-                context.user_data['selected_participants'] = []
-            context.user_data['selected_participants'].append(user_id)
-        
-        # Обновляем сообщение с отметкой выбранных участников
-        message_text = "Выберите участников для разделения расхода:\n\n"
-        
-        for member_id in context.user_data.get('all_participants', []):
-            member = get_user(member_id)
-            if member:
-                # Используем имя и фамилию для отображения
-                first_name = member.get('first_name', '')
-                last_name = member.get('last_name', '')
-                full_name = f"{first_name} {last_name}".strip()
-                
-                # Если нет имени и фамилии, используем никнейм
-                display_name = full_name if full_name else member.get('username', 'Без имени')
-                
-                if member_id in context.user_data.get('selected_participants', []):
-                    message_text += f"✅ {display_name}\n"
-                else:
-                    message_text += f"⬜ {display_name}\n"
-        
-        await query.edit_message_text(
-            text=message_text,
-            reply_markup=query.message.reply_markup
+    elif command == "about":
+        # Показываем информацию о боте
+        await _safe_edit(query,
+            text=_ABOUT_TEXT,
+            parse_mode='Markdown'
         )
-        
-        return EXPENSE_PARTICIPANTS
+        return ConversationHandler.END
     
-    elif query.data == "participants_all":
-        # Выбираем всех участников
-        context.user_data['selected_participants'] = list(context.user_data.get('all_participants', []))
-        
-        # Обновляем сообщение с отметкой всех участников
-        message_text = "Выберите участников для разделения расхода:\n\n"
-        
-        for member_id in context.user_data.get('all_participants', []):
-            member = get_user(member_id)
-            if member:
-                # Используем имя и фамилию для отображения
-                first_name = member.get('first_name', '')
-                last_name = member.get('last_name', '')
-                full_name = f"{first_name} {last_name}".strip()
-                
-                # Если нет имени и фамилии, используем никнейм
-                display_name = full_name if full_name else member.get('username', 'Без имени')
-                
-                message_text += f"✅ {display_name}\n"
-        
-        await query.edit_message_text(
-            text=message_text,
-            reply_markup=query.message.reply_markup
+    return ConversationHandler.END
+
+async def _require_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Проверяет права администратора; при отказе сообщает об этом в том же сообщении."""
+    if await is_admin(update, context):
+        return True
+    await _safe_edit(update.callback_query,
+        "❌ Только администраторы группы могут выполнять эти действия."
+    )
+    return False
+
+def _expense_menu(expenses: List[Dict], callback_prefix: str) -> InlineKeyboardMarkup:
+    """Клавиатура выбора расхода: кнопка на каждый расход и кнопка "Назад"."""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"{e['description']} ({e['amount']} руб.)",
+                              callback_data=f"{callback_prefix}{e['id']}")]
+        for e in expenses
+    ] + [_BACK_ROW])
+
+async def _admin_expense_list(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                              callback_prefix: str, prompt: str) -> int:
+    """Показывает администратору последние расходы группы кнопками с заданным действием."""
+    query = update.callback_query
+    await query.answer()
+    
+    if not await _require_admin(update, context):
+        return ConversationHandler.END
+    
+    # Получаем только последние расходы группы - больше в меню не помещается
+    expenses = get_group_expenses(update.effective_chat.id, limit=ADMIN_LIST_LIMIT)
+    
+    if not expenses:
+        await _safe_edit(query,
+            "В этой группе еще нет расходов."
         )
+        return ConversationHandler.END
         
-        return EXPENSE_PARTICIPANTS
+    await _safe_edit(query,
+        prompt,
+        reply_markup=_expense_menu(expenses, callback_prefix)
+    )
+    return ConversationHandler.END
+
+async def admin_edit_expenses_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Список расходов для редактирования."""
+    return await _admin_expense_list(update, context, "edit_expense_", "Выберите расход для редактирования:")
+
+async def admin_delete_expenses_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Список расходов для удаления."""
+    return await _admin_expense_list(update, context, "delete_expense_", "Выберите расход для удаления:")
+
+async def admin_delete_transactions_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Список транзакций для удаления."""
+    query = update.callback_query
+    await query.answer()
     
-    elif query.data == "participants_done":
-        # Переходим к вопросу о фото
-        keyboard = [
-            [
-                InlineKeyboardButton("Да", callback_data="expense_photo_yes"),
-                InlineKeyboardButton("Нет", callback_data="expense_photo_no"),
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            "Хотите прикрепить фото чека?",
-            reply_markup=reply_markup
+    if not await _require_admin(update, context):
+        return ConversationHandler.END
+    
+    # Получаем только последние транзакции группы - больше в меню не помещается
+    transactions = get_group_transactions(update.effective_chat.id, limit=ADMIN_LIST_LIMIT)
+    
+    if not transactions:
+        await _safe_edit(query,
+            "В этой группе еще нет транзакций."
         )
+        return ConversationHandler.END
         
-        return EXPENSE_PHOTO
+    # Создаем кнопки для каждой транзакции (не более 10 последних)
+    keyboard = [
+        [InlineKeyboardButton(
+            f"{tx.get('sender_username', tx.get('sender_first_name', 'Неизвестно'))} → "
+            f"{tx.get('receiver_username', tx.get('receiver_first_name', 'Неизвестно'))} "
+            f"({tx['amount']} руб.)",
+            callback_data=f"delete_transaction_{tx['id']}"
+        )]
+        for tx in transactions
+    ]
     
-    # Обработка выбора фото чека
-    elif query.data == "expense_photo_yes":
-        await query.edit_message_text(
-            "Отправьте фото чека:"
-        )
-        return EXPENSE_PHOTO
+    # Добавляем кнопку назад
+    keyboard.append(_BACK_ROW)
     
-    elif query.data == "expense_photo_no":
-        # Сохраняем расход без фото
-        user = update.effective_user
-        chat_id = update.effective_chat.id
-        
-        # Используем выбранных участников, если они есть
-        participants = context.user_data.get('selected_participants')
-        
-        # Отмечаем операцию как завершенную
-        await complete_pending_operation(user.id)
-        
-        success, result = handle_new_expense(
-            chat_id,
-            context.user_data['expense_amount'],
-            context.user_data['expense_description'],
-            user.id,
-            participants=participants
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await _safe_edit(query,
+        "Выберите транзакцию для удаления:",
+        reply_markup=reply_markup
+    )
+    return ConversationHandler.END
+
+async def admin_reset_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Запрос подтверждения сброса данных группы."""
+    query = update.callback_query
+    await query.answer()
+    
+    if not await _require_admin(update, context):
+        return ConversationHandler.END
+    
+    await _safe_edit(query,
+        "⚠️ *ВНИМАНИЕ!* ⚠️\n\n"
+        "Вы собираетесь сбросить *ВСЮ* историю группы.\n"
+        "Это удалит все расходы, долги, транзакции и правила группы.\n"
+        "Пользователи останутся в группе, но вся их финансовая история будет удалена.\n\n"
+        "*Это действие необратимо.*\n\n"
+        "Вы уверены, что хотите продолжить?",
+        reply_markup=_RESET_CONFIRM_KB,
+        parse_mode='Markdown'
+    )
+    return ConversationHandler.END
+
+async def admin_back_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Возврат к основному меню помощи."""
+    query = update.callback_query
+    await query.answer()
+    
+    if not await _require_admin(update, context):
+        return ConversationHandler.END
+    
+    await _safe_edit(query, **_help_payload(True))
+    return ConversationHandler.END
+
+async def _refresh_participant_list(query, message_text: str) -> None:
+    """Обновляет текст списка участников, сохраняя клавиатуру.
+    
+    Без reply_markup Telegram убрал бы кнопки, поэтому передаем текущую разметку;
+    если текст не изменился (например, повторное "Выбрать всех"), запрос не отправляется.
+    """
+    message = query.message
+    if message.text == message_text:
+        return
+    await _safe_edit(query, text=message_text, reply_markup=message.reply_markup)
+
+async def _on_participant_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE, query,
+                                 user_id: int) -> int:
+    """Переключает выбор участника расхода."""
+    # Если пользователь уже выбран, снимаем выбор, иначе выбираем
+    _toggle_participant(context.user_data, user_id)
+    selected_mask = context.user_data.get('selected_mask', b'')
+    
+    # Обновляем сообщение с отметкой выбранных участников
+    lines = ["Выберите участников для разделения расхода:", ""]
+    
+    users = _participant_users(context.user_data)
+    for i, member_id in enumerate(context.user_data.get('all_participants', ())):
+        member = users.get(member_id)
+        if member:
+            display_name = _display_name(member['first_name'], member['last_name'], member['username'])
+            mark = "✅" if _is_participant_selected(selected_mask, i) else "⬜"
+            lines.append(f"{mark} {display_name}")
+    message_text = "\n".join(lines)
+    
+    await _refresh_participant_list(query, message_text)
+    
+    return EXPENSE_PARTICIPANTS
+
+async def _on_participants_all(update: Update, context: ContextTypes.DEFAULT_TYPE, query) -> int:
+    """Выбирает всех участников расхода."""
+    # Выбираем всех участников
+    all_participants = context.user_data.get('all_participants', ())
+    _init_participant_selection(context.user_data, all_participants, select_all=True)
+    
+    # Обновляем сообщение с отметкой всех участников
+    lines = ["Выберите участников для разделения расхода:", ""]
+    
+    users = _participant_users(context.user_data)
+    for member_id in all_participants:
+        member = users.get(member_id)
+        if member:
+            display_name = _display_name(member['first_name'], member['last_name'], member['username'])
+            lines.append(f"✅ {display_name}")
+    message_text = "\n".join(lines)
+    
+    await _refresh_participant_list(query, message_text)
+    
+    return EXPENSE_PARTICIPANTS
+
+async def _on_participants_done(update: Update, context: ContextTypes.DEFAULT_TYPE, query) -> int:
+    """Завершает выбор участников и спрашивает о фото чека."""
+    # Переходим к вопросу о фото
+    reply_markup = _PHOTO_KB
+    
+    await _safe_edit(query,
+        "Хотите прикрепить фото чека?",
+        reply_markup=reply_markup
+    )
+    
+    return EXPENSE_PHOTO
+
+async def _on_expense_photo_yes(update: Update, context: ContextTypes.DEFAULT_TYPE, query) -> int:
+    """Просит прислать фото чека."""
+    await _safe_edit(query,
+        "Отправьте фото чека:"
+    )
+    return EXPENSE_PHOTO
+
+async def _on_expense_photo_no(update: Update, context: ContextTypes.DEFAULT_TYPE, query) -> int:
+    """Сохраняет расход без фото чека."""
+    # Сохраняем расход без фото
+    user = update.effective_user
+    chat_id = update.effective_chat.id
+    
+    # Используем выбранных участников, если они есть
+    participants = _selected_participants(context.user_data)
+    
+    # Отмечаем операцию как завершенную
+    await complete_pending_operation(user.id)
+    
+    success, result = handle_new_expense(
+        chat_id,
+        context.user_data['expense_amount'],
+        context.user_data['expense_description'],
+        user.id,
+        participants=participants
+    )
+    
+    if success:
+        # Формируем сообщение об успехе с деталями
+        success_message = (
+            f"✅ Расход успешно добавлен: {context.user_data['expense_amount']} руб. "
+            f"за {context.user_data['expense_description']}"
         )
         
-        if success:
-            # Формируем сообщение об успехе с деталями
-            success_message = (
-                f"✅ Расход успешно добавлен: {context.user_data['expense_amount']} руб. "
-                f"за {context.user_data['expense_description']}"
-            )
-            
-            # Если выбраны конкретные участники, добавляем информацию
-            if participants and len(participants) > 0:
-                # Получаем имена участников
-                names = []
-                for participant_id in participants:
-                    participant = get_user(participant_id)
-                    if participant:
-                        # Используем имя и фамилию для отображения
-                        first_name = participant.get('first_name', '')
-                        last_name = participant.get('last_name', '')
-                        full_name = f"{first_name} {last_name}".strip()
-                        
-                        # Если нет имени и фамилии, используем никнейм
-                        display_name = full_name if full_name else participant.get('username', 'Без имени')
-                        names.append(display_name)
-                
-                success_message += f"\nУчастники: {', '.join(names)}"
-            
-            # Редактируем сообщение с результатом
-            await query.edit_message_text(success_message)
+        # Если выбраны конкретные участники, добавляем информацию
+        if participants and len(participants) > 0:
+            # Получаем имена участников
+            names = []
+            users = _participant_users(context.user_data)
+            for participant_id in participants:
+                participant = users.get(participant_id)
+                if participant:
+                    display_name = _display_name(participant['first_name'], participant['last_name'], participant['username'])
+                    names.append(display_name)
             
-            # Планируем удаление сообщения
-            await schedule_message_deletion(
-                context=context,
-                chat_id=chat_id,
-                message_id=query.message.message_id
-            )
-        else:
-            error_message = f"❌ Ошибка: {result}"
-            await query.edit_message_text(error_message)
-            
-            # Планируем удаление сообщения об ошибке
-            await schedule_message_deletion(
-                context=context,
-                chat_id=chat_id,
-                message_id=query.message.message_id
-            )
-        
-        # Очистка данных
-        for key in ['expense_amount', 'expense_description', 'expense_file_id', 
-                   'all_participants', 'selected_participants']:
-            if key in context.user_data:
-                del context.user_data[key]
+            success_message += f"\nУчастники: {', '.join(names)}"
         
+        # Редактируем сообщение с результатом
+        await _edit_and_schedule_deletion(query, context, success_message)
+    else:
+        error_message = f"❌ Ошибка: {result}"
+        await _edit_and_schedule_deletion(query, context, error_message)
+    
+    # Очистка данных
+    _clear_user_data(context.user_data, _EXPENSE_DRAFT_KEYS)
+    
+    return ConversationHandler.END
+
+async def _on_confirm_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE, query,
+                                  transaction_id: int) -> int:
+    """Подтверждение получения перевода."""
+    success, message = confirm_transaction(transaction_id)
+    
+    if success:
+        # Отображаем сообщение об успешном подтверждении перевода
+        await _edit_and_schedule_deletion(query, context, "✅ Перевод подтвержден!")
+    else:
+        # Отображаем сообщение об ошибке при подтверждении перевода
+        await _edit_and_schedule_deletion(query, context, f"❌ Ошибка: {message}")
+    
+    return ConversationHandler.END
+
+async def _on_reject_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE, query,
+                                 transaction_id: int) -> int:
+    """Отклонение перевода."""
+    success, message = reject_transaction(transaction_id)
+    
+    if success:
+        # Отображаем сообщение об отклонении перевода
+        await _edit_and_schedule_deletion(query, context, "❌ Перевод отклонен.")
+    else:
+        # Отображаем сообщение об ошибке при отклонении перевода
+        await _edit_and_schedule_deletion(query, context, f"❌ Ошибка: {message}")
+    
+    return ConversationHandler.END
+
+async def _on_send_to(update: Update, context: ContextTypes.DEFAULT_TYPE, query,
+                      receiver_id: int) -> int:
+    """Выбор получателя перевода из списка."""
+    # Получаем информацию о получателе
+    receiver = get_user(receiver_id)
+    if not receiver:
+        await _safe_edit(query,
+            "❌ Ошибка: пользователь не найден."
+        )
         return ConversationHandler.END
     
-    # Handle transaction confirmation
-    elif query.data.startswith("confirm_transaction_"):
-        transaction_id = int(query.data.split("_")[-1])
-        success, message = confirm_transaction(transaction_id)
-        
-        if success:
-            # Отображаем сообщение об успешном подтверждении перевода
-            await query.edit_message_text(
-                "✅ Перевод подтвержден!"
-            )
-            
-            # Планируем удаление сообщения через 5 минут
-            await schedule_message_deletion(
-                context=context,
-                chat_id=query.message.chat_id,
-                message_id=query.message.message_id
-            )
-        else:
-            # Отображаем сообщение об ошибке при подтверждении перевода
-            await query.edit_message_text(
-                f"❌ Ошибка: {message}"
-            )
-            
-            # Планируем удаление сообщения об ошибке
-            await schedule_message_deletion(
-                context=context,
-                chat_id=query.message.chat_id,
-                message_id=query.message.message_id
-            )
+    # Формируем отображаемое имя
+    receiver_name = _recipient_name(receiver)
     
-    # Handle transaction rejection
-    elif query.data.startswith("reject_transaction_"):
-        transaction_id = int(query.data.split("_")[-1])
-        success, message = reject_transaction(transaction_id)
-        
-        if success:
-            # Отображаем сообщение об отклонении перевода
-            await query.edit_message_text(
-                "❌ Перевод отклонен."
-            )
-            
-            # Планируем удаление сообщения через 5 минут
-            await schedule_message_deletion(
-                context=context,
-                chat_id=query.message.chat_id,
-                message_id=query.message.message_id
-            )
-        else:
-            # Отображаем сообщение об ошибке при отклонении перевода
-            await query.edit_message_text(
-                f"❌ Ошибка: {message}"
-            )
-            
-            # Планируем удаление сообщения об ошибке
-            await schedule_message_deletion(
-                context=context,
-                chat_id=query.message.chat_id,
-                message_id=query.message.message_id
-            )
+    # Сохраняем ID получателя в контексте
+    context.user_data['send_receiver_id'] = receiver_id
+    context.user_data['send_receiver_name'] = receiver_name
+    
+    # Запрашиваем сумму
+    await _safe_edit(query,
+        f"Сколько вы хотите отправить пользователю {receiver_name}? Введите сумму:"
+    )
+    
+    # Устанавливаем флаг ожидания суммы
+    _set_waiting(context.user_data, PS_SEND_AMOUNT, True)
     
-    # Обработка выбора получателя денег (send_to_ID)
-    elif query.data.startswith("send_to_"):
-        # Извлекаем ID получателя из данных колбэка
-        receiver_id = int(query.data.split("_")[2])
+    return SEND_AMOUNT
+
+async def _on_send_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, query) -> int:
+    """Подтверждение отправки денег."""
+    # Получаем данные из контекста
+    username = context.user_data.get('send_username')
+    amount = context.user_data.get('send_amount')
+    receiver_id = context.user_data.get('send_receiver_id')
+    receiver_name = context.user_data.get('send_receiver_name')
+    
+    # Получаем инфо о пользователе и чате
+    user = update.effective_user
+    chat = update.effective_chat
+    
+    # Отмечаем операцию как завершенную
+    await complete_pending_operation(user.id)
+    
+    # Если есть ID получателя (выбран из меню), используем его
+    if receiver_id and amount:
+        # Создаем транзакцию
+        success, result = handle_money_transfer(
+            chat.id, user.id, receiver_id, amount
+        )
         
-        # Получаем информацию о получателе
-        receiver = get_user(receiver_id)
-        if not receiver:
-            await query.edit_message_text(
-                "❌ Ошибка: пользователь не найден."
+        if success:
+            # Сообщение об успешном переводе
+            await _edit_and_schedule_deletion(query, context,
+                f"✅ Запрос на перевод {amount} руб. пользователю {receiver_name} отправлен. "
+                f"Ожидайте подтверждения от получателя."
             )
-            return ConversationHandler.END
-        
-        # Формируем отображаемое имя
-        receiver_name = ""
-        if receiver.get('first_name') and receiver.get('last_name'):
-            receiver_name = f"{receiver['first_name']} {receiver['last_name']}"
-        elif receiver.get('username'):
-            receiver_name = f"@{receiver['username']}"
         else:
-            receiver_name = f"ID: {receiver_id}"
-        
-        # Сохраняем ID получателя в контексте
-        context.user_data['send_receiver_id'] = receiver_id
-        context.user_data['send_receiver_name'] = receiver_name
-        
-        # Запрашиваем сумму
-        await query.edit_message_text(
-            f"Сколько вы хотите отправить пользователю {receiver_name}? Введите сумму:"
-        )
-        
-        # Устанавливаем флаг ожидания суммы
-        context.user_data['waiting_for_send_amount'] = True
-        
-        return SEND_AMOUNT
-    
-    # Подтверждение отправки денег
-    elif query.data == "send_confirm":
-        # Получаем данные из контекста
-        username = context.user_data.get('send_username')
-        amount = context.user_data.get('send_amount')
-        receiver_id = context.user_data.get('send_receiver_id')
-        receiver_name = context.user_data.get('send_receiver_name')
-        
-        # Получаем инфо о пользователе и чате
-        user = update.effective_user
-        chat = update.effective_chat
+            # Сообщение об ошибке
+            await _edit_and_schedule_deletion(query, context, f"❌ Ошибка: {result}")
+    # Если есть имя пользователя (введено вручную), ищем его
+    elif username and amount:
+        # Находим участника группы по имени пользователя
+        user_by_name = get_group_member_by_username(chat.id, username)
         
-        # Отмечаем операцию как завершенную
-        await complete_pending_operation(user.id)
-        
-        # Если есть ID получателя (выбран из меню), используем его
-        if receiver_id and amount:
-            # Создаем транзакцию
+        if user_by_name:
+            receiver_id = user_by_name['user_id']
             success, result = handle_money_transfer(
                 chat.id, user.id, receiver_id, amount
             )
             
             if success:
                 # Сообщение об успешном переводе
-                await query.edit_message_text(
-                    f"✅ Запрос на перевод {amount} руб. пользователю {receiver_name} отправлен. "
+                await _edit_and_schedule_deletion(query, context,
+                    f"✅ Запрос на перевод {amount} руб. пользователю @{username} отправлен. "
                     f"Ожидайте подтверждения от получателя."
                 )
-                
-                # Планируем удаление сообщения через 5 минут
-                await schedule_message_deletion(
-                    context=context,
-                    chat_id=chat.id,
-                    message_id=query.message.message_id
-                )
             else:
                 # Сообщение об ошибке
-                await query.edit_message_text(
-                    f"❌ Ошибка: {result}"
-                )
-                
-                # Планируем удаление сообщения об ошибке
-                await schedule_message_deletion(
-                    context=context,
-                    chat_id=chat.id,
-                    message_id=query.message.message_id
-                )
-        # Если есть имя пользователя (введено вручную), ищем его
-        elif username and amount:
-            # Находим пользователя по имени пользователя
-            user_by_name = None
-            members = get_group_members(chat.id)
-            
-            if members:
-                for member in members:
-                    if member.get('username') == username:
-                        user_by_name = member
-                        break
-            
-            if user_by_name:
-                receiver_id = user_by_name['user_id']
-                success, result = handle_money_transfer(
-                    chat.id, user.id, receiver_id, amount
-                )
-                
-                if success:
-                    # Сообщение об успешном переводе
-                    await query.edit_message_text(
-                        f"✅ Запрос на перевод {amount} руб. пользователю @{username} отправлен. "
-                        f"Ожидайте подтверждения от получателя."
-                    )
-                    
-                    # Планируем удаление сообщения
-                    await schedule_message_deletion(
-                        context=context,
-                        chat_id=chat.id,
-                        message_id=query.message.message_id
-                    )
-                else:
-                    # Сообщение об ошибке
-                    await query.edit_message_text(
-                        f"❌ Ошибка: {result}"
-                    )
-                    
-                    # Планируем удаление сообщения об ошибке
-                    await schedule_message_deletion(
-                        context=context,
-                        chat_id=chat.id,
-                        message_id=query.message.message_id
-                    )
-            else:
-                # Пользователь не найден
-                await query.edit_message_text(
-                    f"⚠️ Пользователь @{username} не найден в текущей группе. "
-                    f"Проверьте правильность имени пользователя."
-                )
-                
-                # Планируем удаление сообщения
-                await schedule_message_deletion(
-                    context=context,
-                    chat_id=chat.id,
-                    message_id=query.message.message_id
-                )
+                await _edit_and_schedule_deletion(query, context, f"❌ Ошибка: {result}")
         else:
-            # Недостаточно данных
-            await query.edit_message_text(
-                "❌ Ошибка: недостаточно данных для перевода."
-            )
-            
-            # Планируем удаление сообщения об ошибке
-            await schedule_message_deletion(
-                context=context,
-                chat_id=chat.id,
-                message_id=query.message.message_id
+            # Пользователь не найден
+            await _edit_and_schedule_deletion(query, context,
+                f"⚠️ Пользователь @{username} не найден в текущей группе. "
+                f"Проверьте правильность имени пользователя."
             )
-        
-        # Очищаем данные контекста
-        context.user_data.pop('send_username', None)
-        context.user_data.pop('send_amount', None)
-        context.user_data.pop('send_receiver_id', None)
-        context.user_data.pop('send_receiver_name', None)
-        context.user_data.pop('waiting_for_send_amount', None)
-        
-        return ConversationHandler.END
+    else:
+        # Недостаточно данных
+        await _edit_and_schedule_deletion(query, context, "❌ Ошибка: недостаточно данных для перевода.")
+    
+    # Очищаем данные контекста
+    _clear_user_data(context.user_data, _SEND_DRAFT_KEYS)
+    _set_waiting(context.user_data, PS_SEND_AMOUNT, False)
+    
+    return ConversationHandler.END
+
+async def _on_send_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, query) -> int:
+    """Отмена отправки денег."""
+    # Сообщение об отмене операции
+    await _edit_and_schedule_deletion(query, context, "❌ Операция отменена.")
+    
+    # Отмечаем операцию как завершенную
+    await complete_pending_operation(update.effective_user.id)
+    
+    # Очищаем данные контекста
+    _clear_user_data(context.user_data, _SEND_DRAFT_KEYS)
+    _set_waiting(context.user_data, PS_SEND_AMOUNT, False)
+    
+    return ConversationHandler.END
+
+async def _on_setup_rules_yes(update: Update, context: ContextTypes.DEFAULT_TYPE, query) -> int:
+    """Начинает настройку правил группы."""
+    await _safe_edit(query,
+        "Давайте настроим правила группы.\n\n"
+        "Введите описание правил (например, 'Делим поровну'):"
+    )
+    # Сохраняем состояние для ожидания ввода описания правил
+    _set_waiting(context.user_data, PS_RULES_DESCRIPTION, True)
     
-    # Отмена отправки денег
-    elif query.data == "send_cancel":
-        # Сообщение об отмене операции
-        await query.edit_message_text(
-            "❌ Операция отменена."
-        )
+    return ConversationHandler.END
+
+async def _on_setup_rules_no(update: Update, context: ContextTypes.DEFAULT_TYPE, query) -> int:
+    """Отказ от настройки правил группы."""
+    await _safe_edit(query,
+        "Вы решили не настраивать правила. Вы всегда можете сделать это позже с помощью команды /rules."
+    )
+    
+    return ConversationHandler.END
+
+async def _run_group_reset(context: ContextTypes.DEFAULT_TYPE, query, chat, user,
+                           can_delete_messages: bool) -> None:
+    """Очищает чат (если у бота есть права на удаление), сбрасывает данные группы и сообщает результат."""
+    # Если бот может удалять сообщения, удаляем все сообщения
+    if can_delete_messages:
+        try:
+            # Верхняя граница берется из сообщения с кнопкой подтверждения: оно само
+            # попадает в удаляемый диапазон, а пробное сообщение отправлять не нужно
+            latest_message_id = query.message.message_id + 1
+            
+            # Удаляем сообщения до текущего ID пакетами через deleteMessages:
+            # несуществующие и недоступные сообщения Telegram пропускает сам
+            # Пакеты отправляются параллельно, темп задает общий лимитер запросов
+            results = await asyncio.gather(*(
+                _delete_messages_batch(context, chat.id, chunk)
+                for chunk in batched(range(latest_message_id - RESET_DELETE_DEPTH, latest_message_id),
+                                     DELETE_MESSAGES_BATCH)
+            ))
+            requested_count = sum(results)
+            
+            logger.info(f"Запрошено удаление {requested_count} сообщений в группе {chat.id}")
+        except Exception as e:
+            logger.error(f"Ошибка при удалении сообщений в группе {chat.id}: {e}")
+    
+    # Выполняем сброс данных в базе
+    success = reset_group_data(chat.id)
+    
+    if success:
+        # Добавляем лог о сбросе
+        logger.info("Пользователь %s (@%s) сбросил данные группы %s (%s)", user.id, user.username, chat.id, chat.title)
         
-        # Планируем удаление сообщения об отмене
-        await schedule_message_deletion(
-            context=context,
+        # Отправляем новое сообщение (так как старое могло быть удалено)
+        await _tg_call(chat.id, context.bot.send_message,
             chat_id=chat.id,
-            message_id=query.message.message_id
+            text="✅ Данные группы успешно сброшены.\n\n"
+                 "Удалены: все расходы, долги, транзакции, правила и сообщения.\n"
+                 "Пользователи сохранены в группе."
         )
         
-        # Отмечаем операцию как завершенную
-        await complete_pending_operation(update.effective_user.id)
-        
-        # Очищаем данные контекста
-        context.user_data.pop('send_username', None)
-        context.user_data.pop('send_amount', None)
-        context.user_data.pop('send_receiver_id', None)
-        context.user_data.pop('send_receiver_name', None)
-        context.user_data.pop('waiting_for_send_amount', None)
-        
-        return ConversationHandler.END
-    
-    # Обработка настройки правил группы
-    elif query.data == "setup_rules_yes":
-        await query.edit_message_text(
-            "Давайте настроим правила группы.\n\n"
-            "Введите описание правил (например, 'Делим поровну'):"
+        # Также обновляем сообщение с кнопкой (если оно еще существует)
+        try:
+            await _safe_edit(query,
+                "✅ Данные группы успешно сброшены.\n\n"
+                "Удалены: все расходы, долги, транзакции, правила и сообщения.\n"
+                "Пользователи сохранены в группе."
+            )
+        except Exception:
+            pass
+    else:
+        # Отправляем сообщение об ошибке
+        await _tg_call(chat.id, context.bot.send_message,
+            chat_id=chat.id,
+            text="❌ Произошла ошибка при сбросе данных группы.\n"
+                 "Пожалуйста, попробуйте позже или обратитесь к разработчикам."
         )
-        # Сохраняем состояние для ожидания ввода описания правил
-        context.user_data['waiting_for_rules_description'] = True
         
-    elif query.data == "setup_rules_no":
-        await query.edit_message_text(
-            "Вы решили не настраивать правила. Вы всегда можете сделать это позже с помощью команды /rules."
+        # Обновляем сообщение с кнопкой, если оно еще существует
+        try:
+            await _safe_edit(query,
+                "❌ Произошла ошибка при сбросе данных группы.\n"
+                "Пожалуйста, попробуйте позже или обратитесь к разработчикам."
+            )
+        except Exception:
+            pass
+
+async def _on_reset_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, query) -> int:
+    """Подтверждение сброса данных группы."""
+    # Обработка подтверждения сброса данных группы
+    chat = update.effective_chat
+    user = update.effective_user
+    
+    # Проверяем права администратора еще раз
+    if not await is_admin(update, context):
+        await _safe_edit(query,
+            "❌ Только администраторы группы могут сбросить данные."
         )
+        return ConversationHandler.END
     
-    # Обработка кнопок сброса данных группы
-    elif query.data == "reset_confirm":
-        # Обработка подтверждения сброса данных группы
-        chat = update.effective_chat
-        user = update.effective_user
-        
-        # Проверяем права администратора еще раз
-        if not await is_admin(update, context):
-            await query.edit_message_text(
-                "❌ Только администраторы группы могут сбросить данные."
-            )
-            return ConversationHandler.END
-        
-        # Проверяем, может ли бот открепить сообщения (требуется для сброса закрепленных правил)
+    # Права бота и закрепленное сообщение запрашиваем одновременно: права нужны
+    # и для открепления правил, и для удаления сообщений
+    bot_member, chat_info = await asyncio.gather(
+        get_bot_member(context, chat.id),
+        context.bot.get_chat(chat.id),
+        return_exceptions=True
+    )
+    if isinstance(bot_member, Exception):
+        logger.error(f"Ошибка при проверке прав бота: {bot_member}")
+        bot_member = None
+    if isinstance(chat_info, Exception):
+        logger.error(f"Ошибка при получении информации о чате: {chat_info}")
+        chat_info = None
+    
+    # Если у бота есть права на закрепление, пробуем найти и открепить закрепленные сообщения
+    if chat_info is not None and getattr(bot_member, 'can_pin_messages', False):
         try:
-            # Проверяем права бота в чате
-            bot_member = await context.bot.get_chat_member(chat.id, context.bot.id)
-            can_pin = bot_member.can_pin_messages
-            
-            # Если у бота есть права на закрепление, пробуем найти и открепить закрепленные сообщения
-            if can_pin:
-                try:
-                    # Получаем закрепленное сообщение
-                    chat_info = await context.bot.get_chat(chat.id)
-                    pinned_message = chat_info.pinned_message
-                    
-                    # Проверяем, является ли закрепленное сообщение сообщением с правилами от бота
-                    if pinned_message and pinned_message.from_user.id == context.bot.id and "ПРАВИЛА ГРУППЫ" in pinned_message.text:
-                        # Открепляем старое сообщение с правилами
-                        await context.bot.unpin_chat_message(
-                            chat_id=chat.id,
-                            message_id=pinned_message.message_id
-                        )
-                        logger.info(f"Откреплено сообщение с правилами в группе {chat.id}")
-                except Exception as e:
-                    logger.error(f"Ошибка при откреплении сообщения: {e}")
-        except Exception as e:
-            logger.error(f"Ошибка при проверке прав бота: {e}")
+            pinned_message = chat_info.pinned_message
             
-        # Информируем пользователя о начале операции очистки
-        await query.edit_message_text(
-            "⏳ Начинаем очистку чата и сброс данных группы...\n\n"
-            "Это может занять некоторое время. Пожалуйста, подождите."
-        )
-        
-        # Проверяем, есть ли у бота права на удаление сообщений
-        can_delete_messages = False
-        try:
-            bot_member = await context.bot.get_chat_member(chat.id, context.bot.id)
-            can_delete_messages = bot_member.can_delete_messages
-        except Exception as e:
-            logger.error(f"Ошибка при проверке прав на удаление сообщений: {e}")
-        
-        # Если бот может удалять сообщения, удаляем все сообщения
-        if can_delete_messages:
-            # Сначала получаем последнее сообщение в чате
-            try:
-                # Попробуем удалить последние 1000 сообщений
-                # Отправляем временное сообщение для получения последнего ID
-                temp_message = await context.bot.send_message(
-                    chat_id=chat.id,
-                    text="Определение последнего ID сообщения..."
-                )
-                
-                latest_message_id = temp_message.message_id
-                await context.bot.delete_message(
+            # Проверяем, является ли закрепленное сообщение сообщением с правилами от бота
+            if pinned_message and pinned_message.from_user.id == get_bot_id(context) and "ПРАВИЛА ГРУППЫ" in pinned_message.text:
+                # Открепляем старое сообщение с правилами
+                await context.bot.unpin_chat_message(
                     chat_id=chat.id,
-                    message_id=temp_message.message_id
+                    message_id=pinned_message.message_id
                 )
-                
-                # Удаляем все сообщения до текущего ID (кроме фото и видео)
-                deleted_count = 0
-                for msg_id in range(latest_message_id - 1000, latest_message_id):
-                    try:
-                        await context.bot.delete_message(
-                            chat_id=chat.id,
-                            message_id=msg_id
-                        )
-                        deleted_count += 1
-                        # Делаем небольшую паузу, чтобы не перегрузить API Telegram
-                        if deleted_count % 20 == 0:
-                            await asyncio.sleep(0.5)
-                    except Exception:
-                        # Игнорируем ошибки - сообщения могут не существовать или быть фото/видео
-                        pass
-                
-                logger.info(f"Удалено {deleted_count} сообщений в группе {chat.id}")
-            except Exception as e:
-                logger.error(f"Ошибка при удалении сообщений в группе {chat.id}: {e}")
-        
-        # Выполняем сброс данных в базе
-        success = reset_group_data(chat.id)
+                logger.info(f"Откреплено сообщение с правилами в группе {chat.id}")
+        except Exception as e:
+            logger.error(f"Ошибка при откреплении сообщения: {e}")
         
-        if success:
-            # Добавляем лог о сбросе
-            logger.info(f"Пользователь {user.id} (@{user.username}) сбросил данные группы {chat.id} ({chat.title})")
-            
-            # Отправляем новое сообщение (так как старое могло быть удалено)
-            await context.bot.send_message(
-                chat_id=chat.id,
-                text="✅ Данные группы успешно сброшены.\n\n"
-                     "Удалены: все расходы, долги, транзакции, правила и сообщения.\n"
-                     "Пользователи сохранены в группе."
-            )
-            
-            # Также обновляем сообщение с кнопкой (если оно еще существует)
-            try:
-                await query.edit_message_text(
-                    "✅ Данные группы успешно сброшены.\n\n"
-                    "Удалены: все расходы, долги, транзакции, правила и сообщения.\n"
-                    "Пользователи сохранены в группе."
-                )
-            except Exception:
-                pass
-            
-            logger.info(f"Пользователь {user.id} (@{user.username}) сбросил данные группы {chat.id} ({chat.title})")
-        else:
-            # Отправляем сообщение об ошибке
-            await context.bot.send_message(
-                chat_id=chat.id,
-                text="❌ Произошла ошибка при сбросе данных группы.\n"
-                     "Пожалуйста, попробуйте позже или обратитесь к разработчикам."
-            )
-            
-            # Обновляем сообщение с кнопкой, если оно еще существует
-            try:
-                await query.edit_message_text(
-                    "❌ Произошла ошибка при сбросе данных группы.\n"
-                    "Пожалуйста, попробуйте позже или обратитесь к разработчикам."
-                )
-            except Exception:
-                pass
-    
-    elif query.data == "reset_cancel":
-        # Отмена сброса данных группы
-        await query.edit_message_text(
-            "❌ Сброс данных группы отменен."
-        )
-        
-    # Обработка кнопок административного меню - этот блок активируется только для прямых admin_* действий, 
-    # Обработка кнопок администратора
-    elif query.data.startswith("admin_"):
-        admin_action = query.data.split("_")[1]
-        user = update.effective_user
-        chat = update.effective_chat
-        
-        # Проверяем права администратора
-        if not await is_admin(update, context):
-            await query.edit_message_text(
-                "❌ Только администраторы группы могут выполнять эти действия."
-            )
-            return ConversationHandler.END
-            
-        if admin_action == "edit_expenses":
-            # Получаем список всех расходов группы
-            expenses = get_group_expenses(chat.id)
-            
-            if not expenses:
-                await query.edit_message_text(
-                    "В этой группе еще нет расходов."
-                )
-                return ConversationHandler.END
-                
-            # Создаем кнопки для каждого расхода
-            keyboard = []
-            for expense in expenses[:10]:  # Ограничиваем до 10 последних расходов
-                description = expense['description']
-                amount = expense['amount']
-                exp_id = expense['id']
-                
-                # Формируем текст кнопки
-                button_text = f"{description} ({amount} руб.)"
-                
-                # Добавляем кнопку
-                keyboard.append([InlineKeyboardButton(button_text, callback_data=f"edit_expense_{exp_id}")])
-            
-            # Добавляем кнопку назад
-            keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="admin_back")])
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                "Выберите расход для редактирования:",
-                reply_markup=reply_markup
-            )
-            return ConversationHandler.END
-            
-        elif admin_action == "delete_expenses":
-            # Получаем список всех расходов группы
-            expenses = get_group_expenses(chat.id)
-            
-            if not expenses:
-                await query.edit_message_text(
-                    "В этой группе еще нет расходов."
-                )
-                return ConversationHandler.END
-                
-            # Создаем кнопки для каждого расхода
-            keyboard = []
-            for expense in expenses[:10]:  # Ограничиваем до 10 последних расходов
-                description = expense['description']
-                amount = expense['amount']
-                exp_id = expense['id']
-                
-                # Формируем текст кнопки
-                button_text = f"{description} ({amount} руб.)"
-                
-                # Добавляем кнопку
-                keyboard.append([InlineKeyboardButton(button_text, callback_data=f"delete_expense_{exp_id}")])
-            
-            # Добавляем кнопку назад
-            keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="admin_back")])
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                "Выберите расход для удаления:",
-                reply_markup=reply_markup
-            )
-            return ConversationHandler.END
-            
-        elif admin_action == "delete_transactions":
-            # Получаем список всех транзакций группы
-            transactions = get_group_transactions(chat.id)
-            
-            if not transactions:
-                await query.edit_message_text(
-                    "В этой группе еще нет транзакций."
-                )
-                return ConversationHandler.END
-                
-            # Создаем кнопки для каждой транзакции
-            keyboard = []
-            for tx in transactions[:10]:  # Ограничиваем до 10 последних транзакций
-                sender_name = tx.get('sender_username', tx.get('sender_first_name', 'Неизвестно'))
-                receiver_name = tx.get('receiver_username', tx.get('receiver_first_name', 'Неизвестно'))
-                amount = tx['amount']
-                tx_id = tx['id']
-                
-                # Формируем текст кнопки
-                button_text = f"{sender_name} → {receiver_name} ({amount} руб.)"
-                
-                # Добавляем кнопку
-                keyboard.append([InlineKeyboardButton(button_text, callback_data=f"delete_transaction_{tx_id}")])
-            
-            # Добавляем кнопку назад
-            keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="admin_back")])
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                "Выберите транзакцию для удаления:",
-                reply_markup=reply_markup
-            )
-            return ConversationHandler.END
-            
-        elif admin_action == "reset":
-            # Переадресуем на команду сброса с подтверждением
-            keyboard = [
-                [
-                    InlineKeyboardButton("Да, подтверждаю", callback_data="reset_confirm"),
-                    InlineKeyboardButton("Отмена", callback_data="reset_cancel")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                "⚠️ *ВНИМАНИЕ!* ⚠️\n\n"
-                "Вы собираетесь сбросить *ВСЮ* историю группы.\n"
-                "Это удалит все расходы, долги, транзакции и правила группы.\n"
-                "Пользователи останутся в группе, но вся их финансовая история будет удалена.\n\n"
-                "*Это действие необратимо.*\n\n"
-                "Вы уверены, что хотите продолжить?",
-                reply_markup=reply_markup,
-                parse_mode='Markdown'
-            )
-            return ConversationHandler.END
-            
-        elif admin_action == "back":
-            # Возвращаемся к основному меню помощи
-            help_text = (
-                "*Команды бота:*\n\n"
-                "Нажмите на кнопку ниже для выполнения соответствующей команды.\n\n"
-                "*Как использовать:*\n"
-                "1. Добавляйте расходы\n"
-                "2. Проверяйте свой долг\n"
-                "3. Отправляйте деньги участникам\n"
-                "4. Получайте отчеты\n"
-                "5. Администраторы имеют дополнительные функции"
-            )
-            
-            # Создаем инлайн кнопки для всех команд
-            keyboard = [
-                [
-                    InlineKeyboardButton("➕ Добавить расход", callback_data="help_addexpense"),
-                    InlineKeyboardButton("💰 Мой долг", callback_data="help_mydebt")
-                ],
-                [
-                    InlineKeyboardButton("📊 Отчет", callback_data="help_report"),
-                    InlineKeyboardButton("💸 Отправить деньги", callback_data="help_send")
-                ],
-                [
-                    InlineKeyboardButton("⚙️ Правила группы", callback_data="help_rules"),
-                    InlineKeyboardButton("ℹ️ О боте", callback_data="help_about")
-                ],
-                [
-                    InlineKeyboardButton("🔧 Администрирование", callback_data="help_admin")
-                ]
-            ]
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                text=help_text,
-                reply_markup=reply_markup,
-                parse_mode='Markdown'
-            )
-            return ConversationHandler.END
+    # Информируем пользователя о начале операции очистки
+    await _safe_edit(query,
+        "⏳ Начинаем очистку чата и сброс данных группы...\n\n"
+        "Это может занять некоторое время. Пожалуйста, подождите."
+    )
     
-    # Обработка редактирования расхода
-    elif query.data.startswith("edit_expense_"):
-        expense_id = int(query.data.split("_")[-1])
-        expense = get_expense_with_debts(expense_id)
-        
-        if not expense:
-            await query.edit_message_text(
-                "❌ Не удалось найти указанный расход."
-            )
-            return ConversationHandler.END
-        
-        # Сохраняем ID расхода в контексте
-        context.user_data['edit_expense_id'] = expense_id
-        context.user_data['edit_expense_description'] = expense['description']
-        context.user_data['edit_expense_old_amount'] = expense['amount']
-        
-        # Спрашиваем новую сумму
-        await query.edit_message_text(
-            f"Редактирование расхода: {expense['description']}\n\n"
-            f"Текущая сумма: {expense['amount']} руб.\n\n"
-            f"Введите новую сумму расхода:"
-        )
-        
-        # Сохраняем флаг для обработки следующего сообщения
-        context.user_data['waiting_for_edit_expense_amount'] = True
-        
-        return EDIT_EXPENSE_AMOUNT
+    # Очистка чата и сброс данных выполняются в фоне, чтобы не занимать обработчик
+    _spawn(_run_group_reset(context, query, chat, user, getattr(bot_member, 'can_delete_messages', False)))
     
-    # Обработка удаления расхода
-    elif query.data.startswith("delete_expense_"):
-        expense_id = int(query.data.split("_")[-1])
-        expense = get_expense_with_debts(expense_id)
-        
-        if not expense:
-            await query.edit_message_text(
-                "❌ Не удалось найти указанный расход."
-            )
-            return ConversationHandler.END
-        
-        # Запрашиваем подтверждение
-        keyboard = [
-            [
-                InlineKeyboardButton("Да, удалить", callback_data=f"confirm_delete_expense_{expense_id}"),
-                InlineKeyboardButton("Отмена", callback_data="admin_back")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            f"⚠️ Вы уверены, что хотите удалить расход?\n\n"
-            f"Описание: {expense['description']}\n"
-            f"Сумма: {expense['amount']} руб.\n\n"
-            f"Это действие удалит расход и связанные с ним долги!",
-            reply_markup=reply_markup
+    return ConversationHandler.END
+
+async def _on_reset_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, query) -> int:
+    """Отмена сброса данных группы."""
+    # Отмена сброса данных группы
+    await _safe_edit(query,
+        "❌ Сброс данных группы отменен."
+    )
+    
+    return ConversationHandler.END
+
+async def _on_edit_expense(update: Update, context: ContextTypes.DEFAULT_TYPE, query,
+                           expense_id: int) -> int:
+    """Редактирование суммы расхода (только для администраторов)."""
+    # Действие только для администраторов: проверяем права до обращения к БД
+    if not await _require_admin(update, context):
+        return ConversationHandler.END
+    
+    expense = get_expense_with_debts(expense_id)
+    
+    if not expense:
+        await _safe_edit(query,
+            "❌ Не удалось найти указанный расход."
         )
         return ConversationHandler.END
     
-    # Обработка подтверждения удаления расхода
-    elif query.data.startswith("confirm_delete_expense_"):
-        expense_id = int(query.data.split("_")[-1])
-        
-        # Удаляем расход
-        success, message = delete_expense(expense_id)
-        
-        if success:
-            await query.edit_message_text(
-                f"✅ {message}"
-            )
-        else:
-            await query.edit_message_text(
-                f"❌ {message}"
-            )
+    # Сохраняем ID расхода в контексте
+    context.user_data['edit_expense_id'] = expense_id
+    context.user_data['edit_expense_description'] = expense['description']
+    context.user_data['edit_expense_old_amount'] = expense['amount']
+    
+    # Спрашиваем новую сумму
+    await _safe_edit(query,
+        f"Редактирование расхода: {expense['description']}\n\n"
+        f"Текущая сумма: {expense['amount']} руб.\n\n"
+        f"Введите новую сумму расхода:"
+    )
+    
+    # Сохраняем флаг для обработки следующего сообщения
+    _set_waiting(context.user_data, PS_EDIT_EXPENSE_AMOUNT, True)
+    
+    return EDIT_EXPENSE_AMOUNT
+
+async def _on_delete_expense(update: Update, context: ContextTypes.DEFAULT_TYPE, query,
+                             expense_id: int) -> int:
+    """Запрос подтверждения удаления расхода (только для администраторов)."""
+    # Действие только для администраторов: проверяем права до обращения к БД
+    if not await _require_admin(update, context):
         return ConversationHandler.END
     
-    # Обработка удаления транзакции
-    elif query.data.startswith("delete_transaction_"):
-        transaction_id = int(query.data.split("_")[-1])
-        
-        # Запрашиваем подтверждение
-        keyboard = [
-            [
-                InlineKeyboardButton("Да, удалить", callback_data=f"confirm_delete_transaction_{transaction_id}"),
-                InlineKeyboardButton("Отмена", callback_data="admin_back")
-            ]
+    expense = get_expense_with_debts(expense_id)
+    
+    if not expense:
+        await _safe_edit(query,
+            "❌ Не удалось найти указанный расход."
+        )
+        return ConversationHandler.END
+    
+    # Запрашиваем подтверждение
+    keyboard = [
+        [
+            InlineKeyboardButton("Да, удалить", callback_data=f"confirm_delete_expense_{expense_id}"),
+            _ADMIN_CANCEL_BUTTON
         ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            f"⚠️ Вы уверены, что хотите удалить эту транзакцию?\n\n"
-            f"Это действие не может быть отменено!",
-            reply_markup=reply_markup
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await _safe_edit(query,
+        f"⚠️ Вы уверены, что хотите удалить расход?\n\n"
+        f"Описание: {expense['description']}\n"
+        f"Сумма: {expense['amount']} руб.\n\n"
+        f"Это действие удалит расход и связанные с ним долги!",
+        reply_markup=reply_markup
+    )
+    return ConversationHandler.END
+
+async def _on_confirm_delete_expense(update: Update, context: ContextTypes.DEFAULT_TYPE, query,
+                                     expense_id: int) -> int:
+    """Удаление расхода после подтверждения (только для администраторов)."""
+    # Действие только для администраторов: проверяем права до обращения к БД
+    if not await _require_admin(update, context):
+        return ConversationHandler.END
+    
+    # Удаляем расход
+    success, message = delete_expense(expense_id)
+    
+    if success:
+        await _safe_edit(query,
+            f"✅ {message}"
         )
+    else:
+        await _safe_edit(query,
+            f"❌ {message}"
+        )
+    return ConversationHandler.END
+
+async def _on_delete_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE, query,
+                                 transaction_id: int) -> int:
+    """Запрос подтверждения удаления транзакции (только для администраторов)."""
+    # Действие только для администраторов: проверяем права до обращения к БД
+    if not await _require_admin(update, context):
         return ConversationHandler.END
-        
-    # Обработка подтверждения удаления транзакции
-    elif query.data.startswith("confirm_delete_transaction_"):
-        transaction_id = int(query.data.split("_")[-1])
-        
-        # Удаляем транзакцию
-        success, message = delete_transaction(transaction_id)
-        
-        if success:
-            await query.edit_message_text(
-                f"✅ {message}"
-            )
-        else:
-            await query.edit_message_text(
-                f"❌ {message}"
-            )
+    
+    # Запрашиваем подтверждение
+    keyboard = [
+        [
+            InlineKeyboardButton("Да, удалить", callback_data=f"confirm_delete_transaction_{transaction_id}"),
+            _ADMIN_CANCEL_BUTTON
+        ]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await _safe_edit(query,
+        f"⚠️ Вы уверены, что хотите удалить эту транзакцию?\n\n"
+        f"Это действие не может быть отменено!",
+        reply_markup=reply_markup
+    )
+    return ConversationHandler.END
+
+async def _on_confirm_delete_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE, query,
+                                         transaction_id: int) -> int:
+    """Удаление транзакции после подтверждения (только для администраторов)."""
+    # Действие только для администраторов: проверяем права до обращения к БД
+    if not await _require_admin(update, context):
         return ConversationHandler.END
     
+    # Удаляем транзакцию
+    success, message = delete_transaction(transaction_id)
+    
+    if success:
+        await _safe_edit(query,
+            f"✅ {message}"
+        )
+    else:
+        await _safe_edit(query,
+            f"❌ {message}"
+        )
     return ConversationHandler.END
 
+# Обработчики кнопок без параметров, ищутся по data целиком.
+_BUTTON_ACTIONS = {
+    "participants_all": _on_participants_all,
+    "participants_done": _on_participants_done,
+    "expense_photo_yes": _on_expense_photo_yes,
+    "expense_photo_no": _on_expense_photo_no,
+    "send_confirm": _on_send_confirm,
+    "send_cancel": _on_send_cancel,
+    "setup_rules_yes": _on_setup_rules_yes,
+    "setup_rules_no": _on_setup_rules_no,
+    "reset_confirm": _on_reset_confirm,
+    "reset_cancel": _on_reset_cancel,
+}
+
+# Обработчики кнопок с ID последним сегментом ("confirm_transaction_42"): ищутся по
+# префиксу, ID разбирается один раз в button_callback и передается аргументом.
+_BUTTON_ID_ACTIONS = {
+    "participant": _on_participant_toggle,
+    "confirm_transaction": _on_confirm_transaction,
+    "reject_transaction": _on_reject_transaction,
+    "send_to": _on_send_to,
+    "edit_expense": _on_edit_expense,
+    "delete_expense": _on_delete_expense,
+    "confirm_delete_expense": _on_confirm_delete_expense,
+    "delete_transaction": _on_delete_transaction,
+    "confirm_delete_transaction": _on_confirm_delete_transaction,
+}
+
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Обработка нажатий на кнопки."""
+    query = update.callback_query
+    await query.answer()
+    
+    data = query.data
+    action = _BUTTON_ACTIONS.get(data)
+    if action is not None:
+        return await action(update, context, query)
+    
+    prefix, _, item_id = data.rpartition("_")
+    action = _BUTTON_ID_ACTIONS.get(prefix)
+    item_id = _parse_int(item_id)
+    if action is None or item_id is None:
+        return ConversationHandler.END
+    return await action(update, context, query, item_id)
+
 async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработка загрузки фото чека."""
     if 'expense_amount' not in context.user_data or 'expense_description' not in context.user_data:
-        await update.message.reply_text(
+        await _tg_call(update.effective_chat.id, update.message.reply_text,
             "Сначала начните добавление расхода с команды /addexpense"
         )
         return ConversationHandler.END
@@ -2587,7 +2701,7 @@ async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     chat_id = update.effective_chat.id
     
     # Используем выбранных участников, если они есть
-    participants = context.user_data.get('selected_participants')
+    participants = _selected_participants(context.user_data)
     
     success, result = handle_new_expense(
         chat_id,
@@ -2610,57 +2724,38 @@ async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         
         # Если были выбраны участники, покажем их в сообщении
         if participants:
-            participants_text = ""
-            for user_id in participants:
-                user = get_user(user_id)
-                if user:
-                    name = user.get('username', user.get('first_name', str(user_id)))
-                    participants_text += f"@{name}, "
+            users = _participant_users(context.user_data)
+            names = [
+                "@" + (participant['username'] or participant['first_name'] or str(participant_id))
+                for participant_id in participants
+                if (participant := users.get(participant_id))
+            ]
             
-            if participants_text:
-                success_message += f"\nУчастники: {participants_text[:-2]}"
+            if names:
+                success_message += f"\nУчастники: {', '.join(names)}"
         
         # Отправляем сообщение об успешном добавлении
-        reply_message = await update.message.reply_text(success_message)
+        reply_message = await _tg_call(chat_id, update.message.reply_text, success_message)
         
-        # Планируем удаление сообщений
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat_id,
-            message_id=reply_message.message_id
-        )
-        
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat_id,
-            message_id=update.message.message_id
-        )
-    else:
-        # Сообщение об ошибке
-        error_message = f"❌ Ошибка: {result}"
-        reply_message = await update.message.reply_text(error_message)
-        
-        # Планируем удаление сообщений
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat_id,
-            message_id=reply_message.message_id
-        )
+        # Планируем удаление ответа и фото одной задачей
+        await schedule_messages_deletion(context, chat_id, [reply_message.message_id, update.message.message_id])
+    else:
+        # Сообщение об ошибке
+        error_message = f"❌ Ошибка: {result}"
+        reply_message = await _tg_call(chat_id, update.message.reply_text, error_message)
         
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat_id,
-            message_id=update.message.message_id
-        )
+        # Планируем удаление ответа и фото одной задачей
+        await schedule_messages_deletion(context, chat_id, [reply_message.message_id, update.message.message_id])
     
     # Очистка данных
-    for key in ['expense_amount', 'expense_description', 'expense_file_id', 
-               'all_participants', 'selected_participants']:
-        if key in context.user_data:
-            del context.user_data[key]
+    _clear_user_data(context.user_data, _EXPENSE_DRAFT_KEYS)
     
     return ConversationHandler.END
 
+# Шаблоны списка ожидающих переводов в ответе /mydebt
+_PENDING_TRANSFERS_HEADER = "\n\n*У вас есть ожидающие подтверждения переводы:*\n"
+_PENDING_TRANSFER_LINE = "- {:.2f} руб. от @{}\n"
+
 async def my_debt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle the /mydebt command."""
     user = update.effective_user
@@ -2668,24 +2763,15 @@ async def my_debt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = update.message
     
     # Save user info
-    save_user(user.id, user.username, user.first_name, user.last_name)
+    _save_user_cached(user)
     
     # Check if in group chat
-    if chat.type not in ['group', 'supergroup']:
-        reply = await message.reply_text(
+    if chat.type not in _GROUP_TYPES:
+        reply = await _tg_call(chat.id, message.reply_text,
             "Эта команда работает только в группах."
         )
-        # Планируем удаление сообщений
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat.id,
-            message_id=reply.message_id
-        )
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat.id,
-            message_id=message.message_id
-        )
+        # Планируем удаление ответа и команды
+        await schedule_messages_deletion(context, chat.id, [reply.message_id, message.message_id])
         return
     
     # Get and format user's debt message
@@ -2698,13 +2784,13 @@ async def my_debt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     messages_to_delete = []
     
     if pending_transactions:
-        debt_message += "\n\n*У вас есть ожидающие подтверждения переводы:*\n"
+        parts = [debt_message, _PENDING_TRANSFERS_HEADER]
         
         for transaction in pending_transactions:
-            sender = get_user(transaction['sender_id'])
-            sender_name = sender.get('username', sender.get('first_name', 'Unknown'))
+            # Имя отправителя уже получено запросом (JOIN с users)
+            sender_name = transaction['sender_username'] or transaction['sender_first_name'] or 'Unknown'
             
-            debt_message += (f"- {transaction['amount']:.2f} руб. от @{sender_name}\n")
+            parts.append(_PENDING_TRANSFER_LINE.format(transaction['amount'], sender_name))
             
             # Add confirmation buttons
             keyboard = [
@@ -2717,30 +2803,21 @@ async def my_debt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            tx_message = await message.reply_text(
+            tx_message = await _tg_call(chat.id, message.reply_text,
                 f"Перевод от @{sender_name} на сумму {transaction['amount']:.2f} руб.",
                 reply_markup=reply_markup
             )
             messages_to_delete.append(tx_message.message_id)
     
+        debt_message = "".join(parts)
+    
     # Отправляем основное сообщение с долгами
-    debt_reply = await message.reply_markdown(debt_message)
+    debt_reply = await _tg_call(chat.id, message.reply_markdown, debt_message)
     messages_to_delete.append(debt_reply.message_id)
     
-    # Планируем удаление всех сообщений через 5 минут
-    for msg_id in messages_to_delete:
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat.id,
-            message_id=msg_id
-        )
-    
-    # Также планируем удаление команды от пользователя
-    await schedule_message_deletion(
-        context=context,
-        chat_id=chat.id,
-        message_id=message.message_id
-    )
+    # Планируем удаление всех сообщений и команды пользователя через 5 минут
+    messages_to_delete.append(message.message_id)
+    await schedule_messages_deletion(context, chat.id, messages_to_delete)
 
 async def report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle the /report command."""
@@ -2749,141 +2826,121 @@ async def report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = update.message
     
     # Save user info
-    save_user(user.id, user.username, user.first_name, user.last_name)
+    _save_user_cached(user)
     
     # Список сообщений для планирования удаления
     messages_to_delete = []
     
     # Check if in group chat
-    if chat.type not in ['group', 'supergroup']:
-        reply = await message.reply_text(
+    if chat.type not in _GROUP_TYPES:
+        reply = await _tg_call(chat.id, message.reply_text,
             "Эта команда работает только в группах."
         )
-        # Планируем удаление сообщений
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat.id,
-            message_id=reply.message_id
-        )
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat.id,
-            message_id=message.message_id
-        )
+        # Планируем удаление ответа и команды
+        await schedule_messages_deletion(context, chat.id, [reply.message_id, message.message_id])
         return
     
     # Check if user is admin (only admins can generate reports)
     if not await is_admin(update, context):
-        reply = await message.reply_text(
+        reply = await _tg_call(chat.id, message.reply_text,
             "Только администраторы могут генерировать отчеты."
         )
-        # Планируем удаление сообщений
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat.id,
-            message_id=reply.message_id
-        )
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat.id,
-            message_id=message.message_id
-        )
+        # Планируем удаление ответа и команды
+        await schedule_messages_deletion(context, chat.id, [reply.message_id, message.message_id])
         return
     
-    # Сообщение о процессе генерации - планируем удалить после завершения
-    process_msg = await message.reply_text("Генерирую отчеты, пожалуйста подождите...")
-    messages_to_delete.append(process_msg.message_id)
-    
     # Добавляем сообщение о процессе для отладки
     logger.info(f"Начало генерации отчетов для группы {chat.id}")
     
-    # Generate Excel report
-    try:
-        excel_report = generate_excel_report(chat.id)
-        if excel_report:
-            # Отправляем Excel отчет - отчеты НЕ планируем удалять автоматически
-            await message.reply_document(
-                document=excel_report,
-                filename=f"expenses_report_{chat.id}.xlsx",
-                caption="Отчет о расходах (Excel)"
-            )
-            logger.info(f"Excel отчет успешно создан и отправлен для группы {chat.id}")
-        else:
-            error_msg = await message.reply_text(
-                "Не удалось создать Excel отчет. Проверьте логи для подробностей."
+    # Оба отчета строятся параллельно в пуле потоков, пока отправляется сообщение
+    # о процессе генерации (его планируем удалить после завершения)
+    process_msg, (excel_report, pdf_report) = await asyncio.gather(
+        _tg_call(chat.id, message.reply_text, "Генерирую отчеты, пожалуйста подождите..."),
+        _build_reports(chat.id)
+    )
+    messages_to_delete.append(process_msg.message_id)
+    
+    # Оба отчета загружаем в Telegram параллельно
+    async def send_excel() -> None:
+        try:
+            if excel_report:
+                # Отправляем Excel отчет - отчеты НЕ планируем удалять автоматически
+                await _tg_call(chat.id, message.reply_document,
+                    document=excel_report,
+                    filename=f"expenses_report_{chat.id}.xlsx",
+                    caption="Отчет о расходах (Excel)"
+                )
+                logger.info(f"Excel отчет успешно создан и отправлен для группы {chat.id}")
+            else:
+                error_msg = await _tg_call(chat.id, message.reply_text,
+                    "Не удалось создать Excel отчет. Проверьте логи для подробностей."
+                )
+                messages_to_delete.append(error_msg.message_id)
+                logger.error(f"Ошибка при создании Excel отчета для группы {chat.id}: пустой результат")
+        except Exception as e:
+            error_msg = await _tg_call(chat.id, message.reply_text,
+                f"Ошибка при отправке Excel отчета: {str(e)[:100]}..."
             )
             messages_to_delete.append(error_msg.message_id)
-            logger.error(f"Ошибка при создании Excel отчета для группы {chat.id}: пустой результат")
-    except Exception as e:
-        error_msg = await message.reply_text(
-            f"Ошибка при отправке Excel отчета: {str(e)[:100]}..."
-        )
-        messages_to_delete.append(error_msg.message_id)
-        logger.error(f"Ошибка при отправке Excel отчета для группы {chat.id}: {e}")
-        logger.exception(e)
+            logger.error(f"Ошибка при отправке Excel отчета для группы {chat.id}: {e}")
+            logger.exception(e)
     
-    # Generate PDF report
-    try:
-        logger.info(f"Начало генерации PDF отчета для группы {chat.id}")
-        pdf_report = generate_pdf_report(chat.id)
-        
-        if pdf_report:
-            logger.info(f"PDF отчет создан, размер: {pdf_report.getbuffer().nbytes} байт")
-            try:
-                # Отправляем PDF отчет - отчеты НЕ планируем удалять автоматически
-                await message.reply_document(
-                    document=pdf_report,
-                    filename=f"expenses_report_{chat.id}.pdf",
-                    caption="Отчет о расходах (PDF)"
-                )
-                logger.info(f"PDF отчет успешно отправлен для группы {chat.id}")
-            except Exception as send_err:
-                error_msg = await message.reply_text(
-                    f"PDF отчет был создан, но произошла ошибка при отправке: {str(send_err)[:100]}..."
+    async def send_pdf() -> None:
+        try:
+            if pdf_report:
+                logger.info(f"PDF отчет создан, размер: {pdf_report.getbuffer().nbytes} байт")
+                try:
+                    # Отправляем PDF отчет - отчеты НЕ планируем удалять автоматически
+                    await _tg_call(chat.id, message.reply_document,
+                        document=pdf_report,
+                        filename=f"expenses_report_{chat.id}.pdf",
+                        caption="Отчет о расходах (PDF)"
+                    )
+                    logger.info(f"PDF отчет успешно отправлен для группы {chat.id}")
+                except Exception as send_err:
+                    error_msg = await _tg_call(chat.id, message.reply_text,
+                        f"PDF отчет был создан, но произошла ошибка при отправке: {str(send_err)[:100]}..."
+                    )
+                    messages_to_delete.append(error_msg.message_id)
+                    logger.error(f"Ошибка при отправке PDF для группы {chat.id}: {send_err}")
+            else:
+                error_msg = await _tg_call(chat.id, message.reply_text,
+                    "Не удалось создать PDF отчет. Проверьте логи для подробностей."
                 )
                 messages_to_delete.append(error_msg.message_id)
-                logger.error(f"Ошибка при отправке PDF для группы {chat.id}: {send_err}")
-        else:
-            error_msg = await message.reply_text(
-                "Не удалось создать PDF отчет. Проверьте логи для подробностей."
+                logger.error(f"Ошибка при создании PDF отчета для группы {chat.id}: пустой результат")
+        except Exception as e:
+            error_msg = await _tg_call(chat.id, message.reply_text,
+                f"Ошибка при создании PDF отчета: {str(e)[:100]}..."
             )
             messages_to_delete.append(error_msg.message_id)
-            logger.error(f"Ошибка при создании PDF отчета для группы {chat.id}: пустой результат")
-    except Exception as e:
-        error_msg = await message.reply_text(
-            f"Ошибка при создании PDF отчета: {str(e)[:100]}..."
-        )
-        messages_to_delete.append(error_msg.message_id)
-        logger.error(f"Ошибка при создании PDF отчета для группы {chat.id}: {e}")
-        logger.exception(e)
+            logger.error(f"Ошибка при создании PDF отчета для группы {chat.id}: {e}")
+            logger.exception(e)
     
-    # Планируем удаление всех информационных и ошибочных сообщений
-    for msg_id in messages_to_delete:
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat.id,
-            message_id=msg_id
-        )
+    await asyncio.gather(send_excel(), send_pdf())
     
-    # Планируем удаление исходной команды
-    await schedule_message_deletion(
-        context=context,
-        chat_id=chat.id,
-        message_id=message.message_id
-    )
+    # Планируем удаление всех информационных и ошибочных сообщений и исходной команды
+    messages_to_delete.append(message.message_id)
+    await schedule_messages_deletion(context, chat.id, messages_to_delete)
 
-async def handle_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+# Незавершенные представления новых участников: (chat_id, user_id) -> введенное имя
+# (None, пока ждем имя). Отвечать может только сам участник: ключ совпадает с
+# отправителем сообщения, поэтому тексты добавившего его администратора не подходят.
+# Запись живет MESSAGE_DELETE_AFTER секунд с последнего шага - потом представление отменяется
+_pending_intros: TTLCache = TTLCache(STATE_CACHE_MAXSIZE, MESSAGE_DELETE_AFTER)
+
+async def handle_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка новых участников группы - запрос на представление."""
     chat = update.effective_chat
     new_members = update.message.new_chat_members
-    bot_id = context.bot.id
+    bot_id = get_bot_id(context)
     
     # Проверяем, что это групповой чат
-    if chat.type not in ['group', 'supergroup']:
-        return ConversationHandler.END
+    if chat.type not in _GROUP_TYPES:
+        return
     
     # Сохраняем информацию о группе
-    save_group(chat.id, chat.title)
+    _save_group_cached(chat)
     
     # Обрабатываем каждого нового участника
     for member in new_members:
@@ -2892,10 +2949,11 @@ async def handle_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE)
             continue
             
         # Сохраняем базовую информацию о пользователе
-        save_user(member.id, member.username, member.first_name, member.last_name)
+        _save_user_cached(member)
         
-        # Добавляем пользователя в группу
-        add_user_to_group(chat.id, member.id)
+        # Добавляем пользователя в группу и запоминаем это для _register_chat_admins
+        if await asyncio.to_thread(add_user_to_group, chat.id, member.id):
+            _registered_group_members[(chat.id, member.id)] = True
         
         # Запрашиваем представление от всех новых пользователей, независимо от данных профиля
         # Приветствуем пользователя и запрашиваем его имя и фамилию
@@ -2907,76 +2965,46 @@ async def handle_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE)
             reply_to_message_id=update.message.message_id
         )
         
-        # Сохраняем id пользователя, которого нужно представить
-        context.user_data['intro_user_id'] = member.id
-        context.user_data['waiting_for_name'] = True
-        
-        # Создаем обработчик диалога
-        user_intro_handler = ConversationHandler(
-            entry_points=[MessageHandler(filters.TEXT & ~filters.COMMAND, user_intro_name_step)],
-            states={
-                USER_INTRO_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, user_intro_name_step)],
-                USER_INTRO_LASTNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, user_intro_lastname_step)],
-            },
-            fallbacks=[CommandHandler("cancel", lambda u, c: ConversationHandler.END)],
-            per_chat=True,
-            per_user=True,
-            name="user_intro_conversation"
-        )
-        
-        # Добавляем обработчик
-        context.application.add_handler(user_intro_handler)
-        
-        return USER_INTRO_NAME
-    
-    return ConversationHandler.END
-
-async def user_intro_name_step(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обработка ввода имени при представлении нового участника."""
-    # Сохраняем имя
-    name = update.message.text.strip()
-    context.user_data['intro_name'] = name
-    context.user_data['waiting_for_name'] = False
-    context.user_data['waiting_for_lastname'] = True
-    
-    await update.message.reply_text(
-        f"Спасибо, {name}! Теперь введите вашу фамилию:"
-    )
-    
-    return USER_INTRO_LASTNAME
+        # Ответы участника принимает user_intro_step
+        _pending_intros[(chat.id, member.id)] = None
 
-async def user_intro_lastname_step(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обработка ввода фамилии при представлении нового участника."""
-    # Сохраняем фамилию
-    lastname = update.message.text.strip()
-    name = context.user_data.get('intro_name', '')
-    user_id = context.user_data.get('intro_user_id')
+async def user_intro_step(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Принимает имя или фамилию участника, которому предложено представиться.
     
-    if user_id:
-        # Обновляем информацию о пользователе, сохраняя имя и фамилию
-        # Не обновляем username, оставляя None, чтобы не затереть существующее значение
-        save_user(user_id, None, name, lastname)
-        
+    Вызывается для текста, который не забрали диалоги и ожидающие состояния
+    (см. handle_pending_state). Возвращает False, если отправитель не представляется.
+    """
+    key = (update.effective_chat.id, update.effective_user.id)
+    name = _pending_intros.get(key, _NO_INTRO)
+    if name is _NO_INTRO:
+        return False
+    
+    text = update.message.text.strip()
+    if name is None:
+        # Сохраняем имя; запись продлевается, пока участник отвечает
+        _pending_intros[key] = text
         await update.message.reply_text(
-            f"Спасибо за представление, {name} {lastname}! "
-            f"Теперь вы полноправный участник группы и можете пользоваться всеми функциями бота. "
-            f"Отправьте /help для получения списка доступных команд."
+            f"Спасибо, {text}! Теперь введите вашу фамилию:"
         )
-    else:
-        # Если по какой-то причине user_id не сохранился
-        await update.message.reply_text(
-            f"Спасибо за представление, {name} {lastname}! "
+        return True
+    
+    # Фамилия получена - представление завершено
+    _pending_intros.pop(key, None)
+    user_id = update.effective_user.id
+    # Обновляем информацию о пользователе, сохраняя имя и фамилию
+    # Не обновляем username, оставляя None, чтобы не затереть существующее значение
+    # Запись в БД идет в потоке, параллельно с ответом пользователю
+    _pending_user_saves.pop(user_id, None)
+    await asyncio.gather(
+        asyncio.to_thread(save_user, user_id, None, name, text),
+        update.message.reply_text(
+            f"Спасибо за представление, {name} {text}! "
             f"Теперь вы полноправный участник группы и можете пользоваться всеми функциями бота. "
             f"Отправьте /help для получения списка доступных команд."
         )
-    
-    # Очищаем данные
-    context.user_data.pop('waiting_for_lastname', None)
-    context.user_data.pop('waiting_for_name', None)
-    context.user_data.pop('intro_name', None)
-    context.user_data.pop('intro_user_id', None)
-    
-    return ConversationHandler.END
+    )
+    _saved_users.pop(user_id, None)
+    return True
 
 async def send_money(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработка команды /send для отправки денег другому пользователю."""
@@ -2984,35 +3012,29 @@ async def send_money(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     chat = update.effective_chat
     message = update.message
     
-    # Регистрируем незавершенную операцию
-    await register_pending_operation(
+    # Регистрируем незавершенную операцию; повторная /send сразу после первой
+    # (двойное нажатие) не запускает второй диалог и запросы к API и БД
+    if not await register_pending_operation(
         user_id=user.id,
         operation_type="send_money",
         chat_id=chat.id,
-        message_id=message.message_id
-    )
+        message_id=message.message_id,
+        reject_duplicate=True
+    ):
+        await schedule_message_deletion(context, chat.id, message.message_id)
+        return ConversationHandler.END
     
     # Сохраняем информацию о пользователе
-    save_user(user.id, user.username, user.first_name, user.last_name)
+    _save_user_cached(user)
     
     # Проверяем, что команда вызвана в групповом чате
-    if chat.type not in ['group', 'supergroup']:
+    if chat.type not in _GROUP_TYPES:
         reply = await message.reply_text(
             "Эта команда работает только в группах."
         )
         
         # Планируем удаление сообщений
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat.id,
-            message_id=reply.message_id
-        )
-        
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat.id,
-            message_id=message.message_id
-        )
+        await schedule_messages_deletion(context, chat.id, [reply.message_id, message.message_id])
         
         # Отмечаем операцию как завершенную
         await complete_pending_operation(user.id)
@@ -3020,22 +3042,14 @@ async def send_money(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return ConversationHandler.END
         
     # Добавляем текущего пользователя в группу и сохраняем группу
-    logger.info(f"Saving group {chat.id} ({chat.title}) and adding user {user.id}")
-    save_group(chat.id, chat.title)
-    add_user_to_group(chat.id, user.id)
-    
-    # Добавляем всех видимых участников чата в группу
-    chat_members = await context.bot.get_chat_administrators(chat.id)
-    logger.info(f"Found {len(chat_members)} admins in chat {chat.id}")
+    logger.info("Saving group %s (%s) and adding user %s", chat.id, chat.title, user.id)
+    _save_group_cached(chat)
     
-    for member in chat_members:
-        member_user = member.user
-        logger.info(f"Adding admin {member_user.id} (@{member_user.username}) to group {chat.id}")
-        save_user(member_user.id, member_user.username, member_user.first_name, member_user.last_name)
-        add_user_to_group(chat.id, member_user.id)
+    # Добавляем пользователя и всех видимых участников чата в группу
+    register_admins = _register_chat_admins(context, chat, user.id)
     
     # Разбираем аргументы команды, если они предоставлены
-    if context.args and len(context.args) >= 2:
+    if context.args:
         username, amount = extract_username_and_amount(context.args)
         
         if username and amount:
@@ -3043,60 +3057,34 @@ async def send_money(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             context.user_data['send_username'] = username
             context.user_data['send_amount'] = amount
             
-            # Создаем кнопки для подтверждения или отмены перевода
-            keyboard = [
-                [
-                    InlineKeyboardButton("Подтвердить", callback_data="send_confirm"),
-                    InlineKeyboardButton("Отменить", callback_data="send_cancel"),
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await update.message.reply_text(
-                f"Вы собираетесь отправить {amount} руб. пользователю @{username}. "
-                f"Подтвердите операцию:",
-                reply_markup=reply_markup
+            # Запрос подтверждения не зависит от регистрации администраторов,
+            # поэтому оба запроса к Bot API идут параллельно
+            await asyncio.gather(
+                register_admins,
+                update.message.reply_text(
+                    f"Вы собираетесь отправить {amount} руб. пользователю @{username}. "
+                    f"Подтвердите операцию:",
+                    reply_markup=_SEND_CONFIRM_KB
+                )
             )
             
             return SEND_CONFIRM
     
+    # Список получателей должен включать только что добавленных администраторов
+    await register_admins
+    
     # Получаем список участников группы для выбора
-    logger.info(f"Getting group members in send_money command. Chat ID: {chat.id}")
-    members = get_group_members(chat.id)
-    logger.info(f"Found {len(members) if members else 0} members for chat {chat.id} in send_money: {members}")
-    
-    if members and len(members) > 1:
-        # Создаем кнопки для каждого участника
-        keyboard = []
-        for member in members:
-            # Пропускаем текущего пользователя
-            if member['user_id'] == user.id:
-                continue
-                
-            # Формируем отображаемое имя
-            first_name = member.get('first_name', '')
-            last_name = member.get('last_name', '')
-            username = member.get('username', '')
-            user_id = member['user_id']
-            
-            # Создаем текст кнопки (ID + имя/юзернейм)
-            if first_name and last_name:
-                display_name = f"{first_name} {last_name}"
-            elif username:
-                display_name = f"@{username}"
-            else:
-                display_name = f"ID: {user_id}"
-                
-            # Добавляем кнопку
-            keyboard.append([InlineKeyboardButton(
-                display_name, 
-                callback_data=f"send_to_{user_id}"
-            )])
-        
-        # Добавляем кнопку отмены
-        keyboard.append([InlineKeyboardButton("Отмена", callback_data="send_cancel")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    logger.info("Getting group members in send_money command. Chat ID: %s", chat.id)
+    recipients = await asyncio.to_thread(
+        get_group_members, chat.id, exclude_user_ids=(user.id,), fields=MEMBER_FIELDS)
+    logger.info("Found %d recipients for chat %s in send_money", len(recipients), chat.id)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Recipients in chat %s: %s", chat.id, recipients)
+    
+    if recipients:
+        # Кнопки для каждого участника, кроме текущего пользователя (его исключает
+        # запрос), и кнопка отмены
+        reply_markup = _recipient_keyboard(recipients)
         
         await update.message.reply_text(
             "Выберите пользователя, которому хотите отправить деньги:",
@@ -3109,7 +3097,7 @@ async def send_money(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         await update.message.reply_text(
             "Кому вы хотите отправить деньги? Введите @username:"
         )
-        context.user_data['waiting_for_send_username'] = True
+        _set_waiting(context.user_data, PS_SEND_USERNAME, True)
         
         return SEND_AMOUNT
 
@@ -3117,11 +3105,8 @@ async def send_amount_step(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     """Обработка ввода имени пользователя при отправке денег."""
     message = update.message
     chat_id = update.effective_chat.id
-    username = message.text.strip()
-    
     # Извлекаем имя пользователя без символа @
-    if username.startswith('@'):
-        username = username[1:]
+    username = message.text.strip().removeprefix('@')
     
     context.user_data['send_username'] = username
     
@@ -3130,21 +3115,22 @@ async def send_amount_step(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         f"Сколько вы хотите отправить пользователю @{username}? Введите сумму:"
     )
     
-    # Планируем удаление введенного пользователем имени
-    await schedule_message_deletion(
-        context=context,
-        chat_id=chat_id,
-        message_id=message.message_id
-    )
-    
-    # Запрос суммы будет удален, когда пользователь введет сумму
-    await schedule_message_deletion(
-        context=context,
-        chat_id=chat_id,
-        message_id=reply.message_id,
-        user_id=update.effective_user.id,
-        operation_type="send_amount",
-        extend_if_pending=True
+    # Планируем удаление введенного пользователем имени и запроса суммы
+    # (он будет удален, когда пользователь введет сумму)
+    await asyncio.gather(
+        schedule_message_deletion(
+            context=context,
+            chat_id=chat_id,
+            message_id=message.message_id
+        ),
+        schedule_message_deletion(
+            context=context,
+            chat_id=chat_id,
+            message_id=reply.message_id,
+            user_id=update.effective_user.id,
+            operation_type="send_amount",
+            extend_if_pending=True
+        )
     )
     
     return SEND_CONFIRM
@@ -3155,138 +3141,83 @@ async def send_confirm_step(update: Update, context: ContextTypes.DEFAULT_TYPE)
     chat_id = update.effective_chat.id
     user = update.effective_user
     
-    try:
-        amount = float(message.text.replace(',', '.'))
-        if amount <= 0:
-            error_msg = await message.reply_text(
-                "Сумма должна быть положительным числом. Попробуйте снова:"
-            )
-            
-            # Планируем удаление сообщения об ошибке и введенной пользователем суммы
-            await schedule_message_deletion(
-                context=context,
-                chat_id=chat_id,
-                message_id=error_msg.message_id
-            )
-            await schedule_message_deletion(
-                context=context,
-                chat_id=chat_id,
-                message_id=message.message_id
-            )
-            
-            return SEND_CONFIRM
+    amount = _parse_amount(message.text)
+    if amount is None:
+        error_msg = await message.reply_text(
+            "Неверный формат суммы. Введите число:"
+        )
         
-        context.user_data['send_amount'] = amount
-        username = context.user_data['send_username']
+        # Планируем удаление сообщений
+        await schedule_messages_deletion(context, chat_id, [error_msg.message_id, message.message_id])
         
-        # Отмечаем операцию как завершенную
-        await complete_pending_operation(user.id)
+        return SEND_CONFIRM
+    
+    if amount <= 0:
+        error_msg = await message.reply_text(
+            "Сумма должна быть положительным числом. Попробуйте снова:"
+        )
         
-        # Создание транзакции
-        # Находим пользователя по имени пользователя
-        user_by_name = None
-        members = get_group_members(chat_id)
+        # Планируем удаление сообщения об ошибке и введенной пользователем суммы
+        await schedule_messages_deletion(context, chat_id, [error_msg.message_id, message.message_id])
         
-        if members:
-            for member in members:
-                if member.get('username') == username:
-                    user_by_name = member
-                    break
+        return SEND_CONFIRM
+    
+    context.user_data['send_amount'] = amount
+    username = context.user_data['send_username']
+    
+    # Отмечаем операцию как завершенную
+    await complete_pending_operation(user.id)
+    
+    # Создание транзакции
+    # Находим участника группы по имени пользователя
+    user_by_name = get_group_member_by_username(chat_id, username)
+    
+    if user_by_name:
+        receiver_id = user_by_name['user_id']
+        success, result = handle_money_transfer(
+            chat_id, user.id, receiver_id, amount
+        )
         
-        if user_by_name:
-            receiver_id = user_by_name['user_id']
-            success, result = handle_money_transfer(
-                chat_id, user.id, receiver_id, amount
+        if success:
+            success_msg = await message.reply_text(
+                f"✅ Запрос на перевод {amount} руб. пользователю @{username} отправлен. "
+                f"Ожидайте подтверждения от получателя."
             )
             
-            if success:
-                success_msg = await message.reply_text(
-                    f"✅ Запрос на перевод {amount} руб. пользователю @{username} отправлен. "
-                    f"Ожидайте подтверждения от получателя."
-                )
-                
-                # Планируем удаление сообщений
-                await schedule_message_deletion(
-                    context=context,
-                    chat_id=chat_id,
-                    message_id=success_msg.message_id
-                )
-                await schedule_message_deletion(
-                    context=context,
-                    chat_id=chat_id,
-                    message_id=message.message_id
-                )
-            else:
-                error_msg = await message.reply_text(
-                    f"❌ Ошибка: {result}"
-                )
-                
-                # Планируем удаление сообщений
-                await schedule_message_deletion(
-                    context=context,
-                    chat_id=chat_id,
-                    message_id=error_msg.message_id
-                )
-                await schedule_message_deletion(
-                    context=context,
-                    chat_id=chat_id,
-                    message_id=message.message_id
-                )
+            # Планируем удаление сообщений
+            await schedule_messages_deletion(context, chat_id, [success_msg.message_id, message.message_id])
         else:
-            # Пользователь не найден, просто показываем подтверждение
-            not_found_msg = await message.reply_text(
-                f"⚠️ Пользователь @{username} не найден в текущей группе, "
-                f"но запрос на перевод {amount} руб. отправлен. "
-                f"Обратитесь к пользователю для завершения транзакции."
+            error_msg = await message.reply_text(
+                f"❌ Ошибка: {result}"
             )
             
             # Планируем удаление сообщений
-            await schedule_message_deletion(
-                context=context,
-                chat_id=chat_id,
-                message_id=not_found_msg.message_id
-            )
-            await schedule_message_deletion(
-                context=context,
-                chat_id=chat_id,
-                message_id=message.message_id
-            )
-        
-        # Очистка данных пользователя
-        context.user_data.pop('send_username', None)
-        context.user_data.pop('send_amount', None)
-        context.user_data.pop('send_receiver_id', None)
-        context.user_data.pop('send_receiver_name', None)
-        context.user_data.pop('waiting_for_send_amount', None)
-        context.user_data.pop('waiting_for_send_username', None)
-        
-        return ConversationHandler.END
-    except ValueError:
-        error_msg = await message.reply_text(
-            "Неверный формат суммы. Введите число:"
+            await schedule_messages_deletion(context, chat_id, [error_msg.message_id, message.message_id])
+    else:
+        # Пользователь не найден, просто показываем подтверждение
+        not_found_msg = await message.reply_text(
+            f"⚠️ Пользователь @{username} не найден в текущей группе, "
+            f"но запрос на перевод {amount} руб. отправлен. "
+            f"Обратитесь к пользователю для завершения транзакции."
         )
         
         # Планируем удаление сообщений
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat_id,
-            message_id=error_msg.message_id
-        )
-        await schedule_message_deletion(
-            context=context,
-            chat_id=chat_id,
-            message_id=message.message_id
-        )
-        
-        return SEND_CONFIRM
+        await schedule_messages_deletion(context, chat_id, [not_found_msg.message_id, message.message_id])
+    
+    # Очистка данных пользователя
+    _clear_user_data(context.user_data, _SEND_DRAFT_KEYS)
+    _set_waiting(context.user_data, PS_SEND_AMOUNT, False)
+    _set_waiting(context.user_data, PS_SEND_USERNAME, False)
+    
+    return ConversationHandler.END
 
 # Настройка обработчиков диалога
 rules_conversation_handler = ConversationHandler(
     entry_points=[CommandHandler("rules", rules)],
     states={
-        RULES_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, rules_description)],
-        RULES_DEADLINE: [MessageHandler(filters.TEXT & ~filters.COMMAND, rules_deadline)],
-        RULES_NOTIFICATIONS: [MessageHandler(filters.TEXT & ~filters.COMMAND, rules_notifications)],
+        RULES_DESCRIPTION: [MessageHandler(TEXT_NOT_COMMAND, rules_description)],
+        RULES_DEADLINE: [MessageHandler(TEXT_NOT_COMMAND, rules_deadline)],
+        RULES_NOTIFICATIONS: [MessageHandler(TEXT_NOT_COMMAND, rules_notifications)],
     },
     fallbacks=[CommandHandler("cancel", lambda u, c: ConversationHandler.END)],
     per_chat=True,
@@ -3294,27 +3225,46 @@ rules_conversation_handler = ConversationHandler(
     per_message=False
 )
 
+# Кнопка меню помощи - точка входа диалога с per_message=False. Так и задумано: после
+# нажатия пользователь отвечает текстом, поэтому диалог ведется по чату и пользователю,
+# а не по сообщению с кнопкой. Предупреждение PTB об этом при создании диалога отключаем
+warnings.filterwarnings(
+    "ignore",
+    message="If 'per_message=False', 'CallbackQueryHandler' will not be tracked",
+    category=PTBUserWarning,
+    module=__name__
+)
+
+# Таймаут диалога: conversation_timeout требует JobQueue (extra job-queue), которой
+# в зависимостях нет. Вместо него состояния суммы и описания завершают диалог, если
+# операция "expense_add" прервана по неактивности (см. _expense_operation_active)
 expense_conversation_handler = ConversationHandler(
-    entry_points=[CommandHandler("addexpense", add_expense)],
+    entry_points=[
+        CommandHandler("addexpense", add_expense),
+        # Сумму, введенную после кнопки меню помощи, принимает состояние EXPENSE_AMOUNT,
+        # а не глобальный обработчик текста
+        CallbackQueryHandler(help_add_expense_callback, pattern=r"^help_addexpense$"),
+    ],
     states={
-        EXPENSE_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, expense_amount)],
-        EXPENSE_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, expense_description)],
+        EXPENSE_AMOUNT: [MessageHandler(TEXT_NOT_COMMAND, expense_amount)],
+        EXPENSE_DESCRIPTION: [MessageHandler(TEXT_NOT_COMMAND, expense_description)],
         EXPENSE_PARTICIPANTS: [],  # Обрабатывается глобальными обработчиками в main.py
         EXPENSE_PHOTO: [MessageHandler(filters.PHOTO, photo_handler)],  # Только обработка фото
-        EDIT_EXPENSE_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, 
-                                           lambda update, context: handle_pending_state(update, context))],
+        EDIT_EXPENSE_AMOUNT: [MessageHandler(TEXT_NOT_COMMAND, handle_pending_state)],
     },
     fallbacks=[CommandHandler("cancel", lambda u, c: ConversationHandler.END)],
     per_chat=True,
     per_user=True,
+    # Новое добавление расхода (командой или кнопкой) начинает диалог заново
+    allow_reentry=True,
     name="expense_conversation"  # Для отладки
 )
 
 send_conversation_handler = ConversationHandler(
     entry_points=[CommandHandler("send", send_money)],
     states={
-        SEND_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, send_amount_step)],
-        SEND_CONFIRM: [MessageHandler(filters.TEXT & ~filters.COMMAND, send_confirm_step)],
+        SEND_AMOUNT: [MessageHandler(TEXT_NOT_COMMAND, send_amount_step)],
+        SEND_CONFIRM: [MessageHandler(TEXT_NOT_COMMAND, send_confirm_step)],
     },
     fallbacks=[CommandHandler("cancel", lambda u, c: ConversationHandler.END)],
     per_chat=True,
@@ -1,9 +1,12 @@
 import sqlite3
-import json
-import datetime
+import time
 from sqlite3 import Error
 import logging
 import os
+import threading
+from collections import namedtuple
+from functools import lru_cache
+from utils import TTLCache, batched
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
@@ -11,6 +14,174 @@ logger = logging.getLogger(__name__)
 # Файл базы данных
 DB_FILE = "./expense_tracker.db"
 
+# Настройки, применяемые к каждому соединению
+_CONNECTION_PRAGMAS = """
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA busy_timeout=5000;
+    PRAGMA cache_size=-20000;
+    PRAGMA mmap_size=268435456;
+"""
+
+# Версия схемы, хранится в PRAGMA user_version; увеличивается при каждом
+# изменении таблиц, индексов или переносе данных в init_db
+SCHEMA_VERSION = 2
+
+# Триггеры, которые переносят каждое изменение неоплаченных долгов в таблицу balances;
+# группа долга берется из его расхода
+_BALANCE_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS debts_balance_insert
+    AFTER INSERT ON debts WHEN NEW.status = 'unpaid'
+    BEGIN
+        INSERT INTO balances (group_id, user_id, unpaid)
+        SELECT group_id, NEW.user_id, NEW.amount FROM expenses WHERE id = NEW.expense_id
+        ON CONFLICT(group_id, user_id) DO UPDATE SET unpaid = unpaid + excluded.unpaid;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS debts_balance_update
+    AFTER UPDATE OF amount, status ON debts
+    BEGIN
+        UPDATE balances
+        SET unpaid = unpaid
+            - CASE WHEN OLD.status = 'unpaid' THEN OLD.amount ELSE 0 END
+            + CASE WHEN NEW.status = 'unpaid' THEN NEW.amount ELSE 0 END
+        WHERE user_id = NEW.user_id
+          AND group_id = (SELECT group_id FROM expenses WHERE id = NEW.expense_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS debts_balance_delete
+    AFTER DELETE ON debts WHEN OLD.status = 'unpaid'
+    BEGIN
+        UPDATE balances
+        SET unpaid = unpaid - OLD.amount
+        WHERE user_id = OLD.user_id
+          AND group_id = (SELECT group_id FROM expenses WHERE id = OLD.expense_id);
+    END
+    """,
+)
+
+# Соединение с БД у каждого потока свое (обработчики и asyncio.to_thread)
+_local = threading.local()
+
+# Столбцы с датами (INTEGER, Unix-время в секундах)
+_TIMESTAMP_COLUMNS = (
+    ('users', 'joined_date'),
+    ('groups', 'created_date'),
+    ('group_members', 'joined_date'),
+    ('expenses', 'date'),
+    ('transactions', 'timestamp'),
+)
+
+# Индексы под соединения и фильтры запросов: долги по расходу и пользователю,
+# расходы и транзакции группы, входящие/исходящие переводы, группы пользователя
+_INDEX_STATEMENTS = (
+    "CREATE INDEX IF NOT EXISTS idx_debts_expense ON debts(expense_id)",
+    # Покрывающий индекс: сумма долгов пользователя считается без чтения таблицы debts
+    "DROP INDEX IF EXISTS idx_debts_user_status",
+    "CREATE INDEX IF NOT EXISTS idx_debts_user_status_amount ON debts(user_id, status, expense_id, amount)",
+    "CREATE INDEX IF NOT EXISTS idx_expenses_id_group ON expenses(id, group_id)",
+    "CREATE INDEX IF NOT EXISTS idx_expenses_group_date ON expenses(group_id, date DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_tx_group_status_ts ON transactions(group_id, status, timestamp DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_tx_receiver_status ON transactions(receiver_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_tx_sender_status ON transactions(sender_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_gm_user ON group_members(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_ep_user ON expense_participants(user_id)",
+)
+
+# Короткоживущий кэш списков расходов и транзакций группы (меню администратора
+# запрашивает их на каждое нажатие). Любая запись в эти таблицы сбрасывает кэш
+# после фиксации транзакции, чтобы параллельное чтение не вернуло в него старые строки.
+GROUP_LIST_CACHE_TTL = 10
+_group_expenses_cache = TTLCache(maxsize=1024, ttl=GROUP_LIST_CACHE_TTL)
+_group_transactions_cache = TTLCache(maxsize=1024, ttl=GROUP_LIST_CACHE_TTL)
+# Списки участников групп: /send и выбор участников расхода читают их несколько раз
+# за один диалог. Запись пользователей или членства в группах после фиксации сбрасывает
+# списки затронутых групп (get_group_members читают и рабочие потоки, и пул отчетов).
+GROUP_MEMBERS_CACHE_TTL = 60
+_group_members_cache = TTLCache(maxsize=1024, ttl=GROUP_MEMBERS_CACHE_TTL)
+# Строки пользователей и правил групп читаются на каждом шаге диалогов, а меняются
+# только функциями этого модуля, которые сбрасывают соответствующую запись после фиксации
+ROW_CACHE_TTL = 600
+_users_cache = TTLCache(maxsize=4096, ttl=ROW_CACHE_TTL)
+_group_rules_cache = TTLCache(maxsize=1024, ttl=ROW_CACHE_TTL)
+_NOT_CACHED = object()
+# Поколения кэшей строк: писатель после фиксации увеличивает поколение и сбрасывает запись,
+# а читатель сохраняет строку, только если поколение не изменилось с начала его SELECT.
+# Иначе строка, прочитанная до фиксации, вернулась бы в кэш на весь ROW_CACHE_TTL.
+# Проверка и сохранение, увеличение и сброс выполняются под одной блокировкой
+_users_generation = 0
+_group_rules_generation = 0
+_row_cache_lock = threading.Lock()
+
+def _users_changed(user_id=None):
+    """Сбрасывает кэш строк пользователей после фиксации записи (None - весь кэш)."""
+    global _users_generation
+    with _row_cache_lock:
+        _users_generation += 1
+        if user_id is None:
+            _users_cache.clear()
+        else:
+            _users_cache.pop(user_id, None)
+
+def _group_rules_changed(group_id):
+    """Сбрасывает кэшированные правила группы после фиксации записи."""
+    global _group_rules_generation
+    with _row_cache_lock:
+        _group_rules_generation += 1
+        _group_rules_cache.pop(group_id, None)
+
+# Счетчик изменений таблицы долгов; кэши, построенные по долгам, сверяют с ним свою версию.
+# Увеличивается только после фиксации записи: читатель, взявший версию до этого,
+# сохранит результат под старой версией, и следующее обращение его не примет
+_debts_version = 0
+
+def get_debts_version():
+    """Возвращает номер текущей версии данных о долгах."""
+    return _debts_version
+
+def _debts_changed():
+    global _debts_version
+    _debts_version += 1
+
+# Счетчик изменений пользователей и состава групп, по тому же принципу
+_members_version = 0
+
+def get_members_version():
+    """Возвращает номер текущей версии данных об участниках групп."""
+    return _members_version
+
+def _members_changed(group_ids=None):
+    """Отмечает изменение участников; вызывается после фиксации записи.
+    
+    Из кэша удаляются списки участников только групп group_ids (None - всех групп).
+    """
+    global _members_version
+    _members_version += 1
+    if group_ids is None:
+        _group_members_cache.clear()
+        return
+    # Итерация по TTLCache идет по копии ключей, поэтому удалять записи можно на ходу
+    for key in _group_members_cache:
+        if key[0] in group_ids:
+            _group_members_cache.pop(key, None)
+
+def _user_group_ids(conn, user_ids):
+    """Возвращает множество групп, в которых состоят пользователи (None при ошибке чтения)."""
+    group_ids = set()
+    try:
+        for chunk in batched(list(dict.fromkeys(user_ids)), USERS_QUERY_BATCH):
+            placeholders = ','.join('?' * len(chunk))
+            cursor = conn.execute(
+                f"SELECT DISTINCT group_id FROM group_members WHERE user_id IN ({placeholders})", chunk)
+            group_ids.update(row['group_id'] for row in cursor)
+    except Error as e:
+        logger.error(f"Ошибка при получении групп пользователей: {e}")
+        return None
+    return group_ids
+
 def init_db():
     """Инициализация базы данных с необходимыми таблицами, если они не существуют."""
     # Используем корневую директорию для файла базы данных
@@ -20,6 +191,16 @@ def init_db():
         conn = sqlite3.connect(DB_FILE)
         cursor = conn.cursor()
         
+        # WAL сохраняется в файле БД: читатели больше не блокируют запись и наоборот
+        cursor.execute("PRAGMA journal_mode=WAL")
+        
+        # Схема уже создана и перенесена этой версией кода - таблицы, переносы
+        # данных и индексы не нужно разбирать и проверять при каждом запуске
+        cursor.execute("PRAGMA user_version")
+        if cursor.fetchone()[0] >= SCHEMA_VERSION:
+            logger.info("Database schema is up to date.")
+            return
+        
         # Create users table
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -27,7 +208,7 @@ def init_db():
             username TEXT,
             first_name TEXT,
             last_name TEXT,
-            joined_date TIMESTAMP
+            joined_date INTEGER
         )
         ''')
         
@@ -36,7 +217,7 @@ def init_db():
         CREATE TABLE IF NOT EXISTS groups (
             group_id INTEGER PRIMARY KEY,
             title TEXT,
-            created_date TIMESTAMP
+            created_date INTEGER
         )
         ''')
         
@@ -45,7 +226,7 @@ def init_db():
         CREATE TABLE IF NOT EXISTS group_members (
             group_id INTEGER,
             user_id INTEGER,
-            joined_date TIMESTAMP,
+            joined_date INTEGER,
             PRIMARY KEY (group_id, user_id),
             FOREIGN KEY (group_id) REFERENCES groups (group_id),
             FOREIGN KEY (user_id) REFERENCES users (user_id)
@@ -59,7 +240,7 @@ def init_db():
             group_id INTEGER,
             amount REAL,
             description TEXT,
-            date TIMESTAMP,
+            date INTEGER,
             admin_id INTEGER,
             file_id TEXT,
             participants TEXT,
@@ -89,7 +270,7 @@ def init_db():
             sender_id INTEGER,
             receiver_id INTEGER,
             amount REAL,
-            timestamp TIMESTAMP,
+            timestamp INTEGER,
             status TEXT,
             FOREIGN KEY (group_id) REFERENCES groups (group_id),
             FOREIGN KEY (sender_id) REFERENCES users (user_id),
@@ -108,6 +289,72 @@ def init_db():
         )
         ''')
         
+        # Участники расходов: строка на пару (расход, пользователь)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS expense_participants (
+            expense_id INTEGER,
+            user_id INTEGER,
+            PRIMARY KEY (expense_id, user_id),
+            FOREIGN KEY (expense_id) REFERENCES expenses (id),
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''')
+        
+        # Переносим участников, сохраненных старыми версиями в виде JSON в expenses.participants
+        cursor.execute('''
+        INSERT OR IGNORE INTO expense_participants (expense_id, user_id)
+        SELECT e.id, j.value FROM expenses e, json_each(e.participants) j
+        WHERE e.participants IS NOT NULL
+        ''')
+        cursor.execute("UPDATE expenses SET participants = NULL WHERE participants IS NOT NULL")
+        
+        # Даты хранятся как Unix-время в секундах; старые версии писали их
+        # строками локального времени, такие значения переводятся один раз
+        for table, column in _TIMESTAMP_COLUMNS:
+            cursor.execute(f"""
+            UPDATE {table} SET {column} = CAST(strftime('%s', {column}, 'utc') AS INTEGER)
+            WHERE typeof({column}) = 'text'
+            """)
+        
+        # Создание индексов
+        for statement in _INDEX_STATEMENTS:
+            cursor.execute(statement)
+        
+        # Неоплаченный остаток каждого пользователя в группе, поддерживается триггерами
+        # на таблице долгов; заполняется по существующим долгам
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS balances (
+            group_id INTEGER,
+            user_id INTEGER,
+            unpaid REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (group_id, user_id)
+        )
+        ''')
+        cursor.execute('''
+        INSERT OR REPLACE INTO balances (group_id, user_id, unpaid)
+        SELECT e.group_id, d.user_id, SUM(d.amount)
+        FROM debts d
+        JOIN expenses e ON d.expense_id = e.id
+        WHERE d.status = 'unpaid'
+        GROUP BY e.group_id, d.user_id
+        ''')
+        for statement in _BALANCE_TRIGGERS:
+            cursor.execute(statement)
+        
+        # Каскадное удаление долгов и участников вместе с расходом. Триггер вместо
+        # ON DELETE CASCADE: не требует PRAGMA foreign_keys и пересоздания таблиц.
+        # BEFORE, чтобы триггеры балансов еще видели группу удаляемого расхода
+        cursor.execute("DROP TRIGGER IF EXISTS expenses_delete_dependents")
+        cursor.execute('''
+        CREATE TRIGGER expenses_delete_dependents
+        BEFORE DELETE ON expenses
+        BEGIN
+            DELETE FROM debts WHERE expense_id = OLD.id;
+            DELETE FROM expense_participants WHERE expense_id = OLD.id;
+        END
+        ''')
+        
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
         conn.commit()
         logger.info("Database initialized successfully.")
     except Error as e:
@@ -117,16 +364,49 @@ def init_db():
             conn.close()
 
 def get_connection():
-    """Create a database connection and return it."""
+    """Return the calling thread's database connection, creating it on first use.
+
+    The connection stays open for the lifetime of the thread, so its page cache,
+    statement cache and PRAGMA settings are reused by every call.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        return conn
     try:
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row  # This enables dictionary-like access to rows
+        # Соединение живет долго, поэтому кэш подготовленных запросов больше стандартного
+        conn = sqlite3.connect(DB_FILE, cached_statements=256)
+        conn.row_factory = _dict_factory  # Rows are returned as dicts
+        # В режиме WAL NORMAL безопасен и не делает fsync на каждый commit
+        conn.executescript(_CONNECTION_PRAGMAS)
+        _local.conn = conn
         return conn
     except Error as e:
         logger.error(f"Error connecting to database: {e}")
         return None
 
+def _dict_factory(cursor, row):
+    """Build a dict for a fetched row directly, without an intermediate sqlite3.Row."""
+    return dict(zip([column[0] for column in cursor.description], row))
+
+def _release_connection(conn):
+    """Return the connection to its thread, discarding an unfinished transaction."""
+    if conn.in_transaction:
+        conn.rollback()
+
 # User-related functions
+_UPSERT_USER_SQL = """
+    INSERT INTO users (user_id, username, first_name, last_name, joined_date) 
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET 
+        username = excluded.username, 
+        first_name = excluded.first_name, 
+        last_name = excluded.last_name
+"""
+_INSERT_GROUP_MEMBER_SQL = """
+    INSERT OR IGNORE INTO group_members (group_id, user_id, joined_date) 
+    VALUES (?, ?, ?)
+"""
+
 def save_user(user_id, username, first_name, last_name):
     """Save user to database if not exists, otherwise update."""
     conn = get_connection()
@@ -134,47 +414,96 @@ def save_user(user_id, username, first_name, last_name):
         return False
     
     try:
-        cursor = conn.cursor()
-        # Check if user exists
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        if cursor.fetchone():
-            # Update existing user
-            cursor.execute("""
-                UPDATE users 
-                SET username = ?, first_name = ?, last_name = ? 
-                WHERE user_id = ?
-            """, (username, first_name, last_name, user_id))
-        else:
-            # Insert new user
-            cursor.execute("""
-                INSERT INTO users (user_id, username, first_name, last_name, joined_date) 
-                VALUES (?, ?, ?, ?, ?)
-            """, (user_id, username, first_name, last_name, datetime.datetime.now()))
-        
+        # Insert new user or update the existing one in a single statement
+        conn.execute(_UPSERT_USER_SQL, (user_id, username, first_name, last_name, int(time.time())))
         conn.commit()
+        _users_changed(user_id)
+        # Member lists are invalidated after the commit, and only for the user's groups
+        _members_changed(_user_group_ids(conn, (user_id,)))
         return True
     except Error as e:
         logger.error(f"Error saving user: {e}")
         return False
     finally:
-        conn.close()
+        _release_connection(conn)
+
+def save_users(users):
+    """Сохраняет или обновляет пачку пользователей одним запросом.
+    
+    Args:
+        users: последовательность кортежей (user_id, username, first_name, last_name)
+    """
+    conn = get_connection()
+    if not conn:
+        return False
+    
+    try:
+        users = list(users)
+        now = int(time.time())
+        conn.executemany(_UPSERT_USER_SQL, [(*user, now) for user in users])
+        conn.commit()
+        _users_changed()
+        # Списки участников сбрасываются после фиксации и только для групп этих пользователей
+        _members_changed(_user_group_ids(conn, [user[0] for user in users]))
+        return True
+    except Error as e:
+        logger.error(f"Ошибка при пакетном сохранении пользователей: {e}")
+        return False
+    finally:
+        _release_connection(conn)
 
 def get_user(user_id):
-    """Get user from database by user_id."""
+    """Get user from database by user_id (cached for ROW_CACHE_TTL seconds)."""
+    cached = _users_cache.get(user_id, _NOT_CACHED)
+    if cached is not _NOT_CACHED:
+        return cached
+    
     conn = get_connection()
     if not conn:
         return None
     
     try:
+        generation = _users_generation
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        row = cursor.fetchone()
-        return dict(row) if row else None
+        user = cursor.fetchone()
+        with _row_cache_lock:
+            if generation == _users_generation:
+                _users_cache[user_id] = user
+        return user
     except Error as e:
         logger.error(f"Error getting user: {e}")
         return None
     finally:
-        conn.close()
+        _release_connection(conn)
+
+# Максимум ID пользователей в одном запросе get_users
+USERS_QUERY_BATCH = 500
+
+def get_users(user_ids):
+    """Get several users in one query; returns {user_id: user} for the ones found."""
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
+
+    conn = get_connection()
+    if not conn:
+        return {}
+
+    try:
+        cursor = conn.cursor()
+        users = {}
+        # Пачками, чтобы не упереться в лимит числа параметров SQLite
+        for chunk in batched(user_ids, USERS_QUERY_BATCH):
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f"SELECT * FROM users WHERE user_id IN ({placeholders})", chunk)
+            users.update((row['user_id'], row) for row in cursor)
+        return users
+    except Error as e:
+        logger.error(f"Error getting users: {e}")
+        return {}
+    finally:
+        _release_connection(conn)
 
 # Group-related functions
 def save_group(group_id, title):
@@ -184,30 +513,19 @@ def save_group(group_id, title):
         return False
     
     try:
-        cursor = conn.cursor()
-        # Check if group exists
-        cursor.execute("SELECT * FROM groups WHERE group_id = ?", (group_id,))
-        if cursor.fetchone():
-            # Update existing group
-            cursor.execute("""
-                UPDATE groups 
-                SET title = ? 
-                WHERE group_id = ?
-            """, (title, group_id))
-        else:
-            # Insert new group
-            cursor.execute("""
-                INSERT INTO groups (group_id, title, created_date) 
-                VALUES (?, ?, ?)
-            """, (group_id, title, datetime.datetime.now()))
-        
+        # Insert new group or update the title of the existing one
+        conn.execute("""
+            INSERT INTO groups (group_id, title, created_date) 
+            VALUES (?, ?, ?)
+            ON CONFLICT(group_id) DO UPDATE SET title = excluded.title
+        """, (group_id, title, int(time.time())))
         conn.commit()
         return True
     except Error as e:
         logger.error(f"Error saving group: {e}")
         return False
     finally:
-        conn.close()
+        _release_connection(conn)
 
 def add_user_to_group(group_id, user_id):
     """Add user to group if not already a member."""
@@ -216,32 +534,118 @@ def add_user_to_group(group_id, user_id):
         return False
     
     try:
-        cursor = conn.cursor()
-        # Check if user is already in group
-        cursor.execute("SELECT * FROM group_members WHERE group_id = ? AND user_id = ?", 
-                      (group_id, user_id))
-        if not cursor.fetchone():
-            # Add user to group
-            cursor.execute("""
-                INSERT INTO group_members (group_id, user_id, joined_date) 
-                VALUES (?, ?, ?)
-            """, (group_id, user_id, datetime.datetime.now()))
-            
-            conn.commit()
+        # Add user to group; an existing membership is left untouched
+        cursor = conn.execute(_INSERT_GROUP_MEMBER_SQL, (group_id, user_id, int(time.time())))
+        conn.commit()
+        if cursor.rowcount:
+            _members_changed({group_id})
         return True
     except Error as e:
         logger.error(f"Error adding user to group: {e}")
         return False
     finally:
-        conn.close()
+        _release_connection(conn)
+
+def add_users_to_group(group_id, user_ids):
+    """Добавляет в группу сразу несколько пользователей; уже состоящие в ней пропускаются."""
+    conn = get_connection()
+    if not conn:
+        return False
+    
+    try:
+        now = int(time.time())
+        conn.executemany(_INSERT_GROUP_MEMBER_SQL,
+                         [(group_id, user_id, now) for user_id in dict.fromkeys(user_ids)])
+        conn.commit()
+        _members_changed({group_id})
+        return True
+    except Error as e:
+        logger.error(f"Ошибка при пакетном добавлении пользователей в группу: {e}")
+        return False
+    finally:
+        _release_connection(conn)
+
+def save_group_members(group_id, users, user_ids):
+    """Сохраняет пачку пользователей и добавляет пользователей в группу одной транзакцией.
+    
+    Args:
+        group_id: ID группы
+        users: кортежи (user_id, username, first_name, last_name) для сохранения или обновления
+        user_ids: ID пользователей, добавляемых в группу (уже состоящие пропускаются)
+    """
+    conn = get_connection()
+    if not conn:
+        return False
+    
+    try:
+        users = list(users)
+        now = int(time.time())
+        with conn:
+            conn.executemany(_UPSERT_USER_SQL, [(*user, now) for user in users])
+            conn.executemany(_INSERT_GROUP_MEMBER_SQL,
+                             [(group_id, user_id, now) for user_id in dict.fromkeys(user_ids)])
+        _users_changed()
+        # Данные пользователей видны и в других их группах: сбрасываем списки этих групп
+        group_ids = _user_group_ids(conn, [user[0] for user in users])
+        _members_changed(None if group_ids is None else group_ids | {group_id})
+        return True
+    except Error as e:
+        logger.error(f"Ошибка при сохранении участников группы: {e}")
+        return False
+    finally:
+        _release_connection(conn)
+
+# Поля участника, достаточные для построения кнопок выбора
+MEMBER_FIELDS = ('user_id', 'first_name', 'last_name', 'username')
+_MEMBER_ID_FIELDS = ('user_id',)
+_USER_COLUMNS = frozenset(('user_id', 'username', 'first_name', 'last_name'))
+
+@lru_cache(maxsize=None)
+def _member_record(fields):
+    """Возвращает тип именованного кортежа для заданного набора полей участника."""
+    return namedtuple('GroupMember', fields)
+
+# В модуле два правила распознавания ботов, и они намеренно различаются:
+# - is_bot (отчеты): имя пользователя оканчивается на "bot". Telegram требует такого
+#   окончания от имен всех ботов, поэтому правило отсекает ровно ботов; это прежний
+#   фильтр отчетов, и вынос его в SQL не меняет состав сводной таблицы.
+# - _NOT_BOT_CONDITION (exclude_bots: выбор участников и разделение расхода): "bot"
+#   в любом месте имени пользователя или имени. Правило шире и скорее исключит
+#   человека из раздела расхода, чем запишет долг на бота.
+# LIKE в SQLite не различает регистр латиницы. is_bot вычисляется при выборке
+# и кэшируется вместе с участниками
+_IS_BOT_COLUMN = "COALESCE(u.username, '') LIKE '%bot' AS is_bot"
+
+# Пользователь не считается ботом, если ни имя пользователя, ни имя не содержат "bot"
+_NOT_BOT_CONDITION = """
+    (u.username IS NULL OR LOWER(u.username) NOT LIKE '%bot%') 
+    AND (u.first_name IS NULL OR LOWER(u.first_name) NOT LIKE '%bot%')
+"""
 
-def get_group_members(group_id, exclude_bots=False):
+def get_group_members(group_id, exclude_bots=False, exclude_user_ids=(), fields=None):
     """Получение всех участников группы.
     
     Args:
         group_id: ID группы
         exclude_bots: если True, исключить ботов из результата
+        exclude_user_ids: ID пользователей, которых не нужно включать в результат
+        fields: если указан кортеж колонок (например, MEMBER_FIELDS), выбираются только
+            они, а участники возвращаются именованными кортежами вместо словарей
+    
+    Словари участников дополнительно содержат is_bot (1, если имя пользователя
+    оканчивается на "bot").
     """
+    if fields is not None:
+        fields = tuple(fields)
+        unknown = set(fields) - _USER_COLUMNS
+        if unknown:
+            raise ValueError(f"Неизвестные поля участника: {sorted(unknown)}")
+    
+    cache_key = (group_id, exclude_bots, tuple(exclude_user_ids), fields)
+    cached = _group_members_cache.get(cache_key)
+    if cached is not None:
+        return list(cached)
+    
     conn = get_connection()
     if not conn:
         logger.error(f"Не удалось подключиться к базе данных при получении участников группы")
@@ -249,31 +653,78 @@ def get_group_members(group_id, exclude_bots=False):
     
     try:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT u.* FROM users u
+        columns = f"u.*, {_IS_BOT_COLUMN}" if fields is None else ', '.join(f"u.{c}" for c in fields)
+        query = f"""
+            SELECT {columns} FROM users u
             JOIN group_members gm ON u.user_id = gm.user_id
             WHERE gm.group_id = ?
-        """, (group_id,))
-        rows = cursor.fetchall()
-        members = [dict(row) for row in rows]
+        """
+        params = [group_id]
+        
+        if exclude_user_ids:
+            placeholders = ','.join(['?' for _ in exclude_user_ids])
+            query += f" AND u.user_id NOT IN ({placeholders})"
+            params.extend(exclude_user_ids)
         
         # Фильтрация ботов если требуется
         if exclude_bots:
-            # Исключаем пользователей с именем, содержащим "bot" или "_bot"
-            members = [m for m in members if not (
-                (m.get('username') and ('bot' in m.get('username').lower())) or
-                (m.get('first_name') and ('bot' in m.get('first_name').lower()))
-            )]
-        
-        logger.info(f"Группа {group_id} имеет {len(members)} участников: {members}")
-        return members
+            query += f" AND {_NOT_BOT_CONDITION}"
+        
+        if fields is not None:
+            # Именованные кортежи строятся из обычных кортежей строк
+            cursor.row_factory = None
+        cursor.execute(query, params)
+        if fields is None:
+            members = cursor.fetchall()
+        else:
+            members = list(map(_member_record(fields)._make, cursor))
+        
+        # Список форматируется, только если включен уровень DEBUG
+        logger.debug("Группа %s имеет %d участников: %s", group_id, len(members), members)
+        _group_members_cache[cache_key] = members
+        return list(members)
     except Error as e:
         logger.error(f"Ошибка при получении участников группы: {e}")
         return []
     finally:
-        conn.close()
+        _release_connection(conn)
 
 # Expense-related functions
+
+def get_group_member_by_username(group_id, username):
+    """Находит участника группы по имени пользователя (без @); возвращает словарь или None."""
+    conn = get_connection()
+    if not conn:
+        return None
+    
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT u.* FROM users u
+            JOIN group_members gm ON u.user_id = gm.user_id
+            WHERE gm.group_id = ? AND u.username = ?
+            LIMIT 1
+        """, (group_id, username))
+        return cursor.fetchone()
+    except Error as e:
+        logger.error(f"Ошибка при поиске участника группы по имени пользователя: {e}")
+        return None
+    finally:
+        _release_connection(conn)
+
+_INSERT_EXPENSE_SQL = """
+    INSERT INTO expenses (group_id, amount, description, date, admin_id, file_id) 
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+_INSERT_EXPENSE_PARTICIPANT_SQL = """
+    INSERT OR IGNORE INTO expense_participants (expense_id, user_id) 
+    VALUES (?, ?)
+"""
+_INSERT_DEBT_SQL = """
+    INSERT INTO debts (user_id, expense_id, amount, status) 
+    VALUES (?, ?, ?, ?)
+"""
+
 def add_expense(group_id, amount, description, admin_id, file_id=None, participants=None):
     """Добавляет новый расход в базу данных."""
     conn = get_connection()
@@ -285,63 +736,65 @@ def add_expense(group_id, amount, description, admin_id, file_id=None, participa
         
         # Если участники не указаны, получаем всех участников группы (кроме ботов)
         if participants is None:
-            # Получаем всех участников группы, исключая ботов
-            members = get_group_members(group_id, exclude_bots=True)
-            participants = [m['user_id'] for m in members]
+            # Получаем ID всех участников группы, исключая ботов; список берется
+            # из кэша участников, пока состав группы не менялся
+            members = get_group_members(group_id, exclude_bots=True, fields=_MEMBER_ID_FIELDS)
+            participants = [member.user_id for member in members]
         else:
-            # Если список участников указан явно, проверяем, есть ли среди них боты
-            # Получаем информацию о пользователях, чтобы проверить, являются ли они ботами
-            filtered_participants = []
-            for user_id in participants:
-                cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-                user = cursor.fetchone()
-                if user:
-                    user_dict = dict(user)
-                    # Проверяем, является ли пользователь ботом
-                    is_bot = False
-                    username = user_dict.get('username')
-                    first_name = user_dict.get('first_name')
-                    
-                    if username and 'bot' in username.lower():
-                        is_bot = True
-                    if first_name and 'bot' in first_name.lower():
-                        is_bot = True
-                    
-                    if not is_bot:
-                        filtered_participants.append(user_id)
-            participants = filtered_participants
+            # Если список участников указан явно, отбрасываем ботов и неизвестных
+            # пользователей одним запросом; порядок участников сохраняется
+            if participants:
+                placeholders = ','.join('?' * len(participants))
+                cursor.execute(f"""
+                    SELECT u.user_id FROM users u 
+                    WHERE u.user_id IN ({placeholders}) AND {_NOT_BOT_CONDITION}
+                """, participants)
+                humans = {row['user_id'] for row in cursor.fetchall()}
+                participants = [user_id for user_id in participants if user_id in humans]
         
         # Исключаем создателя расхода из списка участников, если он там есть
         if admin_id in participants:
             participants.remove(admin_id)
         
+        # Расход и все его долги записываются в одной транзакции; блокировка записи
+        # берется сразу, а не при первом INSERT
+        conn.execute("BEGIN IMMEDIATE")
+        
         # Добавляем расход
-        cursor.execute("""
-            INSERT INTO expenses (group_id, amount, description, date, admin_id, file_id, participants) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (group_id, amount, description, datetime.datetime.now(), 
-              admin_id, file_id, json.dumps(participants)))
+        cursor.execute(_INSERT_EXPENSE_SQL, (group_id, amount, description, int(time.time()), admin_id, file_id))
         
         expense_id = cursor.lastrowid
+        cursor.executemany(_INSERT_EXPENSE_PARTICIPANT_SQL, [(expense_id, user_id) for user_id in participants])
         
         # Рассчитываем индивидуальную сумму долга
         if participants:
             individual_amount = amount / len(participants)
             
-            # Добавляем долги для всех участников
-            for user_id in participants:
-                cursor.execute("""
-                    INSERT INTO debts (user_id, expense_id, amount, status) 
-                    VALUES (?, ?, ?, ?)
-                """, (user_id, expense_id, individual_amount, 'unpaid'))
+            # Добавляем долги для всех участников одним executemany
+            debt_rows = [(user_id, expense_id, individual_amount, 'unpaid') for user_id in participants]
+            cursor.executemany(_INSERT_DEBT_SQL, debt_rows)
         
         conn.commit()
+        _group_expenses_cache.pop(group_id, None)
+        _debts_changed()
         return expense_id
     except Error as e:
         logger.error(f"Ошибка при добавлении расхода: {e}")
         return None
     finally:
-        conn.close()
+        _release_connection(conn)
+
+# Столбец со списком ID участников расхода e через запятую; разбирается _expense_record
+_PARTICIPANT_IDS_COLUMN = """
+    (SELECT GROUP_CONCAT(ep.user_id) FROM expense_participants ep WHERE ep.expense_id = e.id) AS participant_ids
+"""
+
+def _expense_record(row):
+    """Заменяет в строке расхода столбец participant_ids списком participants."""
+    expense = row
+    participant_ids = expense.pop('participant_ids')
+    expense['participants'] = [int(user_id) for user_id in participant_ids.split(',')] if participant_ids else []
+    return expense
 
 def get_expense(expense_id):
     """Get expense details by ID."""
@@ -351,55 +804,67 @@ def get_expense(expense_id):
     
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM expenses WHERE id = ?", (expense_id,))
+        cursor.execute(f"SELECT e.*, {_PARTICIPANT_IDS_COLUMN} FROM expenses e WHERE e.id = ?", (expense_id,))
         row = cursor.fetchone()
-        if row:
-            expense = dict(row)
-            expense['participants'] = json.loads(expense['participants'])
-            return expense
-        return None
+        return _expense_record(row) if row else None
     except Error as e:
         logger.error(f"Error getting expense: {e}")
         return None
     finally:
-        conn.close()
+        _release_connection(conn)
 
-def get_group_expenses(group_id, start_date=None, end_date=None):
-    """Get all expenses for a group, optionally filtered by date range."""
+def _to_epoch(value):
+    """Переводит datetime в Unix-время; числа возвращаются без изменений."""
+    return int(value.timestamp()) if hasattr(value, 'timestamp') else value
+
+def get_group_expenses(group_id, start_date=None, end_date=None, limit=None):
+    """Get all expenses for a group, optionally filtered by date range.
+    
+    With ``limit`` only the most recent ``limit`` expenses are returned; such
+    partial lists are served from the full cached list when it exists, but never cached.
+    """
+    unfiltered = not start_date and not end_date
+    cacheable = unfiltered and limit is None
+    if unfiltered:
+        cached = _group_expenses_cache.get(group_id)
+        if cached is not None:
+            return cached if limit is None else cached[:limit]
+    
     conn = get_connection()
     if not conn:
         return []
     
     try:
         cursor = conn.cursor()
-        query = "SELECT * FROM expenses WHERE group_id = ?"
+        query = f"SELECT e.*, {_PARTICIPANT_IDS_COLUMN} FROM expenses e WHERE e.group_id = ?"
         params = [group_id]
         
         if start_date:
             query += " AND date >= ?"
-            params.append(start_date)
+            params.append(_to_epoch(start_date))
         
         if end_date:
             query += " AND date <= ?"
-            params.append(end_date)
+            params.append(_to_epoch(end_date))
         
         query += " ORDER BY date DESC"
         
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
         
-        expenses = []
-        for row in rows:
-            expense = dict(row)
-            expense['participants'] = json.loads(expense['participants'])
-            expenses.append(expense)
+        cursor.execute(query, params)
+        # Строки читаются из курсора по мере разбора, без промежуточного списка
+        expenses = [_expense_record(row) for row in cursor]
         
+        if cacheable:
+            _group_expenses_cache[group_id] = expenses
         return expenses
     except Error as e:
         logger.error(f"Error getting group expenses: {e}")
         return []
     finally:
-        conn.close()
+        _release_connection(conn)
 
 def get_user_debts(user_id, group_id=None):
     """Get all debts for a user, optionally filtered by group."""
@@ -427,13 +892,12 @@ def get_user_debts(user_id, group_id=None):
                 ORDER BY e.date DESC
             """, (user_id,))
         
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+        return cursor.fetchall()
     except Error as e:
         logger.error(f"Error getting user debts: {e}")
         return []
     finally:
-        conn.close()
+        _release_connection(conn)
 
 def get_user_debt_summary(user_id, group_id):
     """Get summary of user's debts for a specific group."""
@@ -443,20 +907,17 @@ def get_user_debt_summary(user_id, group_id):
     
     try:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT SUM(d.amount) as total_debt
-            FROM debts d
-            JOIN expenses e ON d.expense_id = e.id
-            WHERE d.user_id = ? AND e.group_id = ? AND d.status = 'unpaid'
-        """, (user_id, group_id))
+        # Остаток поддерживается триггерами на долгах; округление убирает
+        # погрешность накопленных сложений и вычитаний
+        cursor.execute("SELECT unpaid FROM balances WHERE group_id = ? AND user_id = ?", (group_id, user_id))
         
         result = cursor.fetchone()
-        return float(result['total_debt']) if result and result['total_debt'] else 0.0
+        return round(result['unpaid'], 2) if result and result['unpaid'] else 0.0
     except Error as e:
         logger.error(f"Error getting user debt summary: {e}")
         return 0.0
     finally:
-        conn.close()
+        _release_connection(conn)
 
 # Transaction-related functions
 def create_transaction(group_id, sender_id, receiver_id, amount):
@@ -470,16 +931,17 @@ def create_transaction(group_id, sender_id, receiver_id, amount):
         cursor.execute("""
             INSERT INTO transactions (group_id, sender_id, receiver_id, amount, timestamp, status) 
             VALUES (?, ?, ?, ?, ?, ?)
-        """, (group_id, sender_id, receiver_id, amount, datetime.datetime.now(), 'pending'))
+        """, (group_id, sender_id, receiver_id, amount, int(time.time()), 'pending'))
         
         transaction_id = cursor.lastrowid
         conn.commit()
+        _group_transactions_cache.clear()
         return transaction_id
     except Error as e:
         logger.error(f"Error creating transaction: {e}")
         return None
     finally:
-        conn.close()
+        _release_connection(conn)
 
 def get_transaction(transaction_id):
     """Get transaction details by ID."""
@@ -490,77 +952,78 @@ def get_transaction(transaction_id):
     try:
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM transactions WHERE id = ?", (transaction_id,))
-        row = cursor.fetchone()
-        return dict(row) if row else None
+        return cursor.fetchone()
     except Error as e:
         logger.error(f"Error getting transaction: {e}")
         return None
     finally:
-        conn.close()
+        _release_connection(conn)
+
+# Погашение долгов пользователя в группе суммой перевода за один UPDATE:
+# cum - накопленная сумма долгов в порядке их создания
+_PAY_OFF_DEBTS_SQL = """
+    WITH ordered AS (
+        SELECT d.rowid AS debt_rowid, 
+               SUM(d.amount) OVER (ORDER BY e.date, d.expense_id ROWS UNBOUNDED PRECEDING) AS cum, 
+               d.amount AS debt_amount
+        FROM debts d
+        JOIN expenses e ON d.expense_id = e.id
+        WHERE d.user_id = :user_id AND e.group_id = :group_id AND d.status = 'unpaid'
+    )
+    UPDATE debts 
+    SET status = CASE WHEN ordered.cum <= :amount THEN 'paid' ELSE debts.status END, 
+        amount = CASE WHEN ordered.cum > :amount THEN ordered.cum - :amount ELSE debts.amount END
+    FROM ordered
+    WHERE debts.rowid = ordered.debt_rowid AND ordered.cum - ordered.debt_amount < :amount
+"""
 
 def update_transaction_status(transaction_id, status):
-    """Update transaction status (pending, confirmed, rejected)."""
+    """Update transaction status (pending, confirmed, rejected).
+    
+    Confirming a transaction pays off the receiver's debts in the same database
+    transaction and on the same connection as the status change.
+    """
     conn = get_connection()
     if not conn:
         return False
     
     try:
         cursor = conn.cursor()
+        # Смена статуса и погашение долгов выполняются в одной транзакции
+        conn.execute("BEGIN IMMEDIATE")
         cursor.execute("""
             UPDATE transactions 
             SET status = ? 
             WHERE id = ?
         """, (status, transaction_id))
-        conn.commit()
         
         # If transaction is confirmed, update debts
         if status == 'confirmed':
-            # Get transaction details
-            transaction = get_transaction(transaction_id)
+            cursor.execute("SELECT receiver_id, group_id, amount FROM transactions WHERE id = ?",
+                           (transaction_id,))
+            transaction = cursor.fetchone()
             if transaction:
-                # Get receiver's debts to pay off with this amount
-                debts = get_user_debts(transaction['receiver_id'], transaction['group_id'])
-                # Сортируем долги по дате создания (сначала старые)
-                debts.sort(key=lambda x: x.get('date', ''), reverse=False)
-                remaining_amount = transaction['amount']
-                
-                # Логируем для отладки
-                logger.info(f"Обработка транзакции {transaction_id}: сумма {remaining_amount}, получатель {transaction['receiver_id']}")
-                logger.info(f"Найдено {len(debts)} неоплаченных долгов на общую сумму: {sum([d['amount'] for d in debts])}")
-                
-                # Pay off debts until the amount is used up
-                for debt in debts:
-                    if remaining_amount <= 0:
-                        break
-                    
-                    logger.info(f"Обрабатываем долг {debt['id']}: {debt['amount']} руб. за {debt.get('description', 'без описания')}")
-                    
-                    if remaining_amount >= debt['amount']:
-                        # Pay off entire debt
-                        cursor.execute("""
-                            UPDATE debts 
-                            SET status = 'paid' 
-                            WHERE user_id = ? AND expense_id = ? AND status = 'unpaid'
-                        """, (transaction['receiver_id'], debt['expense_id']))
-                        remaining_amount -= debt['amount']
-                    else:
-                        # Pay off part of debt
-                        new_amount = debt['amount'] - remaining_amount
-                        cursor.execute("""
-                            UPDATE debts 
-                            SET amount = ? 
-                            WHERE user_id = ? AND expense_id = ? AND status = 'unpaid'
-                        """, (new_amount, transaction['receiver_id'], debt['expense_id']))
-                        remaining_amount = 0
-                
-                conn.commit()
+                receiver_id, group_id, amount = transaction['receiver_id'], transaction['group_id'], transaction['amount']
+                # Гасим неоплаченные долги получателя, начиная с самых старых: долги,
+                # накопленная сумма которых укладывается в перевод, закрываются целиком,
+                # а первый не уместившийся уменьшается на остаток
+                cursor.execute(_PAY_OFF_DEBTS_SQL, {
+                    'user_id': receiver_id, 'group_id': group_id, 'amount': amount
+                })
+                logger.info("Обработка транзакции %s: сумма %s, получатель %s, изменено долгов: %s",
+                            transaction_id, amount, receiver_id, cursor.rowcount)
         
+        conn.commit()
+        # Кэш и версия долгов меняются после фиксации: иначе параллельное чтение
+        # успело бы сохранить данные до изменения под новой версией
+        _group_transactions_cache.clear()
+        _debts_changed()
         return True
     except Error as e:
         logger.error(f"Error updating transaction status: {e}")
         return False
     finally:
-        conn.close()
+        _release_connection(conn)
 
 def get_pending_transactions(user_id, as_receiver=True):
     """Get pending transactions for a user."""
@@ -587,13 +1050,12 @@ def get_pending_transactions(user_id, as_receiver=True):
                 ORDER BY t.timestamp DESC
             """, (user_id,))
         
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+        return cursor.fetchall()
     except Error as e:
         logger.error(f"Error getting pending transactions: {e}")
         return []
     finally:
-        conn.close()
+        _release_connection(conn)
 
 # Функции для управления расходами
 
@@ -607,8 +1069,9 @@ def get_expense_with_debts(expense_id):
         cursor = conn.cursor()
         
         # Получаем данные о расходе
-        cursor.execute("""
-            SELECT e.*, u.username as admin_username, u.first_name as admin_first_name, u.last_name as admin_last_name
+        cursor.execute(f"""
+            SELECT e.*, u.username as admin_username, u.first_name as admin_first_name, u.last_name as admin_last_name, 
+                   {_PARTICIPANT_IDS_COLUMN}
             FROM expenses e
             LEFT JOIN users u ON e.admin_id = u.user_id
             WHERE e.id = ?
@@ -618,8 +1081,7 @@ def get_expense_with_debts(expense_id):
         if not expense:
             return None
         
-        expense_dict = dict(expense)
-        expense_dict['participants'] = json.loads(expense_dict['participants'])
+        expense_dict = _expense_record(expense)
         
         # Получаем все связанные долги
         cursor.execute("""
@@ -629,7 +1091,7 @@ def get_expense_with_debts(expense_id):
             WHERE d.expense_id = ?
         """, (expense_id,))
         
-        debts = [dict(row) for row in cursor.fetchall()]
+        debts = cursor.fetchall()
         expense_dict['debts'] = debts
         
         return expense_dict
@@ -637,7 +1099,7 @@ def get_expense_with_debts(expense_id):
         logger.error(f"Ошибка при получении расхода с долгами: {e}")
         return None
     finally:
-        conn.close()
+        _release_connection(conn)
 
 def update_expense_amount(expense_id, new_amount):
     """Обновляет сумму расхода и пересчитывает связанные долги."""
@@ -649,51 +1111,45 @@ def update_expense_amount(expense_id, new_amount):
         cursor = conn.cursor()
         
         # Получаем текущую информацию о расходе
-        cursor.execute("SELECT * FROM expenses WHERE id = ?", (expense_id,))
+        cursor.execute("SELECT amount FROM expenses WHERE id = ?", (expense_id,))
         expense = cursor.fetchone()
         if not expense:
             return False, "Расход не найден"
         
         old_amount = expense['amount']
-        participants = json.loads(expense['participants'])
+        cursor.execute("SELECT COUNT(*) AS participant_count FROM expense_participants WHERE expense_id = ?",
+                       (expense_id,))
+        participant_count = cursor.fetchone()['participant_count']
         
         # Если нет участников, просто обновляем сумму
-        if not participants:
+        if not participant_count:
             cursor.execute("UPDATE expenses SET amount = ? WHERE id = ?", (new_amount, expense_id))
             conn.commit()
+            _group_expenses_cache.clear()
+            _debts_changed()
             return True, "Сумма расхода обновлена"
         
-        # Вычисляем новую индивидуальную сумму долга
-        new_individual_amount = new_amount / len(participants)
-        
         # Обновляем сумму расхода
         cursor.execute("UPDATE expenses SET amount = ? WHERE id = ?", (new_amount, expense_id))
         
-        # Обновляем все связанные долги
-        cursor.execute("SELECT * FROM debts WHERE expense_id = ?", (expense_id,))
-        debts = cursor.fetchall()
-        
-        for debt in debts:
-            # Пропорционально обновляем сумму долга
-            if old_amount > 0:  # Избегаем деления на ноль
-                proportion = debt['amount'] / old_amount
-                new_debt_amount = new_amount * proportion
-            else:
-                new_debt_amount = new_individual_amount
-            
-            cursor.execute("""
-                UPDATE debts 
-                SET amount = ? 
-                WHERE id = ?
-            """, (new_debt_amount, debt['id']))
+        # Обновляем все связанные долги одним запросом: пропорционально прежней сумме,
+        # а при нулевой прежней сумме (деление на ноль) поровну между участниками
+        if old_amount > 0:
+            cursor.execute("UPDATE debts SET amount = amount * ? / ? WHERE expense_id = ?",
+                           (new_amount, old_amount, expense_id))
+        else:
+            cursor.execute("UPDATE debts SET amount = ? WHERE expense_id = ?",
+                           (new_amount / participant_count, expense_id))
         
         conn.commit()
+        _group_expenses_cache.clear()
+        _debts_changed()
         return True, "Сумма расхода и связанные долги обновлены"
     except Error as e:
         logger.error(f"Ошибка при обновлении суммы расхода: {e}")
         return False, f"Ошибка: {str(e)}"
     finally:
-        conn.close()
+        _release_connection(conn)
 
 def delete_expense(expense_id):
     """Удаляет расход и связанные с ним долги."""
@@ -704,22 +1160,29 @@ def delete_expense(expense_id):
     try:
         cursor = conn.cursor()
         
-        # Сначала удаляем все связанные долги
-        cursor.execute("DELETE FROM debts WHERE expense_id = ?", (expense_id,))
-        
-        # Затем удаляем сам расход
+        # Долги и участники расхода удаляются триггером expenses_delete_dependents
         cursor.execute("DELETE FROM expenses WHERE id = ?", (expense_id,))
         
         conn.commit()
+        _group_expenses_cache.clear()
+        _debts_changed()
         return True, "Расход и связанные долги успешно удалены"
     except Error as e:
         logger.error(f"Ошибка при удалении расхода: {e}")
         return False, f"Ошибка: {str(e)}"
     finally:
-        conn.close()
+        _release_connection(conn)
 
-def get_group_transactions(group_id, status=None):
-    """Получает все транзакции в группе с опциональной фильтрацией по статусу."""
+def get_group_transactions(group_id, status=None, limit=None):
+    """Получает все транзакции в группе с опциональной фильтрацией по статусу.
+    
+    С limit возвращаются только limit последних транзакций (такой список не кэшируется).
+    """
+    cache_key = (group_id, status)
+    cached = _group_transactions_cache.get(cache_key)
+    if cached is not None:
+        return cached if limit is None else cached[:limit]
+    
     conn = get_connection()
     if not conn:
         return []
@@ -744,14 +1207,20 @@ def get_group_transactions(group_id, status=None):
         
         query += " ORDER BY t.timestamp DESC"
         
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        
         cursor.execute(query, params)
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+        transactions = cursor.fetchall()
+        if limit is None:
+            _group_transactions_cache[cache_key] = transactions
+        return transactions
     except Error as e:
         logger.error(f"Ошибка при получении транзакций группы: {e}")
         return []
     finally:
-        conn.close()
+        _release_connection(conn)
 
 def delete_transaction(transaction_id):
     """Удаляет транзакцию."""
@@ -762,24 +1231,30 @@ def delete_transaction(transaction_id):
     try:
         cursor = conn.cursor()
         
-        # Проверяем, существует ли транзакция
-        cursor.execute("SELECT * FROM transactions WHERE id = ?", (transaction_id,))
-        transaction = cursor.fetchone()
-        if not transaction:
-            return False, "Транзакция не найдена"
-        
-        # Удаляем транзакцию
+        # Удаляем транзакцию; ноль удаленных строк означает, что ее не было
         cursor.execute("DELETE FROM transactions WHERE id = ?", (transaction_id,))
+        if not cursor.rowcount:
+            return False, "Транзакция не найдена"
         
         conn.commit()
+        _group_transactions_cache.clear()
         return True, "Транзакция успешно удалена"
     except Error as e:
         logger.error(f"Ошибка при удалении транзакции: {e}")
         return False, f"Ошибка: {str(e)}"
     finally:
-        conn.close()
+        _release_connection(conn)
 
 # Функция для сброса данных группы
+_RESET_GROUP_STATEMENTS = (
+    # Долги и участники расходов удаляются триггером expenses_delete_dependents
+    "DELETE FROM expenses WHERE group_id = ?",
+    "DELETE FROM transactions WHERE group_id = ?",
+    "DELETE FROM balances WHERE group_id = ?",
+    # Сбрасываем правила группы (если они есть)
+    "DELETE FROM rules WHERE group_id = ?",
+)
+
 def reset_group_data(group_id):
     """Сбрасывает все данные группы (расходы, долги, транзакции) без удаления пользователей."""
     conn = get_connection()
@@ -789,49 +1264,48 @@ def reset_group_data(group_id):
     try:
         cursor = conn.cursor()
         
-        # Получаем все ID расходов в этой группе
-        cursor.execute("SELECT id FROM expenses WHERE group_id = ?", (group_id,))
-        expense_ids = [row['id'] for row in cursor.fetchall()]
-        
-        # Удаляем все долги, связанные с этими расходами
-        if expense_ids:
-            expense_ids_str = ','.join(['?' for _ in expense_ids])
-            cursor.execute(f"DELETE FROM debts WHERE expense_id IN ({expense_ids_str})", expense_ids)
-        
-        # Удаляем все расходы группы
-        cursor.execute("DELETE FROM expenses WHERE group_id = ?", (group_id,))
-        
-        # Удаляем все транзакции группы
-        cursor.execute("DELETE FROM transactions WHERE group_id = ?", (group_id,))
-        
-        # Сбрасываем правила группы (если они есть)
-        cursor.execute("DELETE FROM rules WHERE group_id = ?", (group_id,))
+        # Все удаления идут по group_id в одной транзакции, без чтения ID расходов в Python
+        conn.execute("BEGIN IMMEDIATE")
+        for statement in _RESET_GROUP_STATEMENTS:
+            cursor.execute(statement, (group_id,))
         
         conn.commit()
+        _group_expenses_cache.pop(group_id, None)
+        _group_transactions_cache.clear()
+        _group_rules_changed(group_id)
+        _debts_changed()
         return True
     except Error as e:
         logger.error(f"Ошибка при сбросе данных группы: {e}")
         return False
     finally:
-        conn.close()
+        _release_connection(conn)
 
 # Rules-related functions
 def get_group_rules(group_id):
-    """Получает правила для определенной группы."""
+    """Получает правила для определенной группы (кэшируются на ROW_CACHE_TTL секунд)."""
+    cached = _group_rules_cache.get(group_id, _NOT_CACHED)
+    if cached is not _NOT_CACHED:
+        return cached
+    
     conn = get_connection()
     if not conn:
         return None
     
     try:
+        generation = _group_rules_generation
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM rules WHERE group_id = ?", (group_id,))
-        row = cursor.fetchone()
-        return dict(row) if row else None
+        rules = cursor.fetchone()
+        with _row_cache_lock:
+            if generation == _group_rules_generation:
+                _group_rules_cache[group_id] = rules
+        return rules
     except Error as e:
         logger.error(f"Ошибка при получении правил группы: {e}")
         return None
     finally:
-        conn.close()
+        _release_connection(conn)
 
 def set_group_rules(group_id, description, deadline_hours, notifications_time):
     """Устанавливает или обновляет правила для группы."""
@@ -840,27 +1314,20 @@ def set_group_rules(group_id, description, deadline_hours, notifications_time):
         return False
     
     try:
-        cursor = conn.cursor()
-        # Проверяем, существуют ли правила
-        cursor.execute("SELECT * FROM rules WHERE group_id = ?", (group_id,))
-        if cursor.fetchone():
-            # Обновляем существующие правила
-            cursor.execute("""
-                UPDATE rules 
-                SET description = ?, deadline_hours = ?, notifications_time = ? 
-                WHERE group_id = ?
-            """, (description, deadline_hours, notifications_time, group_id))
-        else:
-            # Вставляем новые правила
-            cursor.execute("""
-                INSERT INTO rules (group_id, description, deadline_hours, notifications_time) 
-                VALUES (?, ?, ?, ?)
-            """, (group_id, description, deadline_hours, notifications_time))
-        
+        # Вставляем новые правила или обновляем существующие одним запросом
+        conn.execute("""
+            INSERT INTO rules (group_id, description, deadline_hours, notifications_time) 
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(group_id) DO UPDATE SET 
+                description = excluded.description, 
+                deadline_hours = excluded.deadline_hours, 
+                notifications_time = excluded.notifications_time
+        """, (group_id, description, deadline_hours, notifications_time))
         conn.commit()
+        _group_rules_changed(group_id)
         return True
     except Error as e:
         logger.error(f"Ошибка при установке правил группы: {e}")
         return False
     finally:
-        conn.close()
+        _release_connection(conn)
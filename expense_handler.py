@@ -1,12 +1,22 @@
-import datetime
+import heapq
 import logging
 from db_manager import (add_expense, get_group_members, get_user_debt_summary, 
                        create_transaction, update_transaction_status, 
-                       get_transaction, get_user_debts)
+                       get_transaction, get_user_debts, get_debts_version)
+from utils import TTLCache, fmt_date_short
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Готовые сообщения о долгах по (user_id, group_id); запись действительна,
+# пока не изменились долги (версия из db_manager) и не истек TTL
+DEBT_MESSAGE_CACHE_TTL = 30
+_debt_message_cache = TTLCache(maxsize=1024, ttl=DEBT_MESSAGE_CACHE_TTL)
+
+# Сколько расходов показывать в деталях долга: длинный список все равно не
+# поместится в сообщение Telegram (4096 символов), поэтому выводятся самые крупные
+DEBT_DETAILS_LIMIT = 30
+
 def handle_new_expense(group_id, amount, description, admin_id, file_id=None, participants=None):
     """Обрабатывает создание нового расхода и рассчитывает долги."""
     try:
@@ -117,18 +127,34 @@ def reject_transaction(transaction_id):
 
 def format_debt_message(user_id, group_id):
     """Форматирует сообщение с информацией о долгах пользователя."""
+    key = (user_id, group_id)
+    version = get_debts_version()
+    cached = _debt_message_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    
+    message = _build_debt_message(user_id, group_id)
+    _debt_message_cache[key] = (version, message)
+    return message
+
+def _build_debt_message(user_id, group_id):
+    """Строит сообщение о долгах по данным из БД (без кэша)."""
     total_debt = get_user_total_debt(user_id, group_id)
     detailed_debts = get_user_detailed_debts(user_id, group_id)
     
     if total_debt <= 0 and not detailed_debts:
         return "У вас нет долгов в этой группе! 🎉"
     
-    message = f"💰 *Ваш общий долг:* {total_debt:.2f} руб.\n\n"
+    parts = [f"💰 *Ваш общий долг:* {total_debt:.2f} руб.\n\n"]
     
     if detailed_debts:
-        message += "*Детали по расходам:*\n"
-        for debt in detailed_debts:
-            date_str = datetime.datetime.fromisoformat(debt['date']).strftime('%d.%m.%Y')
-            message += f"- {debt['description']}: {debt['amount']:.2f} руб. ({date_str})\n"
+        parts.append("*Детали по расходам:*\n")
+        shown = detailed_debts
+        if len(detailed_debts) > DEBT_DETAILS_LIMIT:
+            shown = heapq.nlargest(DEBT_DETAILS_LIMIT, detailed_debts, key=lambda debt: debt['amount'])
+        for debt in shown:
+            parts.append(f"- {debt['description']}: {debt['amount']:.2f} руб. ({fmt_date_short(debt['date'])})\n")
+        if len(detailed_debts) > len(shown):
+            parts.append(f"…и ещё {len(detailed_debts) - len(shown)} записей\n")
     
-    return message
+    return "".join(parts)
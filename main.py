@@ -1,22 +1,55 @@
 import os
+import re
+import queue
 import logging
+import importlib.util
+from logging.handlers import QueueHandler, QueueListener
+from telegram.request import HTTPXRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ConversationHandler
 from bot_commands import (start, rules, add_expense, my_debt, report, send_money, 
                           help_command, button_callback, photo_handler, handle_pending_state,
                           expense_conversation_handler, rules_conversation_handler, 
-                          send_conversation_handler, handle_new_member, reset_group,
-                          handle_my_chat_member)
+                          send_conversation_handler, handle_new_member, user_intro_step, reset_group,
+                          handle_my_chat_member, cache_bot_id, flush_pending_user_saves,
+                          help_callback, expense_all_members_callback, expense_selective_callback,
+                          admin_edit_expenses_callback, admin_delete_expenses_callback,
+                          admin_delete_transactions_callback, admin_reset_callback,
+                          admin_back_callback, TEXT_NOT_COMMAND)
 from db_manager import init_db
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Настройка логирования: обработчики пишут записи в очередь, а вывод выполняет
+# отдельный поток QueueListener, поэтому медленный вывод не задерживает обработчики бота
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, _log_handler)
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(_log_queue)])
 logger = logging.getLogger(__name__)
 
+# Все кнопки, которые обрабатывает button_callback, в одном регулярном выражении:
+# для каждого нажатия проверяется один шаблон, а не полтора десятка обработчиков
+BUTTON_CALLBACK_PATTERN = re.compile(r"^(?:" + "|".join([
+    r"(?:confirm|reject)_transaction_\d+",         # Транзакции
+    r"participant_\d+", r"participants_(?:all|done)",  # Выбор участников
+    r"expense_photo_(?:yes|no)",                    # Фото чеков
+    r"send_(?:to_\d+|confirm|cancel)",              # Перевод денег
+    r"setup_rules_(?:yes|no)",                      # Настройка правил
+    r"reset_(?:confirm|cancel)",                    # Сброс данных группы
+    r"(?:edit|delete)_expense_\d+", r"delete_transaction_\d+",  # Административное меню
+    r"confirm_delete_(?:expense|transaction)_\d+",  # Подтверждение удаления
+]) + r")$")
+
 def main():
     """Запуск бота."""
+    _log_listener.start()
+    try:
+        _run_bot()
+    finally:
+        # Выводим оставшиеся в очереди записи перед выходом
+        _log_listener.stop()
+
+def _run_bot():
+    """Настройка и запуск приложения бота."""
     # Инициализация базы данных
     init_db()
     
@@ -26,8 +59,38 @@ def main():
         logger.error("Токен не предоставлен. Установите переменную окружения TELEGRAM_BOT_TOKEN.")
         return
 
+    # Общий HTTP-клиент для запросов к Bot API: большой пул постоянных соединений,
+    # HTTP/2 (мультиплексирование в одном соединении), если установлен пакет h2
+    http_version = "2" if importlib.util.find_spec("h2") else "1.1"
+    # Загрузка файлов отчетов получает отдельный, более длинный таймаут записи
+    request = HTTPXRequest(
+        connection_pool_size=256,
+        connect_timeout=5,
+        read_timeout=20,
+        media_write_timeout=120,
+        pool_timeout=5,
+        http_version=http_version
+    )
+    # Long polling держит собственное постоянное соединение той же версии HTTP,
+    # чтобы getUpdates не занимал пул и не ждал его
+    get_updates_request = HTTPXRequest(http_version=http_version)
+    
     # Создание экземпляра приложения
-    application = Application.builder().token(token).build()
+    builder = (Application.builder().token(token)
+               .request(request)
+               .get_updates_request(get_updates_request)
+               .post_init(cache_bot_id)
+               .post_shutdown(flush_pending_user_saves))
+    
+    # Необязательный локальный сервер Bot API (telegram-bot-api), например
+    # http://localhost:8081: файлы отчетов не идут через api.telegram.org
+    api_url = os.getenv("TELEGRAM_API_URL")
+    if api_url:
+        api_url = api_url.rstrip("/")
+        builder = builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot")
+        logger.info(f"Используется сервер Bot API {api_url}")
+    
+    application = builder.build()
 
     # Добавление обработчиков диалогов
     application.add_handler(expense_conversation_handler)
@@ -42,52 +105,38 @@ def main():
     application.add_handler(CommandHandler("reset", reset_group))
     
     # Добавление обработчиков для различных типов кнопок
-    # Обработчики транзакций
-    application.add_handler(CallbackQueryHandler(button_callback, pattern=r"^(confirm|reject)_transaction_\d+$"))
+    # Транзакции, участники, фото чеков, переводы, правила, сброс и удаление записей
+    application.add_handler(CallbackQueryHandler(button_callback, pattern=BUTTON_CALLBACK_PATTERN))
     
-    # Обработчики выбора участников
-    application.add_handler(CallbackQueryHandler(button_callback, pattern=r"^participant_\d+$"))
-    application.add_handler(CallbackQueryHandler(button_callback, pattern=r"^participants_all$"))
-    application.add_handler(CallbackQueryHandler(button_callback, pattern=r"^participants_done$"))
-    
-    # Обработчики фото чеков
-    application.add_handler(CallbackQueryHandler(button_callback, pattern=r"^expense_photo_(yes|no)$"))
-    
-    # Обработчики перевода денег
-    application.add_handler(CallbackQueryHandler(button_callback, pattern=r"^send_(to_\d+|confirm|cancel)$"))
+    # Обработчики выбора типа добавления расхода
+    application.add_handler(CallbackQueryHandler(expense_all_members_callback, pattern=r"^expense_all_members$"))
+    application.add_handler(CallbackQueryHandler(expense_selective_callback, pattern=r"^expense_selective$"))
     
     # Обработчики меню помощи
-    application.add_handler(CallbackQueryHandler(button_callback, pattern=r"^help_\w+$"))
-    
-    # Обработчики настройки правил
-    application.add_handler(CallbackQueryHandler(button_callback, pattern=r"^setup_rules_(yes|no)$"))
-    
-    # Обработчики сброса данных группы
-    application.add_handler(CallbackQueryHandler(button_callback, pattern=r"^reset_(confirm|cancel)$"))
+    application.add_handler(CallbackQueryHandler(help_callback, pattern=r"^help_\w+$"))
     
     # Обработчики административного меню
-    application.add_handler(CallbackQueryHandler(button_callback, pattern=r"^admin_(edit_expenses|delete_expenses|delete_transactions|reset|back)$"))
-    application.add_handler(CallbackQueryHandler(button_callback, pattern=r"^edit_expense_\d+$"))
-    application.add_handler(CallbackQueryHandler(button_callback, pattern=r"^delete_expense_\d+$"))
-    application.add_handler(CallbackQueryHandler(button_callback, pattern=r"^delete_transaction_\d+$"))
-    
-    # Обработчики подтверждения удаления расходов и транзакций
-    application.add_handler(CallbackQueryHandler(button_callback, pattern=r"^confirm_delete_(expense|transaction)_\d+$"))
+    application.add_handler(CallbackQueryHandler(admin_edit_expenses_callback, pattern=r"^admin_edit_expenses$"))
+    application.add_handler(CallbackQueryHandler(admin_delete_expenses_callback, pattern=r"^admin_delete_expenses$"))
+    application.add_handler(CallbackQueryHandler(admin_delete_transactions_callback, pattern=r"^admin_delete_transactions$"))
+    application.add_handler(CallbackQueryHandler(admin_reset_callback, pattern=r"^admin_reset$"))
+    application.add_handler(CallbackQueryHandler(admin_back_callback, pattern=r"^admin_back$"))
     
     # Обработчик для продолжения диалога после нажатия на кнопки в меню help
     application.add_handler(MessageHandler(
-        filters.TEXT & ~filters.COMMAND & ~filters.REPLY,
+        TEXT_NOT_COMMAND & ~filters.REPLY,
         handle_pending_state
     ))
     
+    # Ответ на приветствие новому участнику (имя или фамилия); обычный текст
+    # представления handle_pending_state передает user_intro_step сам, после своих состояний
+    application.add_handler(MessageHandler(TEXT_NOT_COMMAND & filters.REPLY, user_intro_step))
+    
     # Обработчик для фото вне диалогов
     application.add_handler(MessageHandler(filters.PHOTO & ~filters.REPLY, photo_handler))
     
-    # Обработчик для новых участников группы
-    application.add_handler(MessageHandler(
-        filters.StatusUpdate.NEW_CHAT_MEMBERS, 
-        handle_new_member
-    ))
+    # Обработчик для новых участников группы: просит их представиться
+    application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, handle_new_member))
     
     # TODO: Добавить обработчик для MY_CHAT_MEMBER события
     # Временно отключено из-за проблем с совместимостью версий
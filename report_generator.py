@@ -1,15 +1,135 @@
-import pandas as pd
 import logging
 import io
+import os
 import datetime
-from db_manager import get_group_expenses, get_group_members, get_user_debt_summary, get_user
-from fpdf import FPDF
+import functools
+import importlib.util
+from collections import defaultdict
+from db_manager import (get_group_expenses, get_group_members, get_user_debt_summary, get_users,
+                        get_debts_version, get_members_version)
+from utils import TTLCache, fmt_date_long, minimize_transactions
+
+# pandas (с xlsxwriter/openpyxl) и fpdf импортируются внутри функций отчетов: они нужны только
+# для /report, а их загрузка при старте заметно увеличивает время запуска и память бота
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
+# Excel пишется через xlsxwriter в режиме constant_memory: строки сбрасываются на диск
+# по мере записи, а не держатся всей книгой в памяти. Без пакета остается openpyxl
+if importlib.util.find_spec("xlsxwriter"):
+    _EXCEL_WRITER_OPTIONS = {'engine': 'xlsxwriter', 'engine_kwargs': {'options': {'constant_memory': True}}}
+else:
+    _EXCEL_WRITER_OPTIONS = {'engine': 'openpyxl'}
+
+# Готовые отчеты (байты файла) вместе с версией данных, по которой они построены.
+# Любое изменение расходов, долгов или участников меняет версию, и отчет строится заново
+REPORT_CACHE_TTL = 300
+_report_cache = TTLCache(maxsize=256, ttl=REPORT_CACHE_TTL)
+
+class _FallbackReport(io.BytesIO):
+    """Упрощенный отчет, построенный запасным путем после ошибки; в кэш не попадает."""
+
+def _cached_report(generate):
+    """Кэширует полностью построенный отчет, пока не изменились данные группы.
+    
+    Каждый вызов получает свой BytesIO. Запасные отчеты (_FallbackReport) не кэшируются,
+    чтобы разовая ошибка не закрепила упрощенный отчет до изменения данных.
+    """
+    @functools.wraps(generate)
+    def wrapper(group_id, start_date=None, end_date=None):
+        key = (generate.__name__, group_id, start_date, end_date)
+        # Версию берем до построения. db_manager меняет версии только после фиксации записи,
+        # поэтому отчет, построенный во время изменения, сохранится под старой версией
+        # и при следующем обращении будет построен заново
+        version = (get_debts_version(), get_members_version())
+        cached = _report_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return io.BytesIO(cached[1])
+        
+        report = generate(group_id, start_date, end_date)
+        if report is not None and not isinstance(report, _FallbackReport):
+            _report_cache[key] = (version, report.getvalue())
+        return report
+    return wrapper
+
+# Шрифты DejaVu для кириллицы в PDF. Их наличие проверяется один раз при импорте:
+# без них отчет сразу строится в упрощенном виде, без попытки создать PDF с кириллицей
+DEJAVU_REGULAR_PATH = '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+DEJAVU_BOLD_PATH = '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf'
+_DEJAVU_AVAILABLE = os.path.exists(DEJAVU_REGULAR_PATH) and os.path.exists(DEJAVU_BOLD_PATH)
+
+def _make_dejavu_pdf():
+    """Создает документ FPDF с зарегистрированными шрифтами DejaVu (обычный и жирный)."""
+    from fpdf import FPDF
+    pdf = FPDF()
+    pdf.add_font('DejaVu', '', DEJAVU_REGULAR_PATH, uni=True)
+    pdf.add_font('DejaVu', 'B', DEJAVU_BOLD_PATH, uni=True)
+    return pdf
+
+def _pdf_to_bytesio(pdf, fallback=False):
+    """Возвращает документ FPDF в BytesIO без временного файла.
+    
+    fpdf 1.7 отдает документ строкой latin-1 (символы вне latin-1 дают UnicodeEncodeError,
+    как и при записи в файл), fpdf2 - bytearray, который BytesIO принимает как есть.
+    Используется всеми путями генерации PDF; запасные пути передают fallback=True
+    и получают _FallbackReport, который не кэшируется.
+    """
+    data = pdf.output(dest='S')
+    if isinstance(data, str):
+        data = data.encode('latin-1')
+    return (_FallbackReport if fallback else io.BytesIO)(data)
+
+def _expense_totals(expenses):
+    """Суммирует расходы по добавившим их пользователям за один проход."""
+    totals_by_admin = defaultdict(float)
+    for expense in expenses:
+        totals_by_admin[expense['admin_id']] += expense['amount']
+    return totals_by_admin
+
+def _compute_debts(totals_by_admin, member_ids):
+    """Считает траты и долги участников по суммам расходов каждого добавившего.
+    
+    Возвращает два списка в порядке member_ids: суммы трат и долги, где
+    долг = (сумма всех трат / кол-во участников) - сумма трат участника.
+    """
+    share_per_person = sum(totals_by_admin.values()) / len(member_ids) if member_ids else 0.0
+    totals = [totals_by_admin.get(user_id, 0.0) for user_id in member_ids]
+    return totals, [share_per_person - total for total in totals]
+
+def _users_by_id(expenses, members):
+    """Собирает пользователей, добавивших расходы: участники группы берутся из уже
+    полученного списка, остальные загружаются одним запросом."""
+    users = {member['user_id']: member for member in members}
+    missing = {expense['admin_id'] for expense in expenses} - users.keys()
+    if missing:
+        users.update(get_users(missing))
+    return users
+
+def _human_members(members):
+    """Отбирает участников-людей за один проход.
+    
+    Возвращает два параллельных списка (user_id, полные имена): дальше отчеты
+    работают со столбцами, а не со словарями участников.
+    """
+    user_ids = []
+    full_names = []
+    for member in members:
+        # Фильтруем ботов: признак is_bot (имя пользователя оканчивается на 'bot')
+        # вычисляется при выборке участников из базы
+        if member['is_bot']:
+            continue
+        username = member.get('username') or ''
+        full_name = f"{member.get('first_name') or ''} {member.get('last_name') or ''}".strip()
+        user_ids.append(member['user_id'])
+        full_names.append(full_name or username or 'Неизвестно')
+    return user_ids, full_names
+
+@_cached_report
 def generate_excel_report(group_id, start_date=None, end_date=None):
     """Создает Excel отчет о расходах и долгах для группы."""
+    import pandas as pd
+    
     try:
         # Получаем расходы
         expenses = get_group_expenses(group_id, start_date, end_date)
@@ -17,69 +137,54 @@ def generate_excel_report(group_id, start_date=None, end_date=None):
         # Получаем участников
         members = get_group_members(group_id)
         
-        # Создаем датафрейм расходов
-        expense_data = []
+        # Создаем датафрейм расходов по столбцам: pandas не разбирает словарь на каждую строку
+        users = _users_by_id(expenses, members)
+        admin_names = []
         for expense in expenses:
             # Получаем информацию о пользователе, добавившем расход
-            admin = get_user(expense['admin_id'])
-            admin_name = f"{admin.get('first_name', '')} {admin.get('last_name', '')}".strip() if admin else str(expense['admin_id'])
-            
-            expense_data.append({
-                'ID': expense['id'],
-                'Дата': datetime.datetime.fromisoformat(expense['date']).strftime('%d.%m.%Y %H:%M'),
-                'Описание': expense['description'],
-                'Сумма': expense['amount'],
-                'Добавил': admin_name
-            })
+            admin = users.get(expense['admin_id'])
+            admin_names.append(f"{admin.get('first_name', '')} {admin.get('last_name', '')}".strip() if admin else str(expense['admin_id']))
         
-        expense_df = pd.DataFrame(expense_data)
+        expense_df = pd.DataFrame({
+            'ID': [expense['id'] for expense in expenses],
+            'Дата': [fmt_date_long(expense['date']) for expense in expenses],
+            'Описание': [expense['description'] for expense in expenses],
+            'Сумма': [expense['amount'] for expense in expenses],
+            'Добавил': admin_names
+        })
         
         # Создаем датафрейм для сводной таблицы, исключая бота
-        debt_data = []
-        # Фильтруем ботов по имени пользователя (как правило, имена ботов заканчиваются на 'bot')
-        human_members = [m for m in members if not m.get('username', '').lower().endswith('bot')]
-        
-        # Рассчитываем общую сумму расходов
-        total_expense_sum = sum(e['amount'] for e in expenses)
-        
-        # Перебираем каждого участника, кроме бота
-        for i, member in enumerate(human_members, 1):
-            user_id = member['user_id']
-            
-            # Получаем полное имя пользователя
-            first_name = member.get('first_name', '')
-            last_name = member.get('last_name', '')
-            full_name = f"{first_name} {last_name}".strip()
-            if not full_name:
-                full_name = member.get('username', 'Неизвестно')
-            
-            # Определяем общую сумму трат пользователя
-            # Находим все расходы, созданные этим пользователем
-            user_expenses = [e for e in expenses if e['admin_id'] == user_id]
-            total_expenses = sum(e['amount'] for e in user_expenses)
-            
-            # Рассчитываем долг по новой формуле:
-            # (Сумма всех трат всех участников / кол-во участников) - сумма трат пользователя
-            share_per_person = total_expense_sum / len(human_members)
-            debt = share_per_person - total_expenses
-            
-            debt_data.append({
-                '№': i,
-                'ID': user_id,
-                'Имя Фамилия': full_name,
-                'Общая сумма трат': total_expenses,
-                'Долг': debt
-            })
-        
-        debt_df = pd.DataFrame(debt_data)
+        member_ids, member_names = _human_members(members)
+        
+        # Рассчитываем суммы трат и долги каждого участника, кроме бота
+        member_totals, member_debts = _compute_debts(_expense_totals(expenses), member_ids)
+        
+        debt_df = pd.DataFrame({
+            '№': range(1, len(member_ids) + 1),
+            'ID': member_ids,
+            'Имя Фамилия': member_names,
+            'Общая сумма трат': member_totals,
+            'Долг': member_debts
+        })
+        
+        # Рекомендуемые переводы: минимальное число переводов, которое закрывает все долги
+        names_by_id = dict(zip(member_ids, member_names))
+        transfers = minimize_transactions(dict(zip(member_ids, member_debts)))
+        transfer_df = pd.DataFrame({
+            'Кто переводит': [names_by_id[from_id] for from_id, _, _ in transfers],
+            'Кому': [names_by_id[to_id] for _, to_id, _ in transfers],
+            'Сумма': [round(amount, 2) for _, _, amount in transfers]
+        })
         
         # Создаем объект BytesIO для хранения данных в памяти
         output = io.BytesIO()
         
-        # Создаем Excel-писатель с использованием BytesIO
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        # Создаем Excel-писатель с использованием BytesIO.
+        # В режиме constant_memory строки пишутся только по порядку: листы не форматируем после записи
+        with pd.ExcelWriter(output, **_EXCEL_WRITER_OPTIONS) as writer:
             expense_df.to_excel(writer, sheet_name='Расходы', index=False)
             debt_df.to_excel(writer, sheet_name='Сводная таблица', index=False)
+            transfer_df.to_excel(writer, sheet_name='Рекомендуемые переводы', index=False)
         
         # Получаем содержимое объекта BytesIO
         output.seek(0)
@@ -88,8 +193,11 @@ def generate_excel_report(group_id, start_date=None, end_date=None):
         logger.error(f"Ошибка создания Excel отчета: {e}")
         return None
 
+@_cached_report
 def generate_pdf_report(group_id, start_date=None, end_date=None):
     """Создать PDF отчет о расходах и долгах для группы."""
+    from fpdf import FPDF
+    
     try:
         # Получаем расходы
         expenses = get_group_expenses(group_id, start_date, end_date)
@@ -97,20 +205,14 @@ def generate_pdf_report(group_id, start_date=None, end_date=None):
         # Получаем участников
         members = get_group_members(group_id)
         
-        # Создаем PDF с поддержкой кириллицы (DejaVu)
-        class PDF(FPDF):
-            def __init__(self):
-                super().__init__()
-                # Добавляем поддержку кириллицы
-                self.add_font('DejaVu', '', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', uni=True)
-                self.add_font('DejaVu', 'B', '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf', uni=True)
+        # Без шрифтов DejaVu кириллицу не отобразить: сразу строим простой PDF
+        if not _DEJAVU_AVAILABLE:
+            logger.warning("Шрифты DejaVu не найдены, используем стандартный шрифт")
+            return generate_simple_pdf_report(group_id, expenses, members)
         
-        # Создаем PDF объект
+        # Создаем PDF объект с поддержкой кириллицы (DejaVu)
         try:
-            pdf = PDF()
-            # Проверяем, что шрифты загрузились
-            font_test = pdf.fonts.get('DejaVu')
-            use_dejavu = True
+            pdf = _make_dejavu_pdf()
         except Exception as e:
             logger.warning(f"Не удалось загрузить шрифт DejaVu, используем стандартный: {e}")
             # Если шрифт не загрузился, то мы не сможем отображать кириллицу правильно
@@ -146,11 +248,18 @@ def generate_pdf_report(group_id, start_date=None, end_date=None):
         
         # Данные таблицы расходов
         pdf.set_font("DejaVu", "", 10)
-            
+        
+        users = _users_by_id(expenses, members)
+        # Имя автора считается один раз на пользователя, а не для каждой строки
+        admin_names = {}
+        # Суммы трат для сводной таблицы набираются в том же проходе по расходам
+        totals_by_admin = defaultdict(float)
+        # Метод вывода ячейки вызывается в циклах для каждой строки таблиц
+        cell = pdf.cell
         for expense in expenses:
-            date_str = datetime.datetime.fromisoformat(expense['date']).strftime('%d.%m.%Y %H:%M')
-            pdf.cell(20, 10, str(expense['id']), 1, 0, "C")
-            pdf.cell(40, 10, date_str, 1, 0, "C")
+            date_str = fmt_date_long(expense['date'])
+            cell(20, 10, str(expense['id']), 1, 0, "C")
+            cell(40, 10, date_str, 1, 0, "C")
             
             # Обработка длинных описаний
             description = expense['description']
@@ -158,17 +267,22 @@ def generate_pdf_report(group_id, start_date=None, end_date=None):
                 # Используем простые точки вместо специального символа многоточия
                 description = description[:27] + "..."
             
-            pdf.cell(70, 10, description, 1, 0, "L")
-            pdf.cell(30, 10, f"{expense['amount']:.2f}", 1, 0, "R")
+            cell(70, 10, description, 1, 0, "L")
+            cell(30, 10, f"{expense['amount']:.2f}", 1, 0, "R")
             
             # Получаем информацию о пользователе, добавившем расход
-            admin = get_user(expense['admin_id'])
-            admin_name = f"{admin.get('first_name', '')} {admin.get('last_name', '')}".strip() if admin else str(expense['admin_id'])
-            
-            if not admin_name and admin:
-                admin_name = admin.get('username', str(expense['admin_id']))
+            admin_id = expense['admin_id']
+            totals_by_admin[admin_id] += expense['amount']
+            admin_name = admin_names.get(admin_id)
+            if admin_name is None:
+                admin = users.get(admin_id)
+                admin_name = f"{admin.get('first_name', '')} {admin.get('last_name', '')}".strip() if admin else str(admin_id)
                 
-            pdf.cell(30, 10, admin_name, 1, 1, "C")
+                if not admin_name and admin:
+                    admin_name = admin.get('username', str(admin_id))
+                admin_names[admin_id] = admin_name
+                
+            cell(30, 10, admin_name, 1, 1, "C")
         
         pdf.ln(10)
         
@@ -193,63 +307,24 @@ def generate_pdf_report(group_id, start_date=None, end_date=None):
         # Данные таблицы долгов
         pdf.set_font("DejaVu", "", 10)
         
-        # Фильтруем ботов по имени пользователя (как правило, имена ботов заканчиваются на 'bot')
-        human_members = [m for m in members if not m.get('username', '').lower().endswith('bot')]
+        member_ids, member_names = _human_members(members)
         
-        # Рассчитываем общую сумму расходов
-        total_expense_sum = sum(e['amount'] for e in expenses)
+        # Рассчитываем суммы трат и долги каждого участника, кроме бота
+        member_totals, member_debts = _compute_debts(totals_by_admin, member_ids)
         
         # Перебираем каждого участника, кроме бота
-        for i, member in enumerate(human_members, 1):
-            user_id = member['user_id']
-            
-            # Получаем полное имя пользователя
-            first_name = member.get('first_name', '')
-            last_name = member.get('last_name', '')
-            full_name = f"{first_name} {last_name}".strip()
-            if not full_name:
-                full_name = member.get('username', 'Неизвестно')
-            
-            # Определяем общую сумму трат пользователя
-            user_expenses = [e for e in expenses if e['admin_id'] == user_id]
-            total_expenses = sum(e['amount'] for e in user_expenses)
-            
-            # Рассчитываем долг по новой формуле:
-            # (Сумма всех трат всех участников / кол-во участников) - сумма трат пользователя
-            share_per_person = total_expense_sum / len(human_members)
-            debt = share_per_person - total_expenses
-            
+        for i, (user_id, full_name, total_expenses, debt) in enumerate(
+                zip(member_ids, member_names, member_totals, member_debts), 1):
             # Выводим строку с данными пользователя
-            pdf.cell(10, 10, str(i), 1, 0, "C")
-            pdf.cell(30, 10, str(user_id), 1, 0, "C")
-            pdf.cell(60, 10, full_name, 1, 0, "L")
-            pdf.cell(45, 10, f"{total_expenses:.2f}", 1, 0, "R")
-            pdf.cell(45, 10, f"{debt:.2f}", 1, 1, "R")
+            cell(10, 10, str(i), 1, 0, "C")
+            cell(30, 10, str(user_id), 1, 0, "C")
+            cell(60, 10, full_name, 1, 0, "L")
+            cell(45, 10, f"{total_expenses:.2f}", 1, 0, "R")
+            cell(45, 10, f"{debt:.2f}", 1, 1, "R")
         
         # Сохраняем PDF напрямую в BytesIO объект
-        output = io.BytesIO()
-        
-        # Создаем временный файл-дескриптор в памяти и получаем его имя
-        import tempfile
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_file:
-            temp_filename = temp_file.name
-            
-        # Сохраняем PDF во временный файл
         try:
-            pdf.output(temp_filename)
-            
-            # Читаем файл в BytesIO
-            with open(temp_filename, 'rb') as f:
-                output.write(f.read())
-                
-            # Удаляем временный файл
-            import os
-            os.unlink(temp_filename)
-            
-            # Возвращаем BytesIO в начало для чтения
-            output.seek(0)
-            
-            return output
+            return _pdf_to_bytesio(pdf)
             
         except Exception as e:
             logger.error(f"Ошибка сохранения PDF: {e}")
@@ -267,26 +342,7 @@ def generate_pdf_report(group_id, start_date=None, end_date=None):
             simple_pdf.cell(0, 10, "Otchet", 0, 1, "C") # Простая метка
             
             # Сохраняем самый простой PDF
-            output = io.BytesIO()
-            
-            # Создаем временный файл для PDF
-            import tempfile
-            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as backup_file:
-                backup_filename = backup_file.name
-            
-            simple_pdf.output(backup_filename)
-            
-            # Читаем файл в BytesIO
-            with open(backup_filename, 'rb') as f:
-                output = io.BytesIO(f.read())
-            
-            # Удаляем временный файл
-            import os
-            os.unlink(backup_filename)
-            
-            # Возвращаем BytesIO в начало для чтения
-            output.seek(0)
-            return output
+            return _pdf_to_bytesio(simple_pdf, fallback=True)
             
         except Exception as e2:
             logger.error(f"Критическая ошибка создания PDF: {e2}")
@@ -294,6 +350,8 @@ def generate_pdf_report(group_id, start_date=None, end_date=None):
 
 def generate_simple_pdf_report(group_id, expenses=None, members=None):
     """Создает простой PDF отчет без кириллицы для случаев, когда шрифты не доступны."""
+    from fpdf import FPDF
+    
     try:
         # Если данные не предоставлены, получаем их
         if expenses is None:
@@ -301,8 +359,7 @@ def generate_simple_pdf_report(group_id, expenses=None, members=None):
         if members is None:
             members = get_group_members(group_id)
         
-        # Фильтруем ботов по имени пользователя (как правило, имена ботов заканчиваются на 'bot')
-        human_members = [m for m in members if not m.get('username', '').lower().endswith('bot')]
+        member_ids, _ = _human_members(members)
         
         # Создаем PDF объект
         pdf = FPDF()
@@ -318,7 +375,7 @@ def generate_simple_pdf_report(group_id, expenses=None, members=None):
         pdf.cell(0, 10, f"Report date: {datetime.datetime.now().strftime('%d.%m.%Y %H:%M')}", 0, 1, "L")
         pdf.cell(0, 10, f"Group ID: {group_id}", 0, 1, "L")
         pdf.cell(0, 10, f"Number of expenses: {len(expenses)}", 0, 1, "L")
-        pdf.cell(0, 10, f"Number of human members: {len(human_members)}", 0, 1, "L")
+        pdf.cell(0, 10, f"Number of human members: {len(member_ids)}", 0, 1, "L")
         pdf.ln(10)
         
         # Добавляем информацию о том, что полный отчет доступен в Excel
@@ -326,27 +383,7 @@ def generate_simple_pdf_report(group_id, expenses=None, members=None):
         pdf.cell(0, 10, "Please use Excel report for full information with correct text display.", 0, 1, "C")
         
         # Сохраняем PDF напрямую в BytesIO объект
-        output = io.BytesIO()
-        
-        # Создаем временный файл для PDF
-        import tempfile
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_file:
-            temp_filename = temp_file.name
-        
-        # Сохраняем PDF во временный файл
-        pdf.output(temp_filename)
-        
-        # Читаем файл в BytesIO
-        with open(temp_filename, 'rb') as f:
-            output.write(f.read())
-        
-        # Удаляем временный файл
-        import os
-        os.unlink(temp_filename)
-        
-        # Возвращаем BytesIO в начало для чтения
-        output.seek(0)
-        return output
+        return _pdf_to_bytesio(pdf, fallback=True)
         
     except Exception as e:
         logger.error(f"Ошибка создания простого PDF отчета: {e}")
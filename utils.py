@@ -1,71 +1,256 @@
 import re
+import time
+import asyncio
 import logging
+import threading
+from datetime import datetime
+from functools import lru_cache
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from itertools import islice
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+try:
+    from itertools import batched
+except ImportError:  # Python < 3.12
+    def batched(iterable, n):
+        """Split iterable into tuples of length n (the last one may be shorter)."""
+        iterator = iter(iterable)
+        while chunk := tuple(islice(iterator, n)):
+            yield chunk
+
+class TTLCache(MutableMapping):
+    """Dict-like container with a maximum size and a per-entry time to live.
+
+    Entries expire ``ttl`` seconds after they were set. When an entry expires or
+    is pushed out because the cache is full, ``on_evict(key, value)`` is called.
+    Explicit deletion (``del``/``pop``) does not trigger the callback.
+    If ``default_factory`` is given, ``cache[key]`` creates missing entries like
+    ``collections.defaultdict`` does; ``get``/``in``/``pop`` never create them.
+    Operations are serialized with a lock, so a cache may be shared with worker threads.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, maxsize, ttl, on_evict=None, default_factory=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.default_factory = default_factory
+        # key -> (expires_at, value); insertion order == expiration order
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _evict(self, key, value):
+        if self.on_evict is None:
+            return
+        try:
+            self.on_evict(key, value)
+        except Exception as e:
+            logger.error(f"Error in cache eviction callback for {key}: {e}")
+
+    def expire(self):
+        """Remove all expired entries."""
+        with self._lock:
+            now = time.monotonic()
+            while self._data:
+                key, (expires_at, value) = next(iter(self._data.items()))
+                if expires_at > now:
+                    break
+                del self._data[key]
+                self._evict(key, value)
+
+    def __getitem__(self, key):
+        with self._lock:
+            self.expire()
+            try:
+                return self._data[key][1]
+            except KeyError:
+                if self.default_factory is None:
+                    raise
+            value = self[key] = self.default_factory()
+            return value
+
+    def __contains__(self, key):
+        with self._lock:
+            self.expire()
+            return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            self.expire()
+            item = self._data.get(key)
+            return default if item is None else item[1]
+
+    def pop(self, key, default=_MISSING):
+        with self._lock:
+            self.expire()
+            item = self._data.pop(key, None)
+        if item is not None:
+            return item[1]
+        if default is self._MISSING:
+            raise KeyError(key)
+        return default
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self.expire()
+            self._data.pop(key, None)
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            while len(self._data) > self.maxsize:
+                old_key, (_, old_value) = self._data.popitem(last=False)
+                self._evict(old_key, old_value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self.expire()
+            del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __iter__(self):
+        with self._lock:
+            self.expire()
+            return iter(list(self._data))
+
+    def __len__(self):
+        with self._lock:
+            self.expire()
+            return len(self._data)
+
+class AsyncRateLimiter:
+    """Token bucket allowing at most ``max_rate`` acquisitions per ``period`` seconds.
+
+    Use as ``async with limiter:``; waiters are served in FIFO order.
+    """
+
+    def __init__(self, max_rate, period=1.0):
+        self.max_rate = max_rate
+        self._refill_rate = max_rate / period
+        self._tokens = float(max_rate)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.max_rate, self._tokens + (now - self._updated) * self._refill_rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._refill_rate)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+# Administrator IDs per chat; admin lists change rarely, so a short TTL is enough
+ADMIN_CACHE_TTL = 60
+_chat_admin_ids = TTLCache(maxsize=4096, ttl=ADMIN_CACHE_TTL)
+# In-flight getChatAdministrators requests, shared by concurrent checks in the same chat
+_admin_id_requests = {}
+
+async def _fetch_admin_ids(bot, chat_id):
+    try:
+        chat_admins = await bot.get_chat_administrators(chat_id)
+        admin_ids = frozenset(admin.user.id for admin in chat_admins)
+        _chat_admin_ids[chat_id] = admin_ids
+        return admin_ids
+    finally:
+        _admin_id_requests.pop(chat_id, None)
+
 async def is_admin(update, context):
-    """Check if the user is an admin in the chat."""
+    """Check if the user is an admin in the chat.
+
+    The chat's administrator IDs are cached for ADMIN_CACHE_TTL seconds, so
+    repeated checks in the same chat cost one getChatAdministrators call;
+    checks that arrive while that call is in flight wait for its result.
+    """
     try:
         chat_id = update.effective_chat.id
         user_id = update.effective_user.id
         
-        # Get chat administrators
-        chat_admins = await context.bot.get_chat_administrators(chat_id)
-        admin_ids = [admin.user.id for admin in chat_admins]
+        admin_ids = _chat_admin_ids.get(chat_id)
+        if admin_ids is None:
+            # Get chat administrators
+            request = _admin_id_requests.get(chat_id)
+            if request is None:
+                request = _admin_id_requests[chat_id] = asyncio.ensure_future(
+                    _fetch_admin_ids(context.bot, chat_id))
+            admin_ids = await asyncio.shield(request)
         
         return user_id in admin_ids
     except Exception as e:
         logger.error(f"Error checking admin status: {e}")
         return False
 
+# /send arguments: "@username 500" (the @ is optional, a comma may separate decimals)
+_SEND_ARGS_RE = re.compile(r'@?(\w+)\s+(\d+(?:[.,]\d+)?)(?:\s|$)')
+
 def extract_username_and_amount(args):
     """Extract username and amount from /send command arguments."""
-    try:
-        # Check for format: /send @username 500
-        if len(args) >= 2:
-            username = args[0]
-            amount_str = args[1]
-            
-            # Clean username
-            if username.startswith('@'):
-                username = username[1:]
-            
-            # Convert amount to float
-            try:
-                amount = float(amount_str.replace(',', '.'))
-                if amount <= 0:
-                    return None, None
-                return username, amount
-            except ValueError:
-                return None, None
-        
-        # Alternative format with amount after username
-        elif len(args) == 1:
-            # Try to find username and amount in one argument
-            match = re.match(r'@?(\w+)\s+(\d+(?:\.\d+)?)', args[0])
-            if match:
-                username = match.group(1)
-                amount = float(match.group(2).replace(',', '.'))
-                if amount <= 0:
-                    return None, None
-                return username, amount
-        
+    match = _SEND_ARGS_RE.match(" ".join(args))
+    if not match:
         return None, None
-    except Exception as e:
-        logger.error(f"Error extracting username and amount: {e}")
+    amount = float(match.group(2).replace(',', '.'))
+    if amount <= 0:
         return None, None
+    return match.group(1), amount
 
 def format_currency(amount):
     """Format amount as currency."""
     return f"{amount:.2f} руб."
 
-def format_date(date_string):
-    """Format ISO date string to a readable format."""
-    from datetime import datetime
+def minimize_transactions(debts, epsilon=0.01):
+    """Suggest the fewest transfers that settle the given debts.
+
+    ``debts`` maps user IDs to the amount each user owes (negative when the
+    user is owed money). Greedily pairs the largest debtor with the largest
+    creditor, so at most ``n - 1`` transfers are produced. Returns a list of
+    ``(from_user_id, to_user_id, amount)``; amounts below ``epsilon`` are ignored.
+    """
+    debtors = sorted(((amount, user_id) for user_id, amount in debts.items() if amount > epsilon), reverse=True)
+    creditors = sorted(((-amount, user_id) for user_id, amount in debts.items() if amount < -epsilon), reverse=True)
+    transfers = []
+    i = j = 0
+    while i < len(debtors) and j < len(creditors):
+        owed, debtor_id = debtors[i]
+        due, creditor_id = creditors[j]
+        amount = min(owed, due)
+        transfers.append((debtor_id, creditor_id, amount))
+        debtors[i] = (owed - amount, debtor_id)
+        creditors[j] = (due - amount, creditor_id)
+        if owed - amount <= epsilon:
+            i += 1
+        if due - amount <= epsilon:
+            j += 1
+    return transfers
+
+# Dates are stored as Unix timestamps; the same expense and debt dates are shown
+# again on every report and /mydebt, so the formatted strings are memoized
+@lru_cache(maxsize=4096)
+def fmt_date_short(timestamp):
+    """Format a Unix timestamp as DD.MM.YYYY."""
+    return datetime.fromtimestamp(timestamp).strftime('%d.%m.%Y')
+
+@lru_cache(maxsize=4096)
+def fmt_date_long(timestamp):
+    """Format a Unix timestamp as DD.MM.YYYY HH:MM."""
+    return datetime.fromtimestamp(timestamp).strftime('%d.%m.%Y %H:%M')
+
+def format_date(timestamp):
+    """Format a Unix timestamp to a readable format."""
     try:
-        date = datetime.fromisoformat(date_string)
-        return date.strftime('%d.%m.%Y %H:%M')
+        return fmt_date_long(timestamp)
     except Exception as e:
         logger.error(f"Error formatting date: {e}")
-        return date_string
+        return str(timestamp)